@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.parsing.mod_args import ModuleArgsParser
+from ansible.plugins.action import ActionBase
+
+# loop items of one task on one host are run one after another by the same
+# worker process, the first item runs the whole batch and leaves the results
+# of the others here: (task uuid, host) -> batch
+_BATCHES = {}
+
+
+class LoopBatchAction(ActionBase):
+    '''
+    Run a task with loop as one module execution in batch mode.
+
+    On the first loop item the module arguments of all items are templated
+    and the module is run once with their objects in its BATCH_OPTION list,
+    every item then gets its own result cut out of the batch result. Tasks
+    where this could give different results than separate runs (when, until,
+    async, delegate_to, loop pause or extended loop variables, with_* loops,
+    items that differ in other options than the per-object ones) are run per
+    item as usual. Variable targetcli_batch_loop set to false turns batching
+    off.
+    '''
+
+    _supports_check_mode = True
+
+    # module option with list of objects and the per-object options that go into it
+    BATCH_OPTION = None
+    OBJECT_OPTIONS = ()
+
+    def object_key(self, obj):
+        raise NotImplementedError()
+
+    def item_result(self, batch_result, key):
+        '''
+        Result of item with object key from successful batch result.
+        '''
+        return {'changed': key in batch_result.get('changed_objects', [])}
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+        result = super(LoopBatchAction, self).run(tmp, task_vars)
+        del tmp
+
+        batch = self._batch(task_vars)
+        if batch is None:
+            result.update(self._execute_module(task_vars=task_vars))
+        else:
+            result.update(batch)
+        self._remove_tmp_path(self._connection._shell.tmpdir)
+        return result
+
+    def _batch(self, task_vars):
+        '''
+        Return result of the current loop item from the batch, None when the item has to run on its own.
+        '''
+        batch_id = (self._task._uuid, task_vars.get('inventory_hostname'))
+        batch = _BATCHES.get(batch_id)
+        if batch is None:
+            batch = self._prepare(task_vars)
+            if batch is None:
+                return None
+            _BATCHES[batch_id] = batch
+        index = batch['next']
+        batch['next'] += 1
+        if batch['next'] >= len(batch['objects']):
+            del _BATCHES[batch_id]
+        if batch['results'] is None:
+            return None
+        obj = self._object(self._task.args)
+        if index >= len(batch['objects']) or batch['objects'][index] != obj:
+            # loop went differently than templated on the first item
+            return None
+        return batch['results'][index]
+
+    def _object(self, args):
+        return dict((option, args.get(option)) for option in self.OBJECT_OPTIONS)
+
+    def _template(self, data, variables):
+        saved = self._templar.available_variables
+        try:
+            self._templar.available_variables = variables
+            return self._templar.template(data)
+        finally:
+            self._templar.available_variables = saved
+
+    def _batchable(self, task_vars):
+        task = self._task
+        loop_control = task.loop_control
+        if not boolean(task_vars.get('targetcli_batch_loop', True), strict=False):
+            return False
+        if task.loop is None or task.loop_with or task.when or task.until or task.async_val or task.delegate_to:
+            return False
+        if loop_control and (loop_control.pause or loop_control.extended):
+            return False
+        return self.BATCH_OPTION not in task.args
+
+    def _prepare(self, task_vars):
+        '''
+        Template arguments of all loop items and run the batch on the first item.
+        '''
+        if not self._batchable(task_vars):
+            # dropped right away, the check is cheap to repeat for every item
+            return {'next': 0, 'objects': [], 'results': None}
+        loop_control = self._task.loop_control
+        loop_var = (loop_control and loop_control.loop_var) or 'item'
+        index_var = loop_control and loop_control.index_var
+        try:
+            items = self._template(self._task.loop, task_vars)
+            raw_args = ModuleArgsParser(task_ds=self._task._ds, collection_list=self._task.collections).parse()[1]
+        except AnsibleError:
+            return {'next': 0, 'objects': [], 'results': None}
+        omit = task_vars.get('omit')
+
+        objects = []
+        common = None
+        for index, item in enumerate(items):
+            variables = dict(task_vars)
+            variables[loop_var] = item
+            if index_var:
+                variables[index_var] = index
+            args = dict((k, v) for k, v in self._template(raw_args, variables).items() if v != omit)
+            item_common = dict((k, v) for k, v in args.items() if k not in self.OBJECT_OPTIONS)
+            if common is not None and item_common != common:
+                return {'next': 0, 'objects': [None] * len(items), 'results': None}
+            common = item_common
+            objects.append(self._object(args))
+        if len(objects) < 2 or objects[0] != self._object(self._task.args):
+            return {'next': 0, 'objects': [None] * len(objects), 'results': None}
+
+        # first item's arguments carry also module_defaults
+        module_args = dict((k, v) for k, v in self._task.args.items() if k not in self.OBJECT_OPTIONS)
+        module_args[self.BATCH_OPTION] = [dict((k, v) for k, v in obj.items() if v is not None) for obj in objects]
+        batch_result = self._execute_module(module_args=module_args, task_vars=task_vars)
+        return {'next': 0, 'objects': objects, 'results': self._split(batch_result, objects)}
+
+    def _split(self, batch_result, objects):
+        keys = [self.object_key(obj) for obj in objects]
+        failed = batch_result.get('failed')
+        failed_object = batch_result.get('failed_object')
+        shared = dict((k, batch_result[k]) for k in ('warnings', 'deprecations', 'perf') if k in batch_result)
+        results = []
+        for index, key in enumerate(keys):
+            if not failed:
+                result = self.item_result(batch_result, key)
+            elif failed_object is None:
+                # failed before handling any of the objects
+                result = dict((k, v) for k, v in batch_result.items() if k not in shared)
+            elif key == failed_object:
+                result = dict((k, v) for k, v in batch_result.items() if k not in shared)
+                result['changed'] = False
+            elif keys.index(key) < keys.index(failed_object):
+                result = self.item_result(batch_result, key)
+            else:
+                result = {'failed': True, 'changed': False, 'msg': 'Not handled, batch failed on %s' % failed_object}
+            if index == 0:
+                result.update(shared)
+            results.append(result)
+        return results
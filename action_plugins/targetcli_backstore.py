@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+import sys
+
+
+def load_loop():
+    '''
+    Action plugins of a role can't import each other, shared part is loaded from the file next to this one.
+    '''
+    name = 'ansible_targetcli_loop'
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '_targetcli_loop.py')
+        try:
+            from importlib.machinery import SourceFileLoader
+            from importlib.util import module_from_spec, spec_from_loader
+            spec = spec_from_loader(name, SourceFileLoader(name, path))
+            module = module_from_spec(spec)
+            sys.modules[name] = module
+            spec.loader.exec_module(module)
+        except ImportError:
+            from imp import load_source
+            load_source(name, path)
+    return sys.modules[name]
+
+
+_loop = load_loop()
+
+
+class ActionModule(_loop.LoopBatchAction):
+    '''
+    targetcli_backstore with loop runs as one targetcli_backstore task with 'backstores' list.
+    '''
+
+    BATCH_OPTION = 'backstores'
+    OBJECT_OPTIONS = ('backstore_type', 'backstore_name', 'options', 'attributes')
+
+    def object_key(self, obj):
+        return '%(backstore_type)s/%(backstore_name)s' % obj
+
+    def item_result(self, batch_result, key):
+        result = super(ActionModule, self).item_result(batch_result, key)
+        # diff of corrected attributes, see reconcile_attributes()
+        header = '/backstores/%s attributes' % key
+        for diff in batch_result.get('diff') or []:
+            if diff.get('before_header') == header:
+                result['diff'] = diff
+        for item in batch_result.get('provisioned') or []:
+            if item['backstore'] == key:
+                result['provisioned'] = item
+        return result
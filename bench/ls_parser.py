@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+'''
+Throughput of module_utils/targetcli_ls.py on generated 'targetcli ls /' output.
+
+usage: bench/ls_parser.py [objects ...]   (default 1000 10000 50000)
+
+Every target gets 16 LUNs, 8 ACLs with all LUNs mapped and 2 portals, the
+listing is generated in the format of targetcli (with '| ' tree drawing) and
+parsed back, results are checked against what was generated.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+
+import ansible.module_utils
+ansible.module_utils.__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module_utils'))
+from ansible.module_utils.targetcli_ls import parse_ls  # noqa: E402
+
+LUNS_PER_TARGET = 16
+ACLS_PER_TARGET = 8
+
+
+def line(depth, name, description, last_flags):
+    prefix = ''.join('  ' if last else '| ' for last in last_flags[:depth])
+    text = '%so- %s ' % (prefix, name)
+    suffix = ' [%s]' % description
+    return text + '.' * max(1, 130 - len(text) - len(suffix)) + suffix
+
+
+def generate(objects):
+    '''
+    Return (ls output, number of targets) with about the requested number of objects.
+    '''
+    per_target = 1 + 2 * LUNS_PER_TARGET + ACLS_PER_TARGET * (1 + LUNS_PER_TARGET) + 2
+    targets = max(1, objects // per_target)
+    out = [line(0, '/', '...', [])]
+    out.append(line(1, 'backstores', '...', [False]))
+    out.append(line(2, 'block', 'Storage Objects: %d' % (targets * LUNS_PER_TARGET), [False, False]))
+    for t in range(targets):
+        for i in range(LUNS_PER_TARGET):
+            out.append(line(3, 'disk%d_%d' % (t, i), '/dev/vg/disk%d_%d (1.0GiB) write-thru activated' % (t, i),
+                            [False, False, True]))
+    out.append(line(1, 'iscsi', 'Targets: %d' % targets, [False]))
+    for t in range(targets):
+        wwn = 'iqn.2020-01.com.example:target%d' % t
+        last_t = t == targets - 1
+        flags = [False, False, last_t]
+        out.append(line(2, wwn, 'TPGs: 1', flags))
+        out.append(line(3, 'tpg1', 'no-gen-acls, no-auth', flags + [True]))
+        out.append(line(4, 'acls', 'ACLs: %d' % ACLS_PER_TARGET, flags + [True, False]))
+        for a in range(ACLS_PER_TARGET):
+            out.append(line(5, 'iqn.2020-01.com.example:client%d' % a, 'Mapped LUNs: %d' % LUNS_PER_TARGET,
+                            flags + [True, False, a == ACLS_PER_TARGET - 1]))
+            for i in range(LUNS_PER_TARGET):
+                out.append(line(6, 'mapped_lun%d' % i, 'lun%d block/disk%d_%d (rw)' % (i, t, i),
+                                flags + [True, False, a == ACLS_PER_TARGET - 1, True]))
+        out.append(line(4, 'luns', 'LUNs: %d' % LUNS_PER_TARGET, flags + [True, False]))
+        for i in range(LUNS_PER_TARGET):
+            out.append(line(5, 'lun%d' % i, 'block/disk%d_%d (/dev/vg/disk%d_%d) (default_tg_pt_gp)' % (t, i, t, i),
+                            flags + [True, False, True]))
+        out.append(line(4, 'portals', 'Portals: 2', flags + [True, True]))
+        for p in range(2):
+            out.append(line(5, '10.0.%d.%d:3260' % (t // 250, p), 'OK', flags + [True, True, True]))
+    out.append(line(1, 'loopback', 'Targets: 0', [True]))
+    return '\n'.join(out) + '\n', targets
+
+
+def check(tree, targets):
+    assert len(tree.backstores) == targets * LUNS_PER_TARGET
+    for t in range(targets):
+        tpg_path = '/iscsi/iqn.2020-01.com.example:target%d/tpg1' % t
+        assert len(tree.luns(tpg_path)) == LUNS_PER_TARGET
+        assert len(tree.acls(tpg_path)) == ACLS_PER_TARGET
+        assert len(tree.portals(tpg_path)) == 2
+        assert tree.lun_id(tpg_path, 'block/disk%d_%d' % (t, LUNS_PER_TARGET - 1)) == LUNS_PER_TARGET - 1
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    print('%10s %10s %10s %12s %14s %14s' % ('objects', 'lines', 'MiB', 'parse [s]', 'lines/s', 'lookups/s'))
+    for objects in sizes:
+        output, targets = generate(objects)
+        lines = output.count('\n')
+        start = time.time()
+        tree = parse_ls(output)
+        parse_time = time.time() - start
+        check(tree, targets)
+        lookups = 0
+        start = time.time()
+        for t in range(targets):
+            tpg_path = '/iscsi/iqn.2020-01.com.example:target%d/tpg1' % t
+            for i in range(LUNS_PER_TARGET):
+                tree.lun_id(tpg_path, 'block/disk%d_%d' % (t, i))
+                lookups += 1
+        lookup_time = max(time.time() - start, 1e-9)
+        print('%10d %10d %10.1f %12.3f %14.0f %14.0f' % (
+            objects, lines, len(output) / 1048576.0, parse_time, lines / max(parse_time, 1e-9), lookups / lookup_time))
+
+
+if __name__ == '__main__':
+    main()
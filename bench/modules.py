@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+'''
+Scaling benchmark of the modules against the fake targetcli in bench/targetcli.
+
+usage: bench/modules.py [--sizes 10,100,1000,10000] [--kinds backstores,luns,acls,portals]
+                        [--single-limit 1000] [--latency SECONDS] [--save-cost SECONDS] [--configfs] [--agent]
+
+For every kind of object and size the configuration is prepared directly in
+the fake targetcli state, then the module's main() is run in a forked process
+once per object (single, like a task with loop) and once for all objects
+(batch), each first against the empty configuration (apply) and then again
+against the applied one (converged). Reported are number of targetcli
+processes, commands and saves done by them, wall time and peak RSS of the
+module process and of the targetcli processes.
+
+--configfs lets the fake targetcli materialize its configuration as configfs
+tree and points the modules at it, --latency and --save-cost are passed to
+the fake targetcli as start up and per 1000 objects save cost. With --agent
+every measurement runs with targetcli agent (targetcli_agent module) started
+before it and stopped after it, targetcli process of the agent is counted.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+import ansible.module_utils  # noqa: E402
+ansible.module_utils.__path__.append(os.path.join(ROOT_DIR, 'module_utils'))
+from ansible.module_utils import basic  # noqa: E402
+from ansible.module_utils._text import to_bytes  # noqa: E402
+
+WWN = 'iqn.2020-01.com.example:bench'
+
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+
+    def load_source(name, path):
+        spec = spec_from_loader(name, SourceFileLoader(name, path))
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+except ImportError:
+    from imp import load_source
+
+stub = load_source('fake_targetcli', os.path.join(BENCH_DIR, 'targetcli'))
+
+
+def backstore(i):
+    return {'backstore_type': 'block', 'backstore_name': 'disk%d' % i, 'options': '/dev/vg/disk%d' % i}
+
+
+def initiator(i):
+    return 'iqn.2020-01.com.example:client%d' % i
+
+
+def portal_ip(i):
+    return '10.%d.%d.%d' % (i // 65536, (i // 256) % 256, i % 256)
+
+
+def saveconfig(backstores=0, target=False):
+    '''
+    Fake targetcli configuration with backstores disk0..N and empty target.
+    '''
+    config = {'fabric_modules': [], 'targets': [], 'storage_objects': [
+        {'plugin': 'block', 'name': 'disk%d' % i, 'dev': '/dev/vg/disk%d' % i, 'attributes': {}} for i in range(backstores)]}
+    if target:
+        config['targets'].append({'wwn': WWN, 'fabric': 'iscsi', 'tpgs': [
+            {'tag': 1, 'enable': True, 'attributes': {}, 'luns': [], 'node_acls': [], 'portals': []}]})
+    return config
+
+
+# kind -> (setup configuration, single tasks, batch task)
+SCENARIOS = {
+    'backstores': (
+        lambda n: saveconfig(),
+        lambda n: [('targetcli_backstore', backstore(i)) for i in range(n)],
+        lambda n: ('targetcli_config', {'backstores': [backstore(i) for i in range(n)]}),
+    ),
+    'luns': (
+        lambda n: saveconfig(n, target=True),
+        lambda n: [('targetcli_iscsi_lun', {'wwn': WWN, 'backstore_type': 'block', 'backstore_name': 'disk%d' % i})
+                   for i in range(n)],
+        lambda n: ('targetcli_iscsi_lun', {'wwn': WWN, 'backstores': [
+            {'backstore_type': 'block', 'backstore_name': 'disk%d' % i} for i in range(n)]}),
+    ),
+    'acls': (
+        lambda n: saveconfig(target=True),
+        lambda n: [('targetcli_iscsi_acl', {'wwn': WWN, 'initiator_wwn': initiator(i)}) for i in range(n)],
+        lambda n: ('targetcli_iscsi_acl', {'wwn': WWN, 'initiators': [{'initiator_wwn': initiator(i)} for i in range(n)]}),
+    ),
+    'portals': (
+        lambda n: saveconfig(target=True),
+        lambda n: [('targetcli_iscsi_portal', {'wwn': WWN, 'portal_ip': portal_ip(i)}) for i in range(n)],
+        lambda n: ('targetcli_config', {'targets': [{'wwn': WWN, 'portals': [{'portal_ip': portal_ip(i)} for i in range(n)]}]}),
+    ),
+}
+
+
+def repoint(func, old, new):
+    '''
+    Replace default argument value old with new (module_utils paths are defaults of the functions).
+    '''
+    if func.__defaults__:
+        func.__defaults__ = tuple(new if d == old else d for d in func.__defaults__)
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='targetcli-bench-')
+        self.state = os.path.join(self.tmp, 'state.json')
+        self.savefile = os.path.join(self.tmp, 'saveconfig.json')
+        self.log = os.path.join(self.tmp, 'spawn.log')
+        self.configfs = os.path.join(self.tmp, 'configfs') if args.configfs else os.path.join(self.tmp, 'no-configfs')
+        self.modules = {}
+        os.environ.update({
+            'PATH': BENCH_DIR + os.pathsep + os.environ.get('PATH', ''),
+            'FAKE_TARGETCLI_STATE': self.state,
+            'FAKE_TARGETCLI_SAVEFILE': self.savefile,
+            'FAKE_TARGETCLI_LOG': self.log,
+            'FAKE_TARGETCLI_LATENCY': str(args.latency),
+            'FAKE_TARGETCLI_SAVE_COST': str(args.save_cost),
+        })
+        if args.configfs:
+            os.environ['FAKE_TARGETCLI_CONFIGFS'] = self.configfs
+        if args.agent:
+            os.environ['FAKE_TARGETCLI_SYNC'] = '1'
+        self.isolate()
+
+    def isolate(self):
+        '''
+        Point the host paths used by module_utils (configfs, /run, /etc/target) into the temporary directory.
+        '''
+        from ansible.module_utils import (targetcli_agent, targetcli_configfs, targetcli_rtslib, targetcli_runtime,
+                                          targetcli_session)
+        runtime = os.path.join(self.tmp, 'run')
+        marker = os.path.join(runtime, 'unsaved')
+        self.agent_socket = os.path.join(runtime, 'agent.sock')
+        for func in (targetcli_agent.AgentClient.connect.__func__, targetcli_agent.agent_info,
+                     targetcli_agent.AgentServer.__init__, targetcli_session.AgentSession.__init__):
+            repoint(func, targetcli_agent.AGENT_SOCKET, self.agent_socket)
+        targetcli_session.AGENT_SOCKET = self.agent_socket
+        self.module('targetcli_agent').AGENT_SOCKET = self.agent_socket
+        repoint(targetcli_configfs.ConfigFS.__init__, targetcli_configfs.CONFIGFS_ROOT, self.configfs)
+        for func in (targetcli_runtime.has_unsaved, targetcli_runtime.mark_unsaved, targetcli_runtime.clear_unsaved,
+                     targetcli_session.TargetCLISession.__init__, targetcli_rtslib.RTSLibSession.__init__):
+            repoint(func, targetcli_runtime.UNSAVED_MARKER, marker)
+        repoint(targetcli_runtime.StateCache.__init__, targetcli_runtime.STATE_CACHE, os.path.join(runtime, 'state.json'))
+        repoint(targetcli_runtime.StateCache.__init__, targetcli_runtime.SAVECONFIG, self.savefile)
+        repoint(targetcli_runtime.HostLock.__init__, targetcli_runtime.HOST_LOCK, os.path.join(runtime, 'lock'))
+        repoint(targetcli_runtime.HostLock.__init__, targetcli_runtime.LOCK_QUEUE, os.path.join(runtime, 'queue'))
+
+    def module(self, name):
+        if name not in self.modules:
+            self.modules[name] = load_source('bench_' + name, os.path.join(ROOT_DIR, 'library', name + '.py'))
+        return self.modules[name]
+
+    def run_module(self, name, params):
+        # agent is used only by engine auto
+        params = dict(params, engine='targetcli' if not self.args.agent or name == 'targetcli_agent' else 'auto',
+                      _ansible_check_mode=False)
+        basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': params}))
+        basic._ANSIBLE_PROFILE = 'legacy'
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        try:
+            self.module(name).main()
+        except SystemExit:
+            pass
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+        result = json.loads(output)
+        if result.get('failed'):
+            raise RuntimeError('%s failed: %s' % (name, result.get('msg')))
+        return result
+
+    def setup(self, config):
+        for path in (self.state, self.savefile):
+            with open(path, 'w') as f:
+                json.dump(config, f)
+        shutil.rmtree(os.path.join(self.tmp, 'run'), ignore_errors=True)
+        if self.args.configfs:
+            stub.write_configfs(config, self.configfs)
+
+    def stop_agent(self):
+        '''
+        Stop the agent and wait for it (and its targetcli process) to exit.
+        '''
+        from ansible.module_utils.targetcli_agent import agent_info
+        pid = (agent_info() or {}).get('pid')
+        self.run_module('targetcli_agent', {'state': 'stopped'})
+        deadline = time.time() + 10
+        while pid and time.time() < deadline:
+            try:
+                # agent is not our child, it stays zombie until init reaps it
+                with open('/proc/%d/stat' % pid) as f:
+                    if f.read().split(')')[-1].split()[0] == 'Z':
+                        break
+            except IOError:
+                break
+            time.sleep(0.01)
+
+    def measure(self, tasks):
+        '''
+        Run the tasks in forked process, return measurements.
+        '''
+        if os.path.exists(self.log):
+            os.unlink(self.log)
+        if self.args.agent:
+            tasks = [('targetcli_agent', {'idle_timeout': 60})] + tasks
+        read_fd, write_fd = os.pipe()
+        start = time.time()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = {'error': None}
+            try:
+                for name, params in tasks:
+                    self.run_module(name, params)
+                if self.args.agent:
+                    self.stop_agent()
+            except Exception as e:
+                status['error'] = str(e)
+            status['mod_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            status['cli_rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            os.write(write_fd, to_bytes(json.dumps(status)))
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            status = json.loads(f.read().decode('utf-8'))
+        os.waitpid(pid, 0)
+        wall = time.time() - start
+        spawns = commands = saves = 0
+        if os.path.exists(self.log):
+            with open(self.log) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    spawns += 1
+                    commands += entry['commands']
+                    saves += entry['saves']
+        if self.args.agent:
+            tasks = tasks[1:]
+        status.update({'tasks': len(tasks), 'spawns': spawns, 'commands': commands, 'saves': saves, 'wall': wall})
+        return status
+
+    def run(self):
+        print('%-10s %-6s %6s %-9s %6s %7s %9s %6s %9s %8s %8s' % (
+            'kind', 'mode', 'size', 'run', 'tasks', 'spawns', 'commands', 'saves', 'wall [s]', 'mod MiB', 'cli MiB'))
+        for kind in self.args.kinds:
+            setup, single, batch = SCENARIOS[kind]
+            for size in self.args.sizes:
+                for mode in ('single', 'batch'):
+                    if mode == 'single' and size > self.args.single_limit:
+                        print('%-10s %-6s %6d %-9s skipped (--single-limit %d)' % (kind, mode, size, '', self.args.single_limit))
+                        continue
+                    tasks = single(size) if mode == 'single' else [batch(size)]
+                    self.setup(setup(size))
+                    for run in ('apply', 'converged'):
+                        m = self.measure(tasks)
+                        print('%-10s %-6s %6d %-9s %6d %7d %9d %6d %9.2f %8.1f %8.1f%s' % (
+                            kind, mode, size, run, m['tasks'], m['spawns'], m['commands'], m['saves'], m['wall'],
+                            m['mod_rss'] / 1024.0, m['cli_rss'] / 1024.0, '  ERROR: ' + m['error'] if m['error'] else ''))
+                        sys.stdout.flush()
+
+    def cleanup(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark of targetcli modules against fake targetcli')
+    parser.add_argument('--sizes', default='10,100,1000,10000', type=lambda v: [int(x) for x in v.split(',')])
+    parser.add_argument('--kinds', default=','.join(sorted(SCENARIOS)), type=lambda v: v.split(','))
+    parser.add_argument('--single-limit', default=1000, type=int,
+                        help='skip one task per object runs above this size (every task starts targetcli)')
+    parser.add_argument('--latency', default=0.0, type=float, help='fake targetcli start up latency in seconds')
+    parser.add_argument('--save-cost', default=0.0, type=float, help='fake targetcli save cost in seconds per 1000 objects')
+    parser.add_argument('--configfs', action='store_true', help='let the modules read fake configfs')
+    parser.add_argument('--agent', action='store_true', help='run the modules with targetcli agent')
+    args = parser.parse_args()
+    bench = Bench(args)
+    try:
+        bench.run()
+    finally:
+        bench.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+'''
+Record/replay fixtures of the modules (module_utils/targetcli_replay.py) at scale.
+
+usage: bench/replay.py record [--dir DIR] [--sizes 10,100,1000,10000] [--kinds backstores,luns,acls,portals]
+                              [--single-limit 100] [--gzip]
+       bench/replay.py replay [--dir DIR] [--repeat N]
+
+record runs the scenarios of bench/modules.py against the fake targetcli with
+ANSIBLE_TARGETCLI_RECORD set. Every scenario (kind, size, single or batch)
+gets fixture <kind>-<size>-<mode>.jsonl with the targetcli commands and
+replies of its module runs (apply, then converged) and <kind>-<size>-<mode>.tasks.json
+with the module parameters and the results they returned, --gzip compresses
+both files.
+
+replay runs the tasks of every fixture in DIR with ANSIBLE_TARGETCLI_REPLAY
+set and without any targetcli (fake or real) on PATH, checks that every
+result equals the recorded one and reports module runs and targetcli
+commands per second. Default DIR is bench/fixtures.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+
+    def load_source(name, path):
+        spec = spec_from_loader(name, SourceFileLoader(name, path))
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+except ImportError:
+    from imp import load_source
+
+bench_modules = load_source('bench_modules', os.path.join(BENCH_DIR, 'modules.py'))
+from ansible.module_utils.targetcli_replay import RECORD_ENV, REPLAY_ENV, load_runs  # noqa: E402
+
+# keys that differ between runs of the same module with the same configuration
+VOLATILE = ('invocation', 'perf')
+
+
+def open_fixture(path, mode):
+    return (gzip.open if path.endswith('.gz') else open)(path, mode)
+
+
+def normalized(result):
+    return dict((k, v) for k, v in result.items() if k not in VOLATILE)
+
+
+def bench_args(args):
+    return argparse.Namespace(latency=0.0, save_cost=0.0, configfs=False, agent=False,
+                              single_limit=getattr(args, 'single_limit', 0))
+
+
+def record(args):
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    bench = bench_modules.Bench(bench_args(args))
+    try:
+        for kind in args.kinds:
+            setup, single, batch = bench_modules.SCENARIOS[kind]
+            for size in args.sizes:
+                for mode in ('single', 'batch'):
+                    if mode == 'single' and size > args.single_limit:
+                        continue
+                    name = '%s-%d-%s' % (kind, size, mode)
+                    fixture = os.path.join(args.dir, name + '.jsonl')
+                    for path in (fixture, fixture + '.gz', fixture[:-len('.jsonl')] + '.tasks.json',
+                                 fixture[:-len('.jsonl')] + '.tasks.json.gz'):
+                        if os.path.exists(path):
+                            os.unlink(path)
+                    bench.setup(setup(size))
+                    os.environ[RECORD_ENV] = fixture
+                    tasks = []
+                    start = time.time()
+                    for run in ('apply', 'converged'):
+                        for module, params in (single(size) if mode == 'single' else [batch(size)]):
+                            result = bench.run_module(module, params)
+                            tasks.append({'run': run, 'module': module, 'params': params, 'result': normalized(result)})
+                    del os.environ[RECORD_ENV]
+                    if args.gzip:
+                        with open(fixture, 'rb') as src, gzip.open(fixture + '.gz', 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                        os.unlink(fixture)
+                        fixture += '.gz'
+                    tasks_file = os.path.join(args.dir, name + '.tasks.json' + ('.gz' if args.gzip else ''))
+                    with open_fixture(tasks_file, 'wb') as f:
+                        f.write(json.dumps({'fixture': os.path.basename(fixture), 'tasks': tasks}, sort_keys=True).encode('utf-8'))
+                    print('%-30s %6d runs %8.2f s %10d bytes' % (os.path.basename(fixture), len(tasks), time.time() - start,
+                                                                 os.path.getsize(fixture)))
+                    sys.stdout.flush()
+    finally:
+        bench.cleanup()
+
+
+def replay(args):
+    names = sorted(f for f in os.listdir(args.dir) if f.endswith(('.tasks.json', '.tasks.json.gz')))
+    if not names:
+        sys.exit('No fixtures in %s, create them with: %s record' % (args.dir, sys.argv[0]))
+    bench = bench_modules.Bench(bench_args(args))
+    # nothing may reach targetcli, fake or real
+    os.environ['PATH'] = os.pathsep.join(p for p in os.environ['PATH'].split(os.pathsep)
+                                         if p != BENCH_DIR and not os.path.exists(os.path.join(p, 'targetcli')))
+    failures = 0
+    print('%-30s %6s %9s %9s %9s %11s  %s' % ('fixture', 'runs', 'commands', 'wall [s]', 'runs/s', 'commands/s', 'result'))
+    try:
+        for name in names:
+            with open_fixture(os.path.join(args.dir, name), 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            fixture = os.path.join(args.dir, data['fixture'])
+            commands = sum(len(run['commands']) for run in load_runs(fixture)) * args.repeat
+            os.environ[REPLAY_ENV] = fixture
+            mismatches = []
+            start = time.time()
+            for dummy in range(args.repeat):
+                for path in (fixture + '.pos', fixture + '.unsaved'):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                for number, task in enumerate(data['tasks']):
+                    try:
+                        result = normalized(bench.run_module(task['module'], task['params']))
+                    except RuntimeError as e:
+                        result = {'error': str(e)}
+                    if result != task['result']:
+                        mismatches.append((number, task['run'], task['module'], result))
+            wall = time.time() - start
+            runs = len(data['tasks']) * args.repeat
+            status = 'OK'
+            if mismatches:
+                failures += 1
+                number, run, module, result = mismatches[0]
+                status = 'FAILED %d runs, first: task %d (%s %s) %s' % (len(mismatches), number, run, module,
+                                                                        json.dumps(result, sort_keys=True)[:200])
+            print('%-30s %6d %9d %9.2f %9.0f %11.0f  %s' % (data['fixture'], runs, commands, wall, runs / max(wall, 1e-6),
+                                                            commands / max(wall, 1e-6), status))
+            sys.stdout.flush()
+            for path in (fixture + '.pos', fixture + '.unsaved'):
+                if os.path.exists(path):
+                    os.unlink(path)
+    finally:
+        bench.cleanup()
+    if failures:
+        sys.exit('%d of %d fixtures did not replay to the recorded results' % (failures, len(names)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record/replay fixtures of targetcli modules')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    p = subparsers.add_parser('record', help='record fixtures running the modules against fake targetcli')
+    p.add_argument('--dir', default=FIXTURES_DIR)
+    p.add_argument('--sizes', default='10,100,1000,10000', type=lambda v: [int(x) for x in v.split(',')])
+    p.add_argument('--kinds', default=','.join(sorted(bench_modules.SCENARIOS)), type=lambda v: v.split(','))
+    p.add_argument('--single-limit', default=100, type=int, help='record one task per object runs only up to this size')
+    p.add_argument('--gzip', action='store_true', help='compress the fixtures')
+    p.set_defaults(func=record)
+    p = subparsers.add_parser('replay', help='replay the fixtures without targetcli and compare the results')
+    p.add_argument('--dir', default=FIXTURES_DIR)
+    p.add_argument('--repeat', default=1, type=int, help='replay every fixture this many times')
+    p.set_defaults(func=replay)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
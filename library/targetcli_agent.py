@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: targetcli_agent
+short_description: TargetCLI agent module
+description:
+     - module for starting and stopping the targetcli agent, background process that keeps rtslib object tree
+       (or one targetcli process) loaded and executes commands of the other targetcli modules sent over
+       Unix socket /run/ansible-targetcli/agent.sock.
+     - while the agent is running, modules with 'engine: auto' send their commands to it instead of starting
+       targetcli or loading rtslib, requests of the modules are served one module run at a time.
+     - agent exits on its own when no module used it for I(idle_timeout) seconds.
+version_added: "2.0"
+options:
+  state:
+    description:
+      - Should the agent be running (started) or not (stopped)
+    required: false
+    default: started
+    choices: [started, stopped]
+    type: str
+  idle_timeout:
+    description:
+      - Seconds without any module using the agent after which the agent exits
+    required: false
+    default: 600
+    type: int
+  engine:
+    description:
+      - Engine used by the agent, targetcli keeps one targetcli process running,
+        rtslib uses rtslib-fb library directly in the agent process, auto uses rtslib when it is
+        installed and configfs is available and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+notes:
+   - Tested on CentOS 7.7
+   - Running agent isn't restarted when I(idle_timeout) or I(engine) differ, stop it first.
+requirements: [ ]
+author: "Ondrej Famera (@OndrejHome)"
+'''
+
+EXAMPLES = '''
+- name: keep targetcli loaded for the following tasks
+  targetcli_agent:
+    idle_timeout: 120
+
+- name: define many backstores, each task is served by the agent
+  targetcli_backstore:
+    backstore_type: 'block'
+    backstore_name: "{{ item.name }}"
+    options: "{{ item.dev }}"
+  loop: "{{ luns }}"
+
+- name: stop the agent
+  targetcli_agent:
+    state: stopped
+'''
+
+RETURN = '''
+pid:
+    description: process ID of the running agent
+    returned: when the agent is running
+    type: int
+    sample: 12345
+engine:
+    description: engine used by the running agent
+    returned: when the agent is running
+    type: str
+    sample: rtslib
+'''
+
+import os
+import time
+
+
+def daemonize():
+    '''
+    Fork detached process, returns True in it and False in the original process once the child is gone.
+    '''
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return False
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    os.chdir('/')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    return True
+
+
+def start_agent(module, engine, idle_timeout):
+    configfs = ConfigFS()
+    if engine == 'rtslib' and not HAS_RTSLIB:
+        module.fail_json(msg=missing_required_lib('rtslib-fb'), exception=RTSLIB_IMP_ERR)
+    if engine == 'rtslib' or (engine == 'auto' and HAS_RTSLIB and configfs.available()):
+        engine, session = 'rtslib', RTSLibSession(module, configfs=configfs, save_mode='never')
+    else:
+        engine, session = 'targetcli', TargetCLISession(module, configfs=configfs, save_mode='never')
+    server = AgentServer(session, engine, idle_timeout=idle_timeout)
+    # bind before forking so that a failure is reported by the module
+    sock = server.listen()
+    if daemonize():
+        try:
+            server.serve(sock)
+        finally:
+            os._exit(0)
+    sock.close()
+    for attempt in range(50):
+        info = agent_info()
+        if info is not None:
+            return info
+        time.sleep(0.1)
+    module.fail_json(msg="Started targetcli agent doesn't respond on %s" % AGENT_SOCKET)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            state=dict(default='started', choices=['started', 'stopped']),
+            idle_timeout=dict(type='int', default=AGENT_IDLE_TIMEOUT),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+        ),
+        supports_check_mode=True
+    )
+
+    result = {'changed': False}
+    info = agent_info()
+    try:
+        if module.params['state'] == 'started' and info is None:
+            result['changed'] = True
+            if not module.check_mode:
+                info = start_agent(module, module.params['engine'], module.params['idle_timeout'])
+        elif module.params['state'] == 'stopped' and info is not None:
+            result['changed'] = True
+            if not module.check_mode:
+                client = AgentClient.connect()
+                if client is not None:
+                    client.shutdown()
+                    client.close()
+                info = None
+        elif module.params['state'] == 'stopped' and os.path.exists(AGENT_SOCKET) and not module.check_mode:
+            # socket left behind by agent that didn't exit cleanly
+            os.unlink(AGENT_SOCKET)
+    except (AgentError, IOError, OSError) as e:
+        module.fail_json(msg="Failed to change state of targetcli agent - %s" % (e))
+    if info is not None:
+        result.update(pid=info['pid'], engine=info['engine'])
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from ansible.module_utils.targetcli_agent import AGENT_IDLE_TIMEOUT, AGENT_SOCKET, AgentClient, AgentError, AgentServer, agent_info
+from ansible.module_utils.targetcli_configfs import ConfigFS
+from ansible.module_utils.targetcli_rtslib import HAS_RTSLIB, RTSLIB_IMP_ERR, RTSLibSession
+from ansible.module_utils.targetcli_session import TargetCLISession
+if __name__ == "__main__":
+    main()
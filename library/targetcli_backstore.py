@@ -23,13 +23,15 @@ options:
   backstore_type:
     description:
       - Type of storage in TargetCLI (block, fileio, pscsi, ramdisk)
-    required: true
+      - Required unless I(backstores) is used
+    required: false
     default: null
     type: str
   backstore_name:
     description:
       - Name of backtore object in TargetCLI
-    required: true
+      - Required unless I(backstores) is used
+    required: false
     default: null
     type: str
   options:
@@ -40,10 +42,31 @@ options:
     type: str
   attributes:
     description:
-      - Attributes for the defined LUN
+      - Attributes for the defined LUN ('key=value' separated by spaces)
+      - Attributes of existing backstore are compared with the live values (read from configfs or with one
+        'get attribute') and only the differing ones are set, in one command, with diff in diff mode
     required: false
     default: null
     type: str
+  backstores:
+    description:
+      - List of backstore objects (backstore_type, backstore_name, options and attributes) to handle in one task,
+        all changes are done in one targetcli session
+      - I(state) applies to all of them
+      - The action plugin of this module turns a task with loop into one task with this list
+    required: false
+    default: null
+    type: list
+  fileio_workers:
+    description:
+      - Number of threads creating image files of new fileio backstores in parallel
+      - Before any backstore is created, missing image files of fileio backstores with absolute path and size
+        in I(options) are created (sized, or fully allocated with 'sparse=false') by this many threads,
+        the backstores are then registered with the existing files in one targetcli session
+      - Each finished file is logged on the managed host, path, size and duration are returned in I(provisioned)
+    required: false
+    default: 4
+    type: int
   state:
     description:
       - Should the object be present or absent from TargetCLI configuration
@@ -51,8 +74,60 @@ options:
     default: present
     choices: [present, absent]
     type: str
+  transactional:
+    description:
+      - When a command fails, put the objects already changed by the task back to how they were before
+        the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+      - Image files created by the task for new fileio backstores are removed when the rollback succeeds
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
 notes:
    - Tested on CentOS 7.7
+   - When creating any image file fails, the files created by the task are removed and no backstore is created.
 requirements: [ ]
 author: "Ondrej Famera (@OndrejHome)"
 '''
@@ -71,6 +146,36 @@ EXAMPLES = '''
     options: '/dev/c7vg/LV2'
     attributes: 'emulate_tpu=1'
 
+- name: correct drifted attributes of existing backstore
+  targetcli_backstore:
+    backstore_type: 'block'
+    backstore_name: 'test2'
+    options: '/dev/c7vg/LV2'
+    attributes: 'emulate_tpu=1 emulate_3pc=0'
+
+- name: define many block backstores at once
+  targetcli_backstore:
+    backstores:
+      - backstore_type: 'block'
+        backstore_name: 'test3'
+        options: '/dev/c7vg/LV3'
+      - backstore_type: 'block'
+        backstore_name: 'test4'
+        options: '/dev/c7vg/LV4'
+
+- name: define fileio backstores with preallocated image files, created by 8 threads
+  targetcli_backstore:
+    backstores: "{{ images }}"
+    fileio_workers: 8
+  vars:
+    images:
+      - backstore_type: 'fileio'
+        backstore_name: 'img1'
+        options: '/srv/iscsi/img1.img 20G sparse=false'
+      - backstore_type: 'fileio'
+        backstore_name: 'img2'
+        options: '/srv/iscsi/img2.img 20G sparse=false'
+
 - name: remove block backstore from disk/LV /dev/c7vg/LV2
   targetcli_backstore:
     backstore_type: 'block'
@@ -78,68 +183,206 @@ EXAMPLES = '''
     state: 'absent'
 '''
 
-from distutils.spawn import find_executable
+RETURN = '''
+changed_objects:
+    description: backstores ('type/name') that were (or in check mode would be) changed
+    returned: with I(backstores)
+    type: list
+    sample: ["block/test3"]
+failed_object:
+    description: backstore ('type/name') whose command failed, objects before it in the list were handled already
+    returned: with I(backstores) when a command failed
+    type: str
+    sample: "block/test4"
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "backstore", "path": "/backstores/block/test3", "name": "block/test3",
+              "command": "/backstores/block delete test3", "rc": 0}]
+provisioned:
+    description: image files of fileio backstores created by the task with size in bytes and seconds it took
+    returned: when some image file was created
+    type: list
+    sample: [{"backstore": "fileio/img1", "path": "/srv/iscsi/img1.img", "size": 21474836480, "sparse": false,
+              "duration": 0.021433, "error": null}]
+'''
+
+import os
+
+
+def apply_backstore(session, module, backstore, state, exists=None):
+    '''
+    Create, delete or correct attributes of one backstore, returns (changed, diff, failure)
+    where diff is None unless attributes were changed and failure is None or fail_json() arguments.
+    '''
+    path = "/backstores/%(backstore_type)s/%(backstore_name)s" % backstore
+    if exists is None:
+        exists = session.exists(path)
+    if exists and state == 'absent':
+        if not module.check_mode:
+            cmd = "/backstores/%(backstore_type)s delete %(backstore_name)s" % backstore
+            rc, out, err = session.run(cmd)
+            if rc != 0:
+                return False, None, dict(msg="Failed to delete backstores object using command " + cmd, output=out, error=err)
+        return True, None, None
+    elif not exists and state == 'present':
+        if not module.check_mode:
+            cmd = "/backstores/%(backstore_type)s create %(backstore_name)s %(options)s" % backstore
+            rc, out, err = session.run(cmd)
+            if rc != 0:
+                return False, None, dict(msg="Failed to define backstores object using command " + cmd, output=out, error=err)
+            if backstore['attributes']:
+                cmd = "%s set attribute %s" % (path, backstore['attributes'])
+                rc, out, err = session.run(cmd)
+                if rc != 0:
+                    return True, None, dict(msg="Failed to set LUN's attributes using cmd " + cmd, output=out, error=err)
+        return True, None, None
+    elif exists and state == 'present' and backstore['attributes']:
+        try:
+            diff, (rc, out, err) = reconcile_attributes(session, path, backstore['attributes'], module.check_mode)
+        except TargetCLIStateError as e:
+            return False, None, dict(msg=str(e))
+        if rc != 0:
+            return False, None, dict(msg="Failed to set LUN's attributes of " + path, output=out, error=err)
+        return diff is not None, diff, None
+    return False, None, None
+
+
+def provision_files(session, module, backstores):
+    '''
+    Create missing image files of fileio backstores that will be created, in parallel.
+    Returns (existing backstore paths checked on the way, created files, failure).
+    '''
+    existing = {}
+    missing = []
+    for backstore in backstores:
+        if backstore['backstore_type'] == 'fileio':
+            path = "/backstores/%(backstore_type)s/%(backstore_name)s" % backstore
+            existing[path] = session.exists(path)
+            if not existing[path]:
+                missing.append(backstore)
+
+    def progress(item):
+        module.log('targetcli_backstore: %s %s (%d bytes) in %.3fs' % (
+            'failed to create' if item['error'] else 'created', item['path'], item['size'], item['duration']))
+
+    done = provision(fileio_specs(missing), module.params['fileio_workers'], progress)
+    if session.profiler is not None:
+        for item in done:
+            session.profiler.record('create file %s' % item['path'], 1 if item['error'] else 0, '', item['duration'], 'provision')
+    failed = [item for item in done if item['error']]
+    if failed:
+        return existing, done, dict(msg="Failed to create image file %(path)s of %(backstore)s - %(error)s" % failed[0])
+    return existing, done, None
+
+
+def rollback_backstores(session, before, names, provisioned):
+    '''
+    Revert backstores changed by the task, when that succeeded also remove image files the task created.
+    '''
+    steps = rollback(session, before, ['/backstores/' + name for name in names])
+    if rolled_back(steps):
+        for item in provisioned:
+            if item['error']:
+                continue
+            step = {'action': 'delete', 'object': 'file', 'path': item['path'], 'name': item['backstore'], 'command': None, 'rc': 0}
+            try:
+                os.unlink(item['path'])
+            except OSError as e:
+                step.update(rc=1, error=str(e))
+            steps.append(step)
+    return steps
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            backstore_type=dict(required=True),
-            backstore_name=dict(required=True),
+            backstore_type=dict(required=False),
+            backstore_name=dict(required=False),
             options=dict(required=False),
             attributes=dict(required=False),
+            backstores=dict(type='list', elements='dict', required=False, options=dict(
+                backstore_type=dict(required=True),
+                backstore_name=dict(required=True),
+                options=dict(required=False),
+                attributes=dict(required=False),
+            )),
+            fileio_workers=dict(type='int', default=PROVISION_WORKERS),
             state=dict(default="present", choices=['present', 'absent']),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
         ),
+        mutually_exclusive=[['backstores', 'backstore_type'], ['backstores', 'backstore_name']],
+        required_one_of=[['backstores', 'backstore_name']],
+        required_together=[['backstore_type', 'backstore_name']],
         supports_check_mode=True
     )
 
-    attributes = module.params['attributes']
-
     state = module.params['state']
-    if state == 'present' and not module.params['options']:
-        module.fail_json(msg="Missing options parameter needed for creating backstore object")
-
-    if find_executable('targetcli') is None:
-        module.fail_json(msg="'targetcli' executable not found. Install 'targetcli'.")
+    batch = module.params['backstores'] is not None
+    if batch:
+        backstores = module.params['backstores']
+    else:
+        backstores = [dict((key, module.params[key]) for key in ('backstore_type', 'backstore_name', 'options', 'attributes'))]
+    for backstore in backstores:
+        if state == 'present' and not backstore['options']:
+            module.fail_json(msg="Missing options parameter needed for creating backstore object",
+                             backstore="%(backstore_type)s/%(backstore_name)s" % backstore)
+        try:
+            parse_attributes(backstore['attributes'])
+        except TargetCLIStateError as e:
+            module.fail_json(msg=str(e), backstore="%(backstore_type)s/%(backstore_name)s" % backstore)
 
-    result = {}
+    result = {'changed': False}
+    diffs = []
+    if batch:
+        result['changed_objects'] = []
+    session = new_session(module)
 
     try:
-        rc, out, err = module.run_command("targetcli '/backstores/%(backstore_type)s/%(backstore_name)s status'" % module.params)
-        if rc == 0 and state == 'present':
-            result['changed'] = False
-        elif rc == 0 and state == 'absent':
-            result['changed'] = True
-            if module.check_mode:
-                module.exit_json(**result)
-            else:
-                cmd = "targetcli '/backstores/%(backstore_type)s delete %(backstore_name)s'" % module.params
-                rc, out, err = module.run_command(cmd)
-                if rc == 0:
-                    module.exit_json(**result)
-                else:
-                    module.fail_json(msg="Failed to delete backstores object using command " + cmd, output=out, error=err)
-        elif state == 'absent':
-            result['changed'] = False
-        else:
-            result['changed'] = True
-            if module.check_mode:
-                module.exit_json(**result)
-            else:
-                cmd = "targetcli '/backstores/%(backstore_type)s create %(backstore_name)s %(options)s'" % module.params
-                rc, out, err = module.run_command(cmd)
-                if rc == 0:
-                    if attributes:
-                        cmd = "targetcli '/backstores/%(backstore_type)s/%(backstore_name)s set attribute %(attributes)s'" % module.params
-                        rc, out, err = module.run_command(cmd)
-                        if rc == 0:
-                            module.exit_json(**result)
-                        else:
-                            module.fail_json(msg="Failed to set LUN's attributes using cmd " + cmd, output=out, error=err)
-                    else:
-                        module.exit_json(**result)
-                else:
-                    module.fail_json(msg="Failed to define backstores object using command " + cmd, output=out, error=err)
+        # what the changed backstores are reverted to when a command fails
+        before = None
+        if module.params['transactional'] and not module.check_mode:
+            before = snapshot(session, attributes=True)
+        existing = {}
+        done = []
+        if state == 'present' and not module.check_mode:
+            existing, done, failure = provision_files(session, module, backstores)
+            if done:
+                result['provisioned'] = done
+            if failure:
+                # no backstore was created, the created files are removed
+                failure.update(result)
+                session.close()
+                module.fail_json(**failure)
+        touched = []
+        for backstore in backstores:
+            name = "%(backstore_type)s/%(backstore_name)s" % backstore
+            changed, diff, failure = apply_backstore(session, module, backstore, state,
+                                                     existing.get("/backstores/" + name))
+            if diff is not None and module._diff:
+                diffs.append(diff)
+                result['diff'] = diffs if batch else diff
+            if changed:
+                result['changed'] = True
+                touched.append(name)
+                if batch:
+                    result['changed_objects'].append(name)
+            if failure:
+                if batch:
+                    failure.update(result, failed_object=name)
+                if before is not None:
+                    failure['rollback'] = rollback_backstores(session, before, touched + [name], done)
+                    failure['msg'] += ", changes were rolled back" if rolled_back(failure['rollback']) else ", rollback failed"
+                module.fail_json(**failure)
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
     except OSError as e:
         module.fail_json(msg="Failed to check backstore object - %s" % (e))
     module.exit_json(**result)
@@ -147,5 +390,9 @@ def main():
 
 # import module snippets
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_provision import PROVISION_WORKERS, fileio_specs, provision
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import (TargetCLIStateError, parse_attributes, reconcile_attributes, rollback, rolled_back,
+                                                  snapshot)
 if __name__ == "__main__":
     main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: targetcli_config
+short_description: TargetCLI declarative configuration module
+description:
+     - module for applying whole desired configuration of backstores and iSCSI targets in targetcli in one pass.
+     - current configuration is read once, only the missing objects are created and objects with state absent
+       (or unlisted objects with I(purge)) are deleted, all in one targetcli session.
+version_added: "2.0"
+options:
+  backstores:
+    description:
+      - List of backstore objects ('/backstores'), items take the same options as targetcli_backstore module
+        (backstore_type, backstore_name, options, attributes, state)
+      - attributes of backstores and targets are kept in sync also on existing objects, only the listed
+        attributes that differ from the live ones are set
+      - When omitted, backstores are not managed
+    required: false
+    default: null
+    type: list
+  targets:
+    description:
+      - List of iSCSI targets ('/iscsi'), items have wwn, attributes, state and lists of luns
+        (backstore_type, backstore_name, lun_index, state), acls (initiator_wwn, state) and portals
+        (portal_ip, portal_port, state)
+      - New LUNs are created with their lun_index, LUNs without it get the lowest indexes not used by any LUN
+        or mapped LUN of the target, so their mapped LUNs have the same number in every ACL, existing LUNs
+        are left at their index
+      - When luns, acls or portals list is omitted for a target, that part of the target is not managed
+      - New targets get only the portals listed, when portals are omitted targetcli's default
+        0.0.0.0:3260 portal is created
+    required: false
+    default: null
+    type: list
+  purge:
+    description:
+      - Remove objects that are not listed in backstores, targets and in the managed lists of the listed targets
+    required: false
+    default: false
+    type: bool
+  transactional:
+    description:
+      - When a command fails, put the objects already changed by the task back to how they were before
+        the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
+notes:
+   - Tested on CentOS 7.7
+   - Supports check mode and diff mode, list of planned changes is returned in both
+requirements: [ ]
+author: "Ondrej Famera (@OndrejHome)"
+'''
+
+EXAMPLES = '''
+- name: define backstores and iSCSI target with LUNs, ACL and portal
+  targetcli_config:
+    backstores:
+      - backstore_type: 'block'
+        backstore_name: 'test1'
+        options: '/dev/c7vg/LV1'
+      - backstore_type: 'block'
+        backstore_name: 'test2'
+        options: '/dev/c7vg/LV2'
+        attributes: 'emulate_tpu=1'
+    targets:
+      - wwn: 'iqn.1994-05.com.redhat:data'
+        luns:
+          - backstore_type: 'block'
+            backstore_name: 'test1'
+          - backstore_type: 'block'
+            backstore_name: 'test2'
+        acls:
+          - initiator_wwn: 'iqn.1994-05.com.redhat:client1'
+        portals:
+          - portal_ip: '192.168.1.10'
+
+- name: keep only listed objects in configuration
+  targetcli_config:
+    backstores:
+      - backstore_type: 'block'
+        backstore_name: 'test1'
+        options: '/dev/c7vg/LV1'
+    targets: []
+    purge: true
+'''
+
+RETURN = '''
+changes:
+    description: list of changes (to be) applied in order
+    returned: always
+    type: list
+    sample: [{"action": "create", "object": "backstore", "path": "/backstores/block/test1", "name": "block/test1",
+              "command": "/backstores/block create test1 /dev/c7vg/LV1"}]
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "backstore", "path": "/backstores/block/test1", "name": "block/test1",
+              "command": "/backstores/block delete test1", "rc": 0}]
+perf:
+    description: timing of the task, every command with its source (targetcli, rtslib, configfs, cache), rc,
+                 duration and stdout_bytes, number of started targetcli processes (spawns) and totals
+    returned: when profile is true
+    type: dict
+    sample: {"engine": "targetcli", "spawns": 1, "spawn_time": 0.41,
+             "commands": [{"cmd": "/iscsi/iqn.2020-01.com.example:t1/tpg1 status", "source": "configfs", "rc": 0,
+                           "duration": 0.0001, "stdout_bytes": 0}],
+             "totals": {"commands": 1, "nonzero_rc": 0, "duration": 0.0001, "stdout_bytes": 0, "wall": 0.52}}
+'''
+
+
+def main():
+    state_choice = dict(default="present", choices=['present', 'absent'])
+    module = AnsibleModule(
+        argument_spec=dict(
+            backstores=dict(type='list', elements='dict', required=False, options=dict(
+                backstore_type=dict(required=True),
+                backstore_name=dict(required=True),
+                options=dict(required=False),
+                attributes=dict(required=False),
+                state=state_choice,
+            )),
+            targets=dict(type='list', elements='dict', required=False, options=dict(
+                wwn=dict(required=True),
+                attributes=dict(required=False),
+                state=state_choice,
+                luns=dict(type='list', elements='dict', required=False, options=dict(
+                    backstore_type=dict(required=True),
+                    backstore_name=dict(required=True),
+                    lun_index=dict(type='int', required=False),
+                    state=state_choice,
+                )),
+                acls=dict(type='list', elements='dict', required=False, options=dict(
+                    initiator_wwn=dict(required=True),
+                    state=state_choice,
+                )),
+                portals=dict(type='list', elements='dict', required=False, options=dict(
+                    portal_ip=dict(required=True),
+                    portal_port=dict(type='int', default=3260, required=False),
+                    state=state_choice,
+                )),
+            )),
+            purge=dict(type='bool', default=False),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
+        ),
+        supports_check_mode=True
+    )
+
+    result = {'changed': False}
+    # portals of new targets are created explicitly by the plan
+    session = new_session(module, prefs={'auto_add_default_portal': 'false'})
+
+    try:
+        # attributes of existing objects are compared with the desired ones
+        current = snapshot(session, attributes=True)
+        desired = desired_from_options(module.params['backstores'], module.params['targets'])
+        changes = plan(current, desired, module.params['purge'])
+        result['changed'] = bool(changes)
+        result['changes'] = changes
+        if module._diff:
+            result['diff'] = diff(changes)
+        if changes and not module.check_mode:
+            failed = apply(session, changes)
+            if failed is not None:
+                change, out, err = failed
+                msg = "Failed to apply configuration using command " + change['command']
+                if module.params['transactional']:
+                    result['rollback'] = rollback(session, current, [c['path'] for c in changes if c.get('done')] + [change['path']])
+                    msg += ", changes were rolled back" if rolled_back(result['rollback']) else ", rollback failed"
+                session.close()
+                module.fail_json(msg=msg, output=out, error=err, **result)
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e))
+    except OSError as e:
+        module.fail_json(msg="Failed to apply targetcli configuration - %s" % (e))
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import (TargetCLIStateError, apply, desired_from_options, diff, plan, rollback, rolled_back,
+                                                  snapshot)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: targetcli_facts
+short_description: TargetCLI facts module
+description:
+     - module for gathering the live targetcli configuration (backstores, iSCSI targets, TPGs, LUNs, ACLs
+       and portals) as facts.
+     - configuration is read directly from configfs without starting targetcli, when configfs is not
+       available the saved configuration is used instead.
+     - fingerprint of the configuration is a stable hash that changes only when the configuration does,
+       with I(desired) the managed part of the configuration and the desired state are hashed too, so a play
+       can skip all targetcli tasks when the two fingerprints match.
+version_added: "2.0"
+options:
+  attributes:
+    description:
+      - Include attributes of backstores and TPGs
+    required: false
+    default: true
+    type: bool
+  configfs_root:
+    description:
+      - Path to target configfs directory
+    required: false
+    default: /sys/kernel/config/target
+    type: path
+  savefile:
+    description:
+      - Saved configuration used when configfs is not available
+    required: false
+    default: /etc/target/saveconfig.json
+    type: path
+  desired:
+    description:
+      - Desired configuration to fingerprint, dict with I(backstores), I(targets) and I(purge) taking the same
+        values as the options of targetcli_config module
+      - Adds I(managed_fingerprint) (hash of the part of the live configuration the desired one manages)
+        and I(desired_fingerprint) to the facts, these are equal when targetcli_config with the same
+        values would change nothing
+    required: false
+    default: null
+    type: dict
+notes:
+   - Tested on CentOS 7.7
+   - Fingerprints don't depend on ordering of the objects nor on the source of the configuration, device paths,
+     sizes, serial numbers and read-only attributes (hw_*) are left out.
+   - Without I(attributes) the fingerprint doesn't cover attributes, with I(desired) attributes are always read
+     (and returned).
+requirements: [ ]
+author: "Ondrej Famera (@OndrejHome)"
+'''
+
+EXAMPLES = '''
+- name: gather targetcli facts
+  targetcli_facts:
+
+- name: show LUNs of iSCSI target
+  debug:
+    var: ansible_facts.targetcli.targets['iqn.1994-05.com.redhat:data'].tpgs.tpg1.luns
+
+- name: check whether the storage configuration needs any change
+  targetcli_facts:
+    desired:
+      backstores: "{{ targetcli_backstores }}"
+      targets: "{{ targetcli_targets }}"
+
+- name: converge storage only when it drifted
+  include_role:
+    name: storage
+  when: ansible_facts.targetcli.managed_fingerprint != ansible_facts.targetcli.desired_fingerprint
+'''
+
+RETURN = '''
+ansible_facts:
+    description: facts with live targetcli configuration
+    returned: always
+    type: dict
+    contains:
+        targetcli:
+            description: backstores (keyed by 'type/name') and targets (keyed by wwn), 'source' is one of
+                         configfs, saveconfig or none, 'fingerprint' is sha256 of the normalized configuration,
+                         'managed_fingerprint' and 'desired_fingerprint' are present with I(desired), ACL auth
+                         passwords (password, mutual_password) are masked, they change only the fingerprints
+            type: dict
+            sample: {"source": "configfs", "fingerprint": "5b0e5cd1c6a4f3c0b1e6f2e1d67c0b5fa6d9d6e1b8b0e4c1a9f5e7d2c3b4a5f6",
+                     "backstores": {"block/test1": {"type": "block", "name": "test1", "dev": "/dev/c7vg/LV1"}},
+                     "targets": {"iqn.1994-05.com.redhat:data": {"wwn": "iqn.1994-05.com.redhat:data", "tpgs": {
+                        "tpg1": {"tag": 1, "luns": {"lun0": {"index": 0, "backstore": "block/test1"}},
+                                 "acls": {}, "portals": {"0.0.0.0:3260": {"ip_address": "0.0.0.0", "port": 3260}}}}}}}
+'''
+
+
+def main():
+    state_choice = dict(default="present", choices=['present', 'absent'])
+    module = AnsibleModule(
+        argument_spec=dict(
+            attributes=dict(type='bool', default=True),
+            configfs_root=dict(type='path', default=CONFIGFS_ROOT),
+            savefile=dict(type='path', default=SAVECONFIG),
+            desired=dict(type='dict', required=False, options=dict(
+                backstores=dict(type='list', elements='dict', required=False, options=dict(
+                    backstore_type=dict(required=True),
+                    backstore_name=dict(required=True),
+                    options=dict(required=False),
+                    attributes=dict(required=False),
+                    state=state_choice,
+                )),
+                targets=dict(type='list', elements='dict', required=False, options=dict(
+                    wwn=dict(required=True),
+                    attributes=dict(required=False),
+                    state=state_choice,
+                    luns=dict(type='list', elements='dict', required=False, options=dict(
+                        backstore_type=dict(required=True),
+                        backstore_name=dict(required=True),
+                        lun_index=dict(type='int', required=False),
+                        state=state_choice,
+                    )),
+                    acls=dict(type='list', elements='dict', required=False, options=dict(
+                        initiator_wwn=dict(required=True),
+                        state=state_choice,
+                    )),
+                    portals=dict(type='list', elements='dict', required=False, options=dict(
+                        portal_ip=dict(required=True),
+                        portal_port=dict(type='int', default=3260, required=False),
+                        state=state_choice,
+                    )),
+                )),
+                purge=dict(type='bool', default=False),
+            )),
+        ),
+        supports_check_mode=True
+    )
+
+    desired = module.params['desired']
+    try:
+        state, source = read_state(module.params['configfs_root'], module.params['savefile'],
+                                   module.params['attributes'] or desired is not None)
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg="Failed to read targetcli configuration - %s" % (e))
+    # CHAP secrets are part of the fingerprints only
+    facts = dict(masked_state(state), source=source)
+    try:
+        facts['fingerprint'] = fingerprint(live_view(state))
+        if desired is not None:
+            wanted = desired_from_options(desired['backstores'], desired['targets'])
+            facts['managed_fingerprint'] = fingerprint(managed_view(state, wanted, desired['purge']))
+            facts['desired_fingerprint'] = fingerprint(desired_view(wanted))
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e))
+    module.exit_json(changed=False, ansible_facts={'targetcli': facts})
+
+
+# import module snippets
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_configfs import CONFIGFS_ROOT, SAVECONFIG, read_state
+from ansible.module_utils.targetcli_state import (TargetCLIStateError, desired_from_options, desired_view, fingerprint, live_view,
+                                                  managed_view, masked_state)
+if __name__ == "__main__":
+    main()
@@ -26,9 +26,19 @@ options:
     required: true
     default: null
     type: str
+  tpgs:
+    description:
+      - Tags of the TPGs the target should have, missing ones are created (targetcli creates TPG 1 with every
+        new target), TPGs that are not listed are left alone
+      - All TPGs of the target and their children are read in one pass
+    required: false
+    default: [1]
+    type: list
   attributes:
     description:
-      - Attributes for the defined target
+      - Attributes for the defined target ('key=value' separated by spaces), set on its TPGs listed in I(tpgs)
+      - Attributes of existing target are compared with the live values (read from configfs or with one
+        'get attribute') and only the differing ones are set, in one command, with diff in diff mode
     required: false
     default: null
     type: str
@@ -39,6 +49,47 @@ options:
     default: present
     choices: [present, absent]
     type: str
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
 notes:
    - Tested on CentOS 7.7
 requirements: [ ]
@@ -51,21 +102,31 @@ EXAMPLES = '''
     wwn: 'iqn.1994-05.com.redhat:data'
     attributes: 'demo_mode_write_protect=0'
 
+- name: define iscsi target with two TPGs, e.g. for separate portals and ACLs
+  targetcli_iscsi:
+    wwn: 'iqn.1994-05.com.redhat:split'
+    tpgs: [1, 2]
+    attributes: 'authentication=1'
+
 - name: remove existing target
   targetcli_iscsi:
     wwn: 'iqn.1994-05.com.redhat:hell'
     state: 'absent'
 '''
 
-from distutils.spawn import find_executable
-
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             wwn=dict(required=True),
+            tpgs=dict(type='list', elements='int', default=[1]),
             attributes=dict(required=False),
             state=dict(default="present", choices=['present', 'absent']),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
         ),
         supports_check_mode=True
     )
@@ -73,49 +134,62 @@ def main():
     wwn = module.params['wwn']
     attributes = module.params['attributes']
     state = module.params['state']
+    tags = sorted(set(module.params['tpgs']))
 
-    if find_executable('targetcli') is None:
-        module.fail_json(msg="'targetcli' executable not found. Install 'targetcli'.")
+    try:
+        parse_attributes(attributes)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e))
 
-    result = {}
+    result = {'changed': False}
+    diffs = []
+    session = new_session(module)
 
     try:
-        cmd = "targetcli '/iscsi/%(wwn)s/tpg1 status'" % module.params
-        rc, out, err = module.run_command(cmd)
-        if rc == 0 and state == 'present':
-            result['changed'] = False
-        elif rc == 0 and state == 'absent':
+        # target with all its TPGs in one read
+        target = read_target(session, wwn, attributes=bool(attributes))
+        if target is not None and state == 'absent':
             result['changed'] = True
-            if module.check_mode:
-                module.exit_json(**result)
-            else:
-                cmd = "targetcli '/iscsi delete %(wwn)s'" % module.params
-                rc, out, err = module.run_command(cmd)
-                if rc == 0:
-                    module.exit_json(**result)
-                else:
+            if not module.check_mode:
+                cmd = "/iscsi delete %(wwn)s" % module.params
+                rc, out, err = session.run(cmd)
+                if rc != 0:
                     module.fail_json(msg="Failed to delete iSCSI object using command " + cmd, output=out, error=err)
-        elif state == 'absent':
-            result['changed'] = False
-        else:
-            result['changed'] = True
-            if module.check_mode:
-                module.exit_json(**result)
+        elif state == 'present':
+            commands = []
+            if target is None:
+                commands.append(("/iscsi create %(wwn)s" % module.params, "Failed to define iSCSI object using command "))
+                # targetcli creates TPG 1 with the target
+                existing = {'tpg1': None}
             else:
-                cmd = "targetcli '/iscsi create %(wwn)s'" % module.params
-                rc, out, err = module.run_command(cmd)
-                if rc == 0:
-                    if attributes:
-                        cmd = "targetcli '/iscsi/%(wwn)s/tpg1 set attribute %(attributes)s'" % module.params
-                        rc, out, err = module.run_command(cmd)
-                        if rc == 0:
-                            module.exit_json(**result)
-                        else:
-                            module.fail_json(msg="Failed to set TPG's attributes using command " + cmd, output=out, error=err)
-                    else:
-                        module.exit_json(**result)
-                else:
-                    module.fail_json(msg="Failed to define iSCSI object using command " + cmd, output=out, error=err)
+                existing = target['tpgs']
+            for tag in tags:
+                tpg_path = "/iscsi/%s/tpg%d" % (wwn, tag)
+                if 'tpg%d' % tag not in existing:
+                    commands.append(("/iscsi/%s create tag=%d" % (wwn, tag), "Failed to define TPG using command "))
+                if attributes and existing.get('tpg%d' % tag) is None:
+                    commands.append(("%s set attribute %s" % (tpg_path, attributes), "Failed to set TPG's attributes using command "))
+                elif attributes:
+                    diff, (rc, out, err) = reconcile_attributes(session, tpg_path, attributes, module.check_mode,
+                                                                existing['tpg%d' % tag]['attributes'] or None)
+                    if rc != 0:
+                        module.fail_json(msg="Failed to set TPG's attributes of " + tpg_path, output=out, error=err)
+                    if diff is not None:
+                        result['changed'] = True
+                        diffs.append(diff)
+            for cmd, msg in commands:
+                result['changed'] = True
+                if not module.check_mode:
+                    rc, out, err = session.run(cmd)
+                    if rc != 0:
+                        module.fail_json(msg=msg + cmd, output=out, error=err)
+            if diffs and module._diff:
+                result['diff'] = diffs if len(diffs) > 1 else diffs[0]
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e))
     except OSError as e:
         module.fail_json(msg="Failed to check iSCSI object - %s" % (e))
     module.exit_json(**result)
@@ -123,5 +197,7 @@ def main():
 
 # import module snippets
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import TargetCLIStateError, parse_attributes, read_target, reconcile_attributes
 if __name__ == "__main__":
     main()
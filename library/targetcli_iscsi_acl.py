@@ -17,7 +17,7 @@ DOCUMENTATION = '''
 module: targetcli_iscsi_acl
 short_description: TargetCLI iSCSI ACL module
 description:
-     - module for handling iSCSI ACL objects in targetcli ('/iscsi/.../tpg1/acls').
+     - module for handling iSCSI ACL objects in targetcli ('/iscsi/.../tpgN/acls').
 version_added: "2.0"
 options:
   wwn:
@@ -26,12 +26,37 @@ options:
     required: true
     default: null
     type: str
+  tpg:
+    description:
+      - Tag of the TPG of the target whose ACLs are handled
+    required: false
+    default: 1
+    type: int
   initiator_wwn:
     description:
       - WWN of iSCSI initiator (client)
-    required: true
+      - required unless I(initiators) is used
+    required: false
     default: null
     type: str
+  initiators:
+    description:
+      - List of iSCSI initiators to handle in one task, existing ACLs are read once and only the differences
+        are applied in one targetcli session
+      - Every item has initiator_wwn, optional mapped_luns (list of mapped_lun, tpg_lun and write_protect)
+        and optional auth (userid, password, mutual_userid, mutual_password)
+      - When mapped_luns are given the ACL has exactly these mapped LUNs, otherwise targetcli maps all
+        LUNs of the TPG to new ACL and mapped LUNs of existing ACL are left alone
+      - I(state) applies to all of them
+    required: false
+    default: null
+    type: list
+  exclusive:
+    description:
+      - Remove ACLs that are not listed in I(initiators)
+    required: false
+    default: false
+    type: bool
   state:
     description:
       - Should the object be present or absent from TargetCLI configuration
@@ -39,6 +64,56 @@ options:
     default: present
     choices: [present, absent]
     type: str
+  transactional:
+    description:
+      - With I(initiators), when a command fails, put the objects already changed by the task back to how
+        they were before the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
 notes:
    - Tested on CentOS 7.7
 requirements: [ ]
@@ -56,63 +131,201 @@ EXAMPLES = '''
     wwn: 'iqn.1994-05.com.redhat:data'
     initiator_wwn: 'iqn.1994-05.com.redhat:client1'
     state: 'absent'
+
+- name: define all iSCSI ACLs of target, remove the others
+  targetcli_iscsi_acl:
+    wwn: 'iqn.1994-05.com.redhat:data'
+    initiators:
+      - initiator_wwn: 'iqn.1994-05.com.redhat:client1'
+      - initiator_wwn: 'iqn.1994-05.com.redhat:client2'
+        mapped_luns:
+          - mapped_lun: 0
+            tpg_lun: 1
+            write_protect: true
+        auth:
+          userid: 'client2'
+          password: 'secret'
+    exclusive: true
 '''
 
-from distutils.spawn import find_executable
+RETURN = '''
+changed_objects:
+    description: initiators whose ACLs were (or in check mode would be) created, changed or removed, in order
+    returned: with I(initiators)
+    type: list
+    sample: ["iqn.1994-05.com.redhat:client2"]
+failed_object:
+    description: initiator whose ACL command failed, initiators before it in changed_objects were handled already
+    returned: with I(initiators) when a command failed
+    type: str
+    sample: "iqn.1994-05.com.redhat:client2"
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "acl", "path": "/iscsi/iqn.1994-05.com.redhat:data/tpg1/acls/iqn.1994-05.com.redhat:client2",
+              "name": "iqn.1994-05.com.redhat:client2",
+              "command": "/iscsi/iqn.1994-05.com.redhat:data/tpg1/acls delete iqn.1994-05.com.redhat:client2", "rc": 0}]
+'''
+
+AUTH_KEYS = ('userid', 'password', 'mutual_userid', 'mutual_password')
+
+
+def acl_commands(tpg_path, initiator, current):
+    '''
+    Return targetcli commands turning current ACL (None when it doesn't exist) into the requested one.
+    '''
+    acl_path = '%s/acls/%s' % (tpg_path, initiator['initiator_wwn'])
+    commands = []
+    cur_mapped = {}
+    if current is None:
+        cmd = '%s/acls create %s' % (tpg_path, initiator['initiator_wwn'])
+        if initiator['mapped_luns'] is not None:
+            # only the listed mapped LUNs are created below
+            cmd += ' add_mapped_luns=false'
+        commands.append(cmd)
+    else:
+        cur_mapped = dict((mlun['index'], (mlun['tpg_lun'], mlun['write_protect'])) for mlun in current['mapped_luns'].values())
+    if initiator['mapped_luns'] is not None:
+        wanted = dict((mlun['mapped_lun'], (mlun['tpg_lun'], mlun['write_protect'])) for mlun in initiator['mapped_luns'])
+        # mapped LUN can't be changed in place, it is deleted and created again
+        for index in sorted(cur_mapped):
+            if wanted.get(index) != cur_mapped[index]:
+                commands.append('%s delete %d' % (acl_path, index))
+        for index, (tpg_lun, write_protect) in sorted(wanted.items()):
+            if cur_mapped.get(index) != (tpg_lun, write_protect):
+                commands.append('%s create %d %d write_protect=%s' % (acl_path, index, tpg_lun, str(write_protect).lower()))
+    auth = initiator['auth'] or {}
+    cur_auth = current['auth'] if current is not None else {}
+    changed_auth = [k for k in AUTH_KEYS if auth.get(k) is not None and auth[k] != cur_auth.get(k, '')]
+    if changed_auth:
+        commands.append('%s set auth %s' % (acl_path, ' '.join('%s=%s' % (k, auth[k]) for k in changed_auth)))
+    return commands
+
+
+def apply_initiator(module, session, result):
+    state = module.params['state']
+    exists = session.exists("/iscsi/%(wwn)s/tpg%(tpg)d/acls/%(initiator_wwn)s" % module.params)
+    if exists and state == 'absent':
+        result['changed'] = True
+        if not module.check_mode:
+            cmd = "/iscsi/%(wwn)s/tpg%(tpg)d/acls delete %(initiator_wwn)s" % module.params
+            rc, out, err = session.run(cmd)
+            if rc != 0:
+                module.fail_json(msg="Failed to delete iSCSI ACL object using command " + cmd, output=out, error=err)
+    elif not exists and state == 'present':
+        result['changed'] = True
+        if not module.check_mode:
+            cmd = "/iscsi/%(wwn)s/tpg%(tpg)d/acls create %(initiator_wwn)s" % module.params
+            rc, out, err = session.run(cmd)
+            if rc != 0:
+                module.fail_json(msg="Failed to define iSCSI ACL object using command " + cmd, output=out, error=err)
+
+
+def apply_initiators(module, session, result):
+    state = module.params['state']
+    tpg_path = "/iscsi/%(wwn)s/tpg%(tpg)d" % module.params
+    # all ACLs with their mapped LUNs and auth in one read
+    tpg = read_tpg(session, module.params['wwn'], module.params['tpg'])
+    if tpg is None:
+        if state == 'present':
+            module.fail_json(msg="ISCSI object doesn't exists", path=tpg_path)
+        return
+    # (initiator WWN, command), commands of one initiator follow each other
+    commands = []
+    listed = set(initiator['initiator_wwn'] for initiator in module.params['initiators'])
+    if module.params['exclusive']:
+        for initiator_wwn in sorted(tpg['acls']):
+            if initiator_wwn not in listed:
+                commands.append((initiator_wwn, '%s/acls delete %s' % (tpg_path, initiator_wwn)))
+    seen = set()
+    for initiator in module.params['initiators']:
+        if initiator['initiator_wwn'] in seen:
+            continue
+        seen.add(initiator['initiator_wwn'])
+        current = tpg['acls'].get(initiator['initiator_wwn'])
+        if state == 'absent':
+            if current is not None:
+                commands.append((initiator['initiator_wwn'], '%s/acls delete %s' % (tpg_path, initiator['initiator_wwn'])))
+        else:
+            commands.extend((initiator['initiator_wwn'], cmd) for cmd in acl_commands(tpg_path, initiator, current))
+    result['changed'] = bool(commands)
+    if module.check_mode:
+        for initiator_wwn, cmd in commands:
+            if initiator_wwn not in result['changed_objects']:
+                result['changed_objects'].append(initiator_wwn)
+        return
+    if commands:
+        # what the target is reverted to when a command fails
+        before = snapshot(session) if module.params['transactional'] else None
+        for index, (initiator_wwn, cmd) in enumerate(commands):
+            rc, out, err = session.run(cmd)
+            if rc != 0:
+                msg = "Failed to apply iSCSI ACL configuration using command " + cmd
+                result['failed_object'] = initiator_wwn
+                if before is not None:
+                    result['rollback'] = rollback(session, before, [tpg_path])
+                    msg += ", changes were rolled back" if rolled_back(result['rollback']) else ", rollback failed"
+                module.fail_json(msg=msg, output=out, error=err, **result)
+            if index + 1 == len(commands) or commands[index + 1][0] != initiator_wwn:
+                result['changed_objects'].append(initiator_wwn)
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             wwn=dict(required=True),
-            initiator_wwn=dict(required=True),
+            tpg=dict(type='int', default=1),
+            initiator_wwn=dict(required=False),
+            initiators=dict(type='list', elements='dict', required=False, options=dict(
+                initiator_wwn=dict(required=True),
+                mapped_luns=dict(type='list', elements='dict', required=False, options=dict(
+                    mapped_lun=dict(type='int', required=True),
+                    tpg_lun=dict(type='int', required=True),
+                    write_protect=dict(type='bool', default=False),
+                )),
+                auth=dict(type='dict', required=False, options=dict(
+                    userid=dict(required=False),
+                    password=dict(required=False, no_log=True),
+                    mutual_userid=dict(required=False),
+                    mutual_password=dict(required=False, no_log=True),
+                )),
+            )),
+            exclusive=dict(type='bool', default=False),
             state=dict(default="present", choices=['present', 'absent']),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
         ),
+        mutually_exclusive=[['initiators', 'initiator_wwn']],
+        required_one_of=[['initiators', 'initiator_wwn']],
         supports_check_mode=True
     )
 
-    state = module.params['state']
-
-    if find_executable('targetcli') is None:
-        module.fail_json(msg="'targetcli' executable not found. Install 'targetcli'.")
-
-    result = {}
+    result = {'changed': False}
+    if module.params['initiators'] is not None:
+        result['changed_objects'] = []
+    session = new_session(module)
 
     try:
-        cmd = "targetcli '/iscsi/%(wwn)s/tpg1/acls/%(initiator_wwn)s status'" % module.params
-        rc, out, err = module.run_command(cmd)
-        if rc == 0 and state == 'present':
-            result['changed'] = False
-        elif rc == 0 and state == 'absent':
-            result['changed'] = True
-            if module.check_mode:
-                module.exit_json(**result)
-            else:
-                cmd = "targetcli '/iscsi/%(wwn)s/tpg1/acls delete %(initiator_wwn)s'" % module.params
-                rc, out, err = module.run_command(cmd)
-                if rc == 0:
-                    module.exit_json(**result)
-                else:
-                    module.fail_json(msg="Failed to delete iSCSI ACL object using command " + cmd, output=out, error=err)
-        elif state == 'absent':
-            result['changed'] = False
+        if module.params['initiators'] is not None:
+            apply_initiators(module, session, result)
         else:
-            result['changed'] = True
-            if module.check_mode:
-                module.exit_json(**result)
-            else:
-                cmd = "targetcli '/iscsi/%(wwn)s/tpg1/acls create %(initiator_wwn)s'" % module.params
-                rc, out, err = module.run_command(cmd)
-                if rc == 0:
-                    module.exit_json(**result)
-                else:
-                    module.fail_json(msg="Failed to define iSCSI ACL object using command " + cmd, output=out, error=err)
-    except OSError as e:
+            apply_initiator(module, session, result)
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
+    except (OSError, TargetCLIStateError) as e:
         module.fail_json(msg="Failed to check iSCSI ACL object - %s" % (e))
     module.exit_json(**result)
 
 
 # import module snippets
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import TargetCLIStateError, read_tpg, rollback, rolled_back, snapshot
 if __name__ == "__main__":
     main()
@@ -17,7 +17,7 @@ DOCUMENTATION = '''
 module: targetcli_iscsi_lun
 short_description: TargetCLI LUN module
 description:
-     - module for handling iSCSI LUN objects in targetcli ('/iscsi/.../tpg1/luns').
+     - module for handling iSCSI LUN objects in targetcli ('/iscsi/.../tpgN/luns').
 version_added: "2.0"
 options:
   wwn:
@@ -26,18 +26,45 @@ options:
     required: true
     default: null
     type: str
+  tpg:
+    description:
+      - Tag of the TPG of the target whose LUNs are handled
+    required: false
+    default: 1
+    type: int
   backstore_type:
     description:
       - type of backstore object
-    required: true
+      - required unless I(backstores) is used
+    required: false
     default: null
     type: str
   backstore_name:
     description:
       - name of backstore object
-    required: true
+      - required unless I(backstores) is used
+    required: false
     default: null
     type: str
+  lun_index:
+    description:
+      - Index of the LUN when it is created, existing LUN is left at its index
+      - When omitted, new LUN gets the lowest index that is not used by any LUN or mapped LUN of the TPG
+    required: false
+    default: null
+    type: int
+  backstores:
+    description:
+      - List of backstore objects (backstore_type, backstore_name and optional lun_index) to handle in one task,
+        LUNs are listed once and all changes are done in one targetcli session
+      - lun_index is the index used when the LUN is created, existing LUNs are left at their index
+      - Indexes of all new LUNs are assigned before the first one is created, the ones without lun_index get
+        the lowest indexes not used by any LUN, mapped LUN or lun_index of the list, in the order of the list
+      - I(state) applies to all of them
+      - The action plugin of this module turns a task with loop into one task with this list
+    required: false
+    default: null
+    type: list
   state:
     description:
       - Should the object be present or absent from TargetCLI configuration
@@ -45,8 +72,69 @@ options:
     default: present
     choices: [present, absent]
     type: str
+  transactional:
+    description:
+      - When a command fails, put the objects already changed by the task back to how they were before
+        the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  return_raw:
+    description:
+      - Return the raw targetcli listing (luns_output) in the result, by default it is returned only
+        when the task fails and only structured data are returned otherwise
+      - The listing is there only when it was needed, not when the LUNs were read from configfs or host cache
+    required: false
+    default: false
+    type: bool
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
 notes:
    - Tested on CentOS 7.7
+   - Every LUN is created with explicit index, so the same task gives the same LUN numbers on every host with
+     the same configuration. targetcli maps new LUN into the ACLs of the TPG under its own index, automatically
+     assigned indexes are free in all ACLs so the mapped LUN numbers match the LUN index.
 requirements: [ ]
 author: "Ondrej Famera (@OndrejHome)"
 '''
@@ -58,97 +146,239 @@ EXAMPLES = '''
     backstore_type: 'block'
     backstore_name: 'test1'
 
+- name: define iSCSI LUN with fixed index
+  targetcli_iscsi_lun:
+    wwn: 'iqn.1994-05.com.redhat:fastvm'
+    backstore_type: 'block'
+    backstore_name: 'test3'
+    lun_index: 3
+
 - name: remove iSCSI LUN
   targetcli_iscsi_lun:
     wwn: 'iqn.1994-05.com.redhat:data'
     backstore_type: 'block'
     backstore_name: 'test2'
     state: 'absent'
+
+- name: define many iSCSI LUNs at once
+  targetcli_iscsi_lun:
+    wwn: 'iqn.1994-05.com.redhat:data'
+    backstores:
+      - backstore_type: 'block'
+        backstore_name: 'test1'
+      - backstore_type: 'block'
+        backstore_name: 'test2'
+        lun_index: 10
 '''
 
-from distutils.spawn import find_executable
+RETURN = '''
+lun_id:
+    description: index of the LUN (the one it was or in check mode would be created with), with I(backstores)
+                 map of 'type/name' to index (null when LUN doesn't exist)
+    returned: when LUN exists or is created, always with I(backstores)
+    type: raw
+    sample: {"block/test1": "0", "block/test2": "10"}
+changed_objects:
+    description: backstores ('type/name') whose LUNs were (or in check mode would be) created or deleted
+    returned: with I(backstores)
+    type: list
+    sample: ["block/test2"]
+failed_object:
+    description: backstore ('type/name') whose LUN command failed, backstores before it in the list were handled already
+    returned: with I(backstores) when a command failed
+    type: str
+    sample: "block/test2"
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "lun", "path": "/iscsi/iqn.2020-01.com.example:t1/tpg1/luns/lun1",
+              "name": "block/test2", "command": "/iscsi/iqn.2020-01.com.example:t1/tpg1/luns delete lun1", "rc": 0}]
+luns_output:
+    description: raw output of 'ls' of the TPG when its LUNs and ACLs had to be listed by targetcli
+    returned: with I(return_raw) or when the task failed
+    type: str
+perf:
+    description: timing of the task, every command with its source (targetcli, rtslib, configfs, cache), rc,
+                 duration and stdout_bytes, number of started targetcli processes (spawns) and totals
+    returned: when profile is true
+    type: dict
+    sample: {"engine": "targetcli", "spawns": 1, "spawn_time": 0.41,
+             "commands": [{"cmd": "/iscsi/iqn.2020-01.com.example:t1/tpg1 status", "source": "configfs", "rc": 0,
+                           "duration": 0.0001, "stdout_bytes": 0}],
+             "totals": {"commands": 1, "nonzero_rc": 0, "duration": 0.0001, "stdout_bytes": 0, "wall": 0.52}}
+'''
+
+
+def read_luns(session, module, raw):
+    '''
+    Return LUNs and ACLs (with mapped LUNs) of the TPG in one read, listing goes into raw.
+    '''
+    wwn, tag = module.params['wwn'], module.params['tpg']
+    cached = session.cached_state()
+    if session.configfs.available():
+        tpg = session.configfs.read_tpg(wwn, tag, attributes=False)
+    elif cached is not None and wwn in cached['targets']:
+        # host cache is valid, no need to list the TPG
+        tpg = cached['targets'][wwn]['tpgs'].get('tpg%d' % tag)
+    else:
+        # lets parse the LUNs and ACLs from the targetcli listing of the TPG
+        tpg_path = "/iscsi/%s/tpg%d" % (wwn, tag)
+        rc, output, err = session.run(tpg_path + " ls")
+        raw['luns_output'] = output
+        tpg = parse_ls(output, tpg_path).to_state()['targets'].get(wwn, {}).get('tpgs', {}).get('tpg%d' % tag)
+    return tpg or new_tpg(tag)
+
+
+def allocate_indexes(tpg, tpg_path, requested):
+    '''
+    Index of every LUN to be created keyed by backstore, explicit indexes are taken first, the rest get
+    the lowest free ones in the requested order. Raises TargetCLIStateError on conflicting indexes.
+    '''
+    existing = lun_by_backstore(tpg)
+    allocator = LunAllocator(tpg, tpg_path)
+    indexes = {}
+    for lun_path, lun_index in requested:
+        if lun_index is None or lun_path in existing or lun_path in indexes:
+            continue
+        if lun_index in allocator.owners and lun_index not in allocator.assigned:
+            raise TargetCLIStateError("LUN %d in %s is used by backstore %s" % (lun_index, tpg_path, allocator.owner(lun_index)))
+        indexes[lun_path] = allocator.take(lun_index, lun_path)
+    for lun_path, lun_index in requested:
+        if lun_path not in existing and lun_path not in indexes:
+            indexes[lun_path] = allocator.allocate(lun_path)
+    return indexes
+
+
+def fail(module, session, before, msg, out, err, tpg_path, details):
+    '''
+    Fail the task, with transactional (before is the state read before any change) revert the target first.
+    '''
+    if before is not None:
+        details['rollback'] = rollback(session, before, [tpg_path])
+        msg += ", changes were rolled back" if rolled_back(details['rollback']) else ", rollback failed"
+    module.fail_json(msg=msg, output=out, error=err, **details)
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             wwn=dict(required=True),
-            backstore_type=dict(required=True),
-            backstore_name=dict(required=True),
+            tpg=dict(type='int', default=1),
+            backstore_type=dict(required=False),
+            backstore_name=dict(required=False),
+            backstores=dict(type='list', elements='dict', required=False, options=dict(
+                backstore_type=dict(required=True),
+                backstore_name=dict(required=True),
+                lun_index=dict(type='int', required=False),
+            )),
+            lun_index=dict(type='int', required=False),
             state=dict(default="present", choices=['present', 'absent']),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            return_raw=dict(type='bool', default=False),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
         ),
+        mutually_exclusive=[['backstores', 'backstore_type'], ['backstores', 'backstore_name'], ['backstores', 'lun_index']],
+        required_one_of=[['backstores', 'backstore_name']],
+        required_together=[['backstore_type', 'backstore_name']],
         supports_check_mode=True
     )
 
-    lun_path = module.params['backstore_type'] + "/" + module.params['backstore_name']
     state = module.params['state']
+    batch = module.params['backstores'] is not None
+    if batch:
+        requested = [('%(backstore_type)s/%(backstore_name)s' % bs, bs['lun_index']) for bs in module.params['backstores']]
+    else:
+        requested = [(module.params['backstore_type'] + "/" + module.params['backstore_name'], module.params['lun_index'])]
 
-    if find_executable('targetcli') is None:
-        module.fail_json(msg="'targetcli' executable not found. Install 'targetcli'.")
-
-    result = {}
-    luns = {}
+    result = {'changed': False}
+    if batch:
+        result['changed_objects'] = []
+    # raw targetcli output, returned only on request or with failure
+    raw = {}
+    lun_ids = {}
+    tpg_path = "/iscsi/%(wwn)s/tpg%(tpg)d" % module.params
+    session = new_session(module)
 
     try:
         # check if the iscsi target exists
-        cmd = "targetcli '/iscsi/%(wwn)s/tpg1 status'" % module.params
-        rc, out, err = module.run_command(cmd)
-        if rc != 0 and state == 'present':
-            result['changed'] = False
-            module.fail_json(msg="ISCSI object doesn't exists", cmd=cmd, output=out, error=err)
-        elif rc != 0 and state == 'absent':
+        exists = session.exists(tpg_path)
+        if not exists and state == 'present':
+            module.fail_json(msg="ISCSI object doesn't exists", path=tpg_path)
+        elif not exists and state == 'absent':
             result['changed'] = False
             # ok iSCSI object doesn't exist so LUN is also not there --> success
+            lun_ids = dict((lun_path, None) for lun_path, lun_index in requested)
         else:
-            # lets parse the list of LUNs from the targetcli
-            cmd = "targetcli '/iscsi/%(wwn)s/tpg1/luns ls'" % module.params
-            rc, output, err = module.run_command(cmd)
-            result['luns_output'] = output
-            for row in output.split('\n'):
-                row_data = row.split(' ')
-                if len(row_data) < 2 or row_data[0] == 'luns':
-                    continue
-                if row_data[1] == "luns":
+            # LUNs are listed once for all requested backstores
+            tpg = read_luns(session, module, raw)
+            luns = dict((lun['backstore'], str(lun['index'])) for lun in tpg['luns'].values())
+            # indexes of the whole batch are assigned from the same read, before the first LUN is created
+            indexes = allocate_indexes(tpg, tpg_path, requested) if state == 'present' else {}
+            # what the target is reverted to when a command fails
+            before = snapshot(session) if module.params['transactional'] and not module.check_mode else None
+            for lun_path, lun_index in requested:
+                if lun_path in lun_ids:
                     continue
-                luns[row_data[5][1:]] = row_data[3][3:]
-            if state == 'present' and lun_path in luns:
-                # LUN is already there and present
-                result['changed'] = False
-                result['lun_id'] = luns[lun_path]
-            elif state == 'absent' and lun_path not in luns:
-                # LUN is not there and should not be there
-                result['changed'] = False
-            elif state == 'present' and lun_path not in luns:
-                # create LUN
-                result['changed'] = True
-                if module.check_mode:
-                    module.exit_json(**result)
-                else:
-                    cmd = "targetcli '/iscsi/%(wwn)s/tpg1/luns create /backstores/%(backstore_type)s/%(backstore_name)s'" % module.params
-                    rc, out, err = module.run_command(cmd)
-                    if rc == 0:
-                        module.exit_json(**result)
-                    else:
-                        module.fail_json(msg="Failed to create iSCSI LUN object using command " + cmd, output=out, error=err)
-
-            elif state == 'absent' and lun_path in luns:
-                # delete LUN
-                result['changed'] = True
-                if module.check_mode:
-                    module.exit_json(**result)
-                else:
-                    cmd = "targetcli '/iscsi/%(wwn)s/tpg1/luns delete lun" % module.params + luns[lun_path] + "'"
-                    rc, out, err = module.run_command(cmd)
-                    if rc == 0:
-                        module.exit_json(**result)
-                    else:
-                        module.fail_json(msg="Failed to delete iSCSI LUN object using command " + cmd, output=out, error=err)
+                lun_ids[lun_path] = None
+                # what failure of this LUN's command reports, in batch mode with the LUNs handled before it
+                details = dict(raw)
+                if batch:
+                    details.update(changed=result['changed'], changed_objects=result['changed_objects'], lun_id=lun_ids,
+                                   failed_object=lun_path)
+                if state == 'present' and lun_path in luns:
+                    # LUN is already there and present
+                    lun_ids[lun_path] = luns[lun_path]
+                    if not batch:
+                        result['lun_id'] = luns[lun_path]
+                elif state == 'present' and lun_path not in luns:
+                    # create LUN
+                    result['changed'] = True
+                    lun_ids[lun_path] = str(indexes[lun_path])
+                    if not batch:
+                        result['lun_id'] = lun_ids[lun_path]
+                    if not module.check_mode:
+                        cmd = "%s/luns create /backstores/%s lun=%d" % (tpg_path, lun_path, indexes[lun_path])
+                        rc, out, err = session.run(cmd)
+                        if rc != 0:
+                            fail(module, session, before, "Failed to create iSCSI LUN object using command " + cmd, out, err,
+                                 tpg_path, details)
+                    if batch:
+                        result['changed_objects'].append(lun_path)
+                elif state == 'absent' and lun_path in luns:
+                    # delete LUN
+                    result['changed'] = True
+                    if not module.check_mode:
+                        cmd = "%s/luns delete lun%s" % (tpg_path, luns[lun_path])
+                        rc, out, err = session.run(cmd)
+                        if rc != 0:
+                            fail(module, session, before, "Failed to delete iSCSI LUN object using command " + cmd, out, err,
+                                 tpg_path, details)
+                    if batch:
+                        result['changed_objects'].append(lun_path)
+        if batch:
+            result['lun_id'] = lun_ids
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err, **raw)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e), **raw)
     except OSError as e:
-        module.fail_json(msg="Failed to check iSCSI lun object - %s" % (e))
+        module.fail_json(msg="Failed to check iSCSI lun object - %s" % (e), **raw)
+    if module.params['return_raw']:
+        result.update(raw)
     module.exit_json(**result)
 
 
 # import module snippets
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_ls import parse_ls
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import (LunAllocator, TargetCLIStateError, lun_by_backstore, new_tpg, rollback, rolled_back,
+                                                  snapshot)
 if __name__ == "__main__":
     main()
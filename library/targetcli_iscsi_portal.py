@@ -20,18 +20,34 @@ module: targetcli_iscsi_portal
 short_description: TargetCLI portal module
 description:
      - module for handling iSCSI portals object in targetcli ('/iscsi/.../tpg1/portals').
+     - with I(wwns) and I(portals) lists many portals of many targets are handled in one task.
 version_added: "2.0"
 options:
   wwn:
     description:
       - WWN of iSCSI target (server)
-    required: true
+      - Required unless I(wwns) is used
+    required: false
     default: null
     type: str
+  wwns:
+    description:
+      - List of WWNs of iSCSI targets that get the same portals, portals of all of them are read in one pass
+        (configfs, host cache or one saveconfig) and changed in one targetcli session
+    required: false
+    default: null
+    type: list
+  tpg:
+    description:
+      - Tag of the TPG of the target(s) whose portals are handled
+    required: false
+    default: 1
+    type: int
   portal_ip:
     description:
       - ip of portal object
-    required: true
+      - Required unless I(portals) is used
+    required: false
     default: null
     type: str
   portal_port:
@@ -40,6 +56,21 @@ options:
     required: false
     default: 3260
     type: int
+  portals:
+    description:
+      - List of portals (portal_ip, portal_port) to handle in one task, I(state) applies to all of them
+    required: false
+    default: null
+    type: list
+  exclusive:
+    description:
+      - With state present, also remove the portals of the TPG(s) that are not listed, including the default
+        0.0.0.0:3260 portal created with the target
+      - Unlisted portals are removed before the listed ones are created, so portals on the port of removed
+        0.0.0.0 portal can be created
+    required: false
+    default: false
+    type: bool
   state:
     description:
       - Should the object be present or absent from TargetCLI configuration
@@ -47,6 +78,64 @@ options:
     default: present
     choices: [present, absent]
     type: str
+  transactional:
+    description:
+      - When a command fails, put the objects already changed by the task back to how they were before
+        the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  return_raw:
+    description:
+      - Return the raw targetcli listing (portals_output) in the result, by default it is returned only
+        when the task fails and only structured data are returned otherwise
+      - The listing is there only when it was needed, not when the portals were read from configfs or host cache
+    required: false
+    default: false
+    type: bool
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
 notes:
    - Tested on CentOS 7.7
 requirements: [ ]
@@ -70,90 +159,200 @@ EXAMPLES = '''
     wwn: 'iqn.2020-01.com.recisio.iscsi:alpha'
     portal_ip: '192.168.1.10'
     state: 'absent'
+
+- name: have exactly these portals on all targets, without the default one
+  targetcli_iscsi_portal:
+    wwns:
+      - 'iqn.2020-01.com.recisio.iscsi:alpha'
+      - 'iqn.2020-01.com.recisio.iscsi:beta'
+    portals:
+      - portal_ip: '192.168.1.10'
+      - portal_ip: '192.168.2.10'
+    exclusive: true
+'''
+
+RETURN = '''
+portals:
+    description: portals of the TPG of every existing target found before the task changed anything, the same list
+                 with I(wwn) and I(wwns), sorted by WWN and portal
+    returned: always
+    type: list
+    sample: [{"wwn": "iqn.2020-01.com.recisio.iscsi:alpha", "tpg": 1, "ip_address": "0.0.0.0", "port": 3260},
+             {"wwn": "iqn.2020-01.com.recisio.iscsi:alpha", "tpg": 1, "ip_address": "192.168.1.10", "port": 3260}]
+changed_objects:
+    description: portals that were (or in check mode would be) created or removed, in order
+    returned: with I(wwns) or I(portals)
+    type: list
+    sample: ["/iscsi/iqn.2020-01.com.recisio.iscsi:alpha/tpg1/portals/0.0.0.0:3260"]
+failed_object:
+    description: portal whose command failed, objects before it in changed_objects were handled already
+    returned: with I(wwns) or I(portals) when a command failed
+    type: str
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "portal", "path": "/iscsi/iqn.2020-01.com.example:t1/tpg1/portals/10.0.0.1:3260",
+              "name": "10.0.0.1:3260",
+              "command": "/iscsi/iqn.2020-01.com.example:t1/tpg1/portals delete ip_address=10.0.0.1 ip_port=3260", "rc": 0}]
+portals_output:
+    description: raw output of 'portals ls' when the portals had to be listed by targetcli
+    returned: with I(return_raw) or when the task failed
+    type: str
 '''
 
-from distutils.spawn import find_executable
+
+def read_portals(session, wwns, tag, batch, raw):
+    '''
+    Portals ('ip:port') of the TPG of every target in one pass, None for targets without the TPG.
+    '''
+    session.acquire()
+    name = 'tpg%d' % tag
+    if session.configfs.available():
+        tpgs = dict((wwn, session.configfs.read_tpg(wwn, tag, attributes=False)) for wwn in wwns)
+        return dict((wwn, list(tpg['portals']) if tpg else None) for wwn, tpg in tpgs.items())
+    if not batch:
+        tpg_path = "/iscsi/%s/%s" % (wwns[0], name)
+        if not session.exists(tpg_path):
+            return {wwns[0]: None}
+    state = session.cached_state()
+    if state is None and batch:
+        # one saveconfig for all targets instead of status and ls of each
+        state = snapshot(session)
+    if state is not None:
+        current = {}
+        for wwn in wwns:
+            tpg = state['targets'].get(wwn, {'tpgs': {}})['tpgs'].get(name)
+            current[wwn] = list(tpg['portals']) if tpg else None
+        return current
+    # lets parse the list of portals from the targetcli
+    rc, output, err = session.run(tpg_path + "/portals ls")
+    raw['portals_output'] = output
+    return {wwns[0]: list(parse_ls(output, tpg_path + '/portals').portals(tpg_path))}
+
+
+def portal_list(current, tag):
+    '''
+    Portals of all targets as one list of {'wwn', 'tpg', 'ip_address', 'port'}, targets without the TPG are left out.
+    '''
+    portals = []
+    for wwn, names in sorted(current.items()):
+        for name in sorted(names or []):
+            ip_address, port = name.rsplit(':', 1)
+            portals.append({'wwn': wwn, 'tpg': tag, 'ip_address': ip_address, 'port': int(port)})
+    return portals
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            wwn=dict(required=True),
-            portal_ip=dict(required=True),
-            portal_port=dict(type='int', default="3260", required=False),
+            wwn=dict(required=False),
+            wwns=dict(type='list', elements='str', required=False),
+            tpg=dict(type='int', default=1),
+            portal_ip=dict(required=False),
+            portal_port=dict(type='int', default=3260, required=False),
+            portals=dict(type='list', elements='dict', required=False, options=dict(
+                portal_ip=dict(required=True),
+                portal_port=dict(type='int', default=3260, required=False),
+            )),
+            exclusive=dict(type='bool', default=False),
             state=dict(default="present", choices=['present', 'absent']),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            return_raw=dict(type='bool', default=False),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
         ),
+        mutually_exclusive=[['wwn', 'wwns'], ['portal_ip', 'portals']],
+        required_one_of=[['wwn', 'wwns'], ['portal_ip', 'portals']],
         supports_check_mode=True
     )
 
-    portal = module.params['portal_ip'] + ":" + str(module.params['portal_port'])
     state = module.params['state']
+    batch = module.params['wwns'] is not None or module.params['portals'] is not None
+    wwns = module.params['wwns'] if module.params['wwns'] is not None else [module.params['wwn']]
+    if module.params['portals'] is not None:
+        wanted = module.params['portals']
+    else:
+        wanted = [dict((key, module.params[key]) for key in ('portal_ip', 'portal_port'))]
+    wanted = dict((portal_name(p['portal_ip'], p['portal_port']), p) for p in wanted)
+    if module.params['exclusive'] and state != 'present':
+        module.fail_json(msg="exclusive can be used only with state present")
 
-    if find_executable('targetcli') is None:
-        module.fail_json(msg="'targetcli' executable not found. Install 'targetcli'.")
-
-    result = {}
-    portals = []
+    result = {'changed': False}
+    if batch:
+        result['changed_objects'] = []
+    # raw targetcli output, returned only on request or with failure
+    raw = {}
+    tpg_name = 'tpg%d' % module.params['tpg']
+    session = new_session(module)
 
     try:
-        # check if the iscsi target exists
-        cmd = "targetcli '/iscsi/%(wwn)s/tpg1 status'" % module.params
-        rc, out, err = module.run_command(cmd)
-        if rc != 0 and state == 'present':
-            result['changed'] = False
-            module.fail_json(msg="ISCSI object doesn't exists", cmd=cmd, output=out, error=err)
-        elif rc != 0 and state == 'absent':
-            result['changed'] = False
-            # ok iSCSI object doesn't exist so portal is also not there --> success
-        else:
-            # lets parse the list of portals from the targetcli
-            cmd = "targetcli '/iscsi/%(wwn)s/tpg1/portals ls'" % module.params
-            rc, output, err = module.run_command(cmd)
-            result['portals_output'] = output
-            for row in output.split('\n'):
-                row_data = row.split(' ')
-                if len(row_data) < 2 or row_data[0] == 'portals':
-                    continue
-                if row_data[1] == "portals":
-                    continue
-                portals.append(row_data[3])
-            if state == 'present' and portal in portals:
-                # portal is already there and present
-                result['changed'] = False
-            elif state == 'absent' and portal not in portals:
-                # portal is not there and should not be there
-                result['changed'] = False
-            elif state == 'present' and portal not in portals:
-                # create portal
-                result['changed'] = True
-                if module.check_mode:
-                    module.exit_json(**result)
-                else:
-                    cmd = "targetcli '/iscsi/%(wwn)s/tpg1/portals create ip_address=%(portal_ip)s ip_port=%(portal_port)s'" % module.params
-                    rc, out, err = module.run_command(cmd)
-                    if rc == 0:
-                        module.exit_json(**result)
-                    else:
-                        module.fail_json(msg="Failed to create iSCSI portal object using command " + cmd, output=out, error=err)
-
-            elif state == 'absent' and portal in portals:
-                # delete portal
-                result['changed'] = True
-                if module.check_mode:
-                    module.exit_json(**result)
-                else:
-                    cmd = "targetcli '/iscsi/%(wwn)s/tpg1/portals delete ip_address=%(portal_ip)s ip_port=%(portal_port)s'" % module.params
-                    rc, out, err = module.run_command(cmd)
-                    if rc == 0:
-                        module.exit_json(**result)
-                    else:
-                        module.fail_json(msg="Failed to delete iSCSI portal object using command " + cmd, output=out, error=err)
+        current = read_portals(session, wwns, module.params['tpg'], batch, raw)
+        # what the targets are reverted to when a command fails
+        before = snapshot(session) if module.params['transactional'] and not module.check_mode else None
+        missing = [wwn for wwn in wwns if current[wwn] is None]
+        if missing and state == 'present':
+            # nothing is changed when any target is missing
+            module.fail_json(msg="ISCSI object doesn't exists", path="/iscsi/%s/%s" % (missing[0], tpg_name), **raw)
+        result['portals'] = portal_list(current, module.params['tpg'])
+
+        # removals first, 0.0.0.0:3260 blocks other portals on port 3260
+        commands = []
+        for wwn in wwns:
+            portals = current[wwn]
+            if portals is None:
+                # ok iSCSI object doesn't exist so portal is also not there --> success
+                continue
+            path = "/iscsi/%s/%s/portals" % (wwn, tpg_name)
+            if state == 'absent':
+                removed = [name for name in portals if name in wanted]
+            else:
+                removed = [name for name in portals if name not in wanted] if module.params['exclusive'] else []
+            for name in sorted(removed):
+                ip_address, port = name.rsplit(':', 1)
+                commands.append(("%s/%s" % (path, name), "Failed to delete iSCSI portal object using command ",
+                                 "%s delete ip_address=%s ip_port=%s" % (path, ip_address, port)))
+        if state == 'present':
+            for wwn in wwns:
+                path = "/iscsi/%s/%s/portals" % (wwn, tpg_name)
+                for name, portal in sorted(wanted.items()):
+                    if name not in current[wwn]:
+                        commands.append(("%s/%s" % (path, name), "Failed to create iSCSI portal object using command ",
+                                         "%s create ip_address=%s ip_port=%s" % (path, portal['portal_ip'], portal['portal_port'])))
+
+        for obj, msg, cmd in commands:
+            if not module.check_mode:
+                rc, out, err = session.run(cmd)
+                if rc != 0:
+                    failure = dict(raw, msg=msg + cmd, output=out, error=err)
+                    if batch:
+                        failure.update(result, failed_object=obj)
+                    if before is not None:
+                        failure['rollback'] = rollback(session, before, result.get('changed_objects', []) + [obj])
+                        failure['msg'] += ", changes were rolled back" if rolled_back(failure['rollback']) else ", rollback failed"
+                    module.fail_json(**failure)
+            result['changed'] = True
+            if batch:
+                result['changed_objects'].append(obj)
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err, **raw)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e), **raw)
     except OSError as e:
-        module.fail_json(msg="Failed to check iSCSI portal object - %s" % (e))
+        module.fail_json(msg="Failed to check iSCSI portal object - %s" % (e), **raw)
+    if module.params['return_raw']:
+        result.update(raw)
     module.exit_json(**result)
 
 
 # import module snippets
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_ls import parse_ls
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import TargetCLIStateError, portal_name, rollback, rolled_back, snapshot
 if __name__ == "__main__":
     main()
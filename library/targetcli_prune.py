@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: targetcli_prune
+short_description: TargetCLI prune module
+description:
+     - module for removing orphaned objects from targetcli configuration in one pass.
+     - live configuration is read once and indexed, orphans are backstores not used by any LUN (with
+       I(backstores)), LUNs whose backstore is gone, mapped LUNs whose TPG LUN is gone and ACLs of initiators
+       that are not listed in I(initiators).
+     - orphans are deleted in dependency order (mapped LUNs, ACLs, LUNs, backstores) in one targetcli session.
+version_added: "2.0"
+options:
+  backstores:
+    description:
+      - Remove backstores that are not used by any LUN of any target
+      - LUNs of targets of all fabrics (iSCSI, loopback, vhost, qla2xxx, ...) count as users of backstores
+    required: false
+    default: false
+    type: bool
+  keep_backstores:
+    description:
+      - Backstores that are never removed, backstore types like 'block' or 'type/name' of single backstores
+    required: false
+    default: []
+    type: list
+  initiators:
+    description:
+      - Initiator WWNs that may have ACLs, ACLs of all other initiators are removed
+      - When omitted ACLs are not removed
+    required: false
+    default: null
+    type: list
+  targets:
+    description:
+      - WWNs of iSCSI targets whose LUNs, ACLs and mapped LUNs are pruned, when omitted all targets are
+      - LUNs of all targets count as users of backstores regardless of this list
+    required: false
+    default: null
+    type: list
+  transactional:
+    description:
+      - When a command fails, put the objects already changed by the task back to how they were before
+        the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
+notes:
+   - Tested on CentOS 7.7
+   - Supports check mode and diff mode, list of objects to be removed is returned in both
+   - Targets, TPGs and portals are never removed.
+requirements: [ ]
+author: "Ondrej Famera (@OndrejHome)"
+'''
+
+EXAMPLES = '''
+- name: list orphaned objects without removing them
+  targetcli_prune:
+  check_mode: true
+  register: orphans
+
+- name: remove unused backstores except fileio ones and ACLs of decommissioned initiators
+  targetcli_prune:
+    backstores: true
+    keep_backstores: ['fileio']
+    initiators:
+      - 'iqn.1994-05.com.redhat:client1'
+      - 'iqn.1994-05.com.redhat:client2'
+'''
+
+RETURN = '''
+changes:
+    description: list of deletions (to be) applied in order
+    returned: always
+    type: list
+    sample: [{"action": "delete", "object": "backstore", "path": "/backstores/block/test1", "name": "block/test1",
+              "command": "/backstores/block delete test1", "reason": "not used by any LUN"}]
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "backstore", "path": "/backstores/block/test1", "name": "block/test1",
+              "command": "/backstores/block delete test1", "rc": 0}]
+'''
+
+
+def prune_plan(state, params):
+    '''
+    Deletions of orphaned objects in state, in the order they have to be applied.
+    '''
+    references = backstore_references(state)
+    changes = []
+    for wwn, target in sorted(state['targets'].items()):
+        if params['targets'] is not None and wwn not in params['targets']:
+            continue
+        for tpg_name, tpg in sorted(target['tpgs'].items()):
+            tpg_path = '/iscsi/%s/%s' % (wwn, tpg_name)
+            orphan_luns = set()
+            for name, lun in sorted(tpg['luns'].items()):
+                if lun['backstore'] is None or lun['backstore'] not in state['backstores']:
+                    orphan_luns.add(lun['index'])
+                    changes.append(Change('delete', 'lun', '%s/luns/%s' % (tpg_path, name), lun['backstore'] or name,
+                                          '%s/luns delete %s' % (tpg_path, name), reason='backstore is gone'))
+            luns = set(lun['index'] for lun in tpg['luns'].values()) - orphan_luns
+            for initiator, acl in sorted(tpg['acls'].items()):
+                acl_path = '%s/acls/%s' % (tpg_path, initiator)
+                if params['initiators'] is not None and initiator not in params['initiators']:
+                    changes.append(Change('delete', 'acl', acl_path, initiator, '%s/acls delete %s' % (tpg_path, initiator),
+                                          reason='initiator is not listed'))
+                    continue
+                for name, mlun in sorted(acl['mapped_luns'].items()):
+                    # mapped LUNs of deleted LUNs go away with them
+                    if mlun['tpg_lun'] not in luns and mlun['tpg_lun'] not in orphan_luns:
+                        changes.append(Change('delete', 'mapped_lun', '%s/%s' % (acl_path, name), name,
+                                              '%s delete %d' % (acl_path, mlun['index']), reason='TPG LUN is gone'))
+    if params['backstores']:
+        for key, users in sorted(references.items()):
+            if users or key not in state['backstores'] or in_scope(key, params['keep_backstores']):
+                continue
+            bs = state['backstores'][key]
+            changes.append(Change('delete', 'backstore', '/backstores/%s' % key, key,
+                                  '/backstores/%s delete %s' % (bs['type'], bs['name']), reason='not used by any LUN'))
+    changes.sort(key=lambda c: -OBJECT_ORDER.index(c['object']))
+    return changes
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            backstores=dict(type='bool', default=False),
+            keep_backstores=dict(type='list', elements='str', default=[]),
+            initiators=dict(type='list', elements='str', required=False),
+            targets=dict(type='list', elements='str', required=False),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
+        ),
+        supports_check_mode=True
+    )
+
+    result = {'changed': False}
+    session = new_session(module)
+
+    try:
+        before = snapshot(session)
+        changes = prune_plan(before, module.params)
+        result['changed'] = bool(changes)
+        result['changes'] = changes
+        if module._diff:
+            result['diff'] = diff(changes)
+        if changes and not module.check_mode:
+            failed = apply(session, changes)
+            if failed is not None:
+                change, out, err = failed
+                msg = "Failed to remove orphaned object using command " + change['command']
+                if module.params['transactional']:
+                    result['rollback'] = rollback(session, before, [c['path'] for c in changes if c.get('done')] + [change['path']])
+                    msg += ", changes were rolled back" if rolled_back(result['rollback']) else ", rollback failed"
+                session.close()
+                module.fail_json(msg=msg, output=out, error=err, **result)
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e))
+    except OSError as e:
+        module.fail_json(msg="Failed to prune targetcli configuration - %s" % (e))
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import (OBJECT_ORDER, Change, TargetCLIStateError, apply, backstore_references, diff,
+                                                  in_scope, rollback, rolled_back, snapshot)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: targetcli_restore
+short_description: TargetCLI restore module
+description:
+     - module for restoring configuration saved by targetcli (saveconfig.json format) without clearing the
+       live configuration first.
+     - live configuration is read once and compared with the file, only the differences (missing objects,
+       LUNs, mapped LUNs, portals, differing attributes and ACL auth) are applied in one targetcli session,
+       objects that match the file stay untouched together with the sessions using them.
+version_added: "2.0"
+options:
+  src:
+    description:
+      - Path to the saveconfig.json file on the managed host
+    required: true
+    type: path
+  scope:
+    description:
+      - Restore only part of the file, dict with optional lists I(targets) (WWNs of iSCSI targets)
+        and I(backstores) (backstore types like 'block' or 'type/name' of single backstores)
+      - With I(targets) only the backstores their LUNs refer to are restored unless I(backstores) are listed too,
+        without I(targets) iSCSI targets are not touched at all
+      - When omitted whole file is restored
+    required: false
+    default: null
+    type: dict
+  purge:
+    description:
+      - Remove objects (in scope) that are not in the file, including LUNs, mapped LUNs, ACLs and portals
+        of the restored targets
+    required: false
+    default: false
+    type: bool
+  transactional:
+    description:
+      - When a command fails, put the objects already changed by the task back to how they were before
+        the task, in reverse order and in the same targetcli session, the steps are returned in 'rollback'
+      - Objects deleted by the task are recreated with the device, size and serial number, LUN index,
+        mapped LUNs, ACL auth and portals they had, attributes are restored only on objects that were not deleted
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for reading and changing the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  save:
+    description:
+      - When to save the changed configuration, immediate saves it at the end of the task,
+        deferred leaves the save to targetcli_save module (typically run as handler) and
+        never doesn't save it at all
+      - deferred records the pending save in /run/ansible-targetcli/unsaved so that it isn't lost when
+        the play fails before the save, any later immediate save or targetcli_save run flushes it
+    required: false
+    default: immediate
+    choices: [immediate, deferred, never]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
+notes:
+   - Tested on CentOS 7.7
+   - Supports check mode and diff mode, list of planned changes is returned in both
+   - Only iSCSI targets are restored with all their TPGs, TPG parameters and enable flag are not restored and
+     TPGs that are not in the file are not removed.
+   - LUNs are created with the index from the file, LUN of the same backstore with different index is kept as is.
+   - CHAP passwords from the file are hidden in the returned changes.
+requirements: [ ]
+author: "Ondrej Famera (@OndrejHome)"
+'''
+
+EXAMPLES = '''
+- name: restore configuration saved before reinstall
+  targetcli_restore:
+    src: /root/saveconfig.json
+
+- name: restore one target and the backstores of its LUNs
+  targetcli_restore:
+    src: /root/saveconfig.json
+    scope:
+      targets:
+        - 'iqn.1994-05.com.redhat:data'
+
+- name: make block backstores exactly as in the file
+  targetcli_restore:
+    src: /root/saveconfig.json
+    scope:
+      backstores: ['block']
+    purge: true
+'''
+
+RETURN = '''
+changes:
+    description: list of changes (to be) applied in order, changes of attributes and auth have before and after values
+    returned: always
+    type: list
+    sample: [{"action": "create", "object": "lun", "path": "/iscsi/iqn.1994-05.com.redhat:data/tpg1/luns",
+              "name": "block/test1", "command": "/iscsi/iqn.1994-05.com.redhat:data/tpg1/luns create /backstores/block/test1 lun=0"}]
+rollback:
+    description: steps that reverted the changes of the task after a failed command, with rc (and error) of each
+    returned: when a command failed with I(transactional)
+    type: list
+    sample: [{"action": "delete", "object": "backstore", "path": "/backstores/block/test1", "name": "block/test1",
+              "command": "/backstores/block delete test1", "rc": 0}]
+'''
+
+import json
+
+
+def backstore_options(so):
+    '''
+    Parameters of backstore create command recreating storage object from saveconfig.
+    '''
+    options = []
+    if so['plugin'] in ('block', 'pscsi'):
+        options.append('dev=%s' % so['dev'])
+    elif so['plugin'] == 'fileio':
+        options.append('file_or_dev=%s' % so['dev'])
+        if so.get('size'):
+            options.append('size=%s' % so['size'])
+        if 'write_back' in so:
+            options.append('write_back=%s' % str(bool(so['write_back'])).lower())
+    elif so['plugin'] == 'ramdisk':
+        options.append('size=%s' % so['size'])
+        if so.get('nullio'):
+            options.append('nullio=true')
+    if so['plugin'] == 'block' and so.get('readonly'):
+        options.append('readonly=true')
+    if so['plugin'] != 'pscsi' and so.get('wwn'):
+        options.append('wwn=%s' % so['wwn'])
+    return ' '.join(options)
+
+
+def desired_state(data, scope):
+    '''
+    Desired state for plan() from saveconfig data limited to scope, returns (desired, backstore keys filter, target filter).
+    '''
+    saved = from_saveconfig(data)
+    options = dict(('%(plugin)s/%(name)s' % so, backstore_options(so)) for so in data.get('storage_objects', []))
+    target_scope = scope.get('targets') if scope else None
+    backstore_scope = scope.get('backstores') if scope else None
+
+    desired = {'backstores': {}, 'targets': None}
+    referenced = set()
+    if not scope or target_scope is not None:
+        desired['targets'] = {}
+        for wwn, target in sorted(saved['targets'].items()):
+            if target_scope is not None and wwn not in target_scope:
+                continue
+            for tpg in target['tpgs'].values():
+                tpg['luns'] = dict((lun['backstore'], {'index': lun['index']}) for lun in tpg['luns'].values())
+                referenced.update(tpg['luns'])
+            desired['targets'][wwn] = {'wwn': wwn, 'tpgs': target['tpgs'] or {'tpg1': new_tpg(1)}}
+
+    def backstore_filter(key):
+        return not scope or key in referenced or (backstore_scope is not None and in_scope(key, backstore_scope))
+
+    def target_filter(wwn):
+        return not scope or (target_scope is not None and wwn in target_scope)
+
+    for key, bs in sorted(saved['backstores'].items()):
+        if backstore_filter(key):
+            desired['backstores'][key] = dict(bs, options=options[key])
+
+    return desired, backstore_filter, target_filter
+
+
+def scoped_state(current, backstore_filter, target_filter):
+    '''
+    Part of the live state the restore may change, purge works only within it.
+    '''
+    state = new_state()
+    state['backstores'] = dict((k, v) for k, v in current['backstores'].items() if backstore_filter(k))
+    state['targets'] = dict((k, v) for k, v in current['targets'].items() if target_filter(k))
+    return state
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            src=dict(type='path', required=True),
+            scope=dict(type='dict', required=False, options=dict(
+                targets=dict(type='list', elements='str', required=False),
+                backstores=dict(type='list', elements='str', required=False),
+            )),
+            purge=dict(type='bool', default=False),
+            transactional=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            save=dict(default='immediate', choices=['immediate', 'deferred', 'never']),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
+        ),
+        supports_check_mode=True
+    )
+
+    try:
+        with open(module.params['src']) as f:
+            content = f.read()
+        data = json.loads(content) if content.strip() else {}
+        for target in data.get('targets', []):
+            for tpg in target.get('tpgs', []):
+                for acl in tpg.get('node_acls', []):
+                    for key in ('chap_password', 'chap_mutual_password'):
+                        if acl.get(key):
+                            module.no_log_values.add(acl[key])
+        desired, backstore_filter, target_filter = desired_state(data, module.params['scope'])
+    except (IOError, OSError) as e:
+        module.fail_json(msg="Failed to read %s - %s" % (module.params['src'], e))
+    except (ValueError, KeyError, TypeError) as e:
+        module.fail_json(msg="Invalid saveconfig file %s - %s" % (module.params['src'], e))
+
+    result = {'changed': False}
+    # LUN mappings and portals come only from the file
+    session = new_session(module, prefs={'auto_add_default_portal': 'false', 'auto_add_mapped_luns': 'false'})
+
+    try:
+        before = snapshot(session, attributes=True)
+        current = scoped_state(before, backstore_filter, target_filter)
+        changes = plan(current, desired, module.params['purge'])
+        result['changed'] = bool(changes)
+        result['changes'] = changes
+        if module._diff:
+            result['diff'] = diff(changes)
+        if changes and not module.check_mode:
+            failed = apply(session, changes)
+            if failed is not None:
+                change, out, err = failed
+                msg = "Failed to restore configuration using command " + change['command']
+                if module.params['transactional']:
+                    result['rollback'] = rollback(session, before, [c['path'] for c in changes if c.get('done')] + [change['path']])
+                    msg += ", changes were rolled back" if rolled_back(result['rollback']) else ", rollback failed"
+                session.close()
+                module.fail_json(msg=msg, output=out, error=err, **result)
+        rc, out, err = session.close()
+        if rc != 0:
+            module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
+    except TargetCLIStateError as e:
+        module.fail_json(msg=str(e))
+    except OSError as e:
+        module.fail_json(msg="Failed to restore targetcli configuration - %s" % (e))
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_session import new_session
+from ansible.module_utils.targetcli_state import (TargetCLIStateError, apply, diff, from_saveconfig, in_scope, new_state, new_tpg,
+                                                  plan, rollback, rolled_back, snapshot)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: targetcli_save
+short_description: TargetCLI save configuration module
+description:
+     - module for saving the live targetcli configuration ('saveconfig') after tasks that used 'save: deferred'.
+     - configuration is saved only when some deferred save is pending (the marker /run/ansible-targetcli/unsaved
+       exists), otherwise the module does nothing and targetcli is not started.
+version_added: "2.0"
+options:
+  force:
+    description:
+      - Save the configuration even when there is no pending deferred save
+    required: false
+    default: false
+    type: bool
+  engine:
+    description:
+      - Engine used for saving the configuration, targetcli runs one targetcli process,
+        rtslib uses rtslib-fb library directly in the module process, auto uses rtslib when it is
+        installed and falls back to targetcli otherwise
+    required: false
+    default: auto
+    choices: [auto, targetcli, rtslib]
+    type: str
+  lock_timeout:
+    description:
+      - Seconds to wait for host-wide lock (/run/ansible-targetcli/lock) held by other module run
+        (another play or async task) before failing, the module retries with growing delay
+      - When the module run would save and another run that saves is waiting for the lock the save is
+        left to that run, so concurrent runs share one save
+    required: false
+    default: 300
+    type: int
+  profile:
+    description:
+      - Add 'perf' key to the result with duration, return code and output size of every targetcli
+        command (or rtslib call and configfs lookup), number of started targetcli processes and totals
+    required: false
+    default: false
+    type: bool
+  profile_file:
+    description:
+      - With profile, also append the 'perf' data of the task as one JSON line to this file on the managed host
+    required: false
+    type: path
+notes:
+   - Tested on CentOS 7.7
+   - Intended to be used as handler notified by the tasks with 'save: deferred', it is also cheap enough
+     to be run unconditionally at the end of the play.
+requirements: [ ]
+author: "Ondrej Famera (@OndrejHome)"
+'''
+
+EXAMPLES = '''
+- name: define backstores without saving the configuration after each of them
+  targetcli_backstore:
+    backstore_type: 'block'
+    backstore_name: "{{ item.name }}"
+    options: "{{ item.dev }}"
+    save: deferred
+  loop: "{{ luns }}"
+  notify: save targetcli configuration
+
+# handlers:
+- name: save targetcli configuration
+  targetcli_save:
+'''
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            force=dict(type='bool', default=False),
+            engine=dict(default='auto', choices=['auto', 'targetcli', 'rtslib']),
+            lock_timeout=dict(type='int', default=300),
+            profile=dict(type='bool', default=False),
+            profile_file=dict(type='path'),
+        ),
+        supports_check_mode=True
+    )
+
+    # hooked before the early exit so that even no-op runs report perf
+    get_profiler(module)
+    result = {'changed': False}
+    if not module.params['force'] and not has_unsaved():
+        module.exit_json(**result)
+
+    result['changed'] = True
+    if not module.check_mode:
+        session = new_session(module)
+        try:
+            rc, out, err = session.save()
+            session.close()
+            if rc != 0:
+                module.fail_json(msg="Failed to save targetcli configuration", output=out, error=err)
+        except OSError as e:
+            module.fail_json(msg="Failed to save targetcli configuration - %s" % (e))
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.targetcli_profile import get_profiler
+from ansible.module_utils.targetcli_runtime import has_unsaved
+from ansible.module_utils.targetcli_session import new_session
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import errno
+import json
+import os
+import socket
+
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.targetcli_runtime import RUNTIME_DIR
+
+# Unix socket of the agent started by targetcli_agent module
+AGENT_SOCKET = os.path.join(RUNTIME_DIR, 'agent.sock')
+
+# agent exits when no client connected for this many seconds
+AGENT_IDLE_TIMEOUT = 600
+
+# how long client waits for the agent that serves somebody else
+AGENT_CLIENT_TIMEOUT = 600
+
+
+class AgentError(Exception):
+    pass
+
+
+def send(conn, message):
+    conn.sendall(to_bytes(json.dumps(message) + '\n'))
+
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        raise AgentError('agent closed the connection')
+    return json.loads(to_text(line))
+
+
+class AgentClient(object):
+    '''
+    Connection to the agent, the agent serves one connection at a time so
+    everything done through one client is serialized with other clients.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.stream = conn.makefile('rb')
+
+    @classmethod
+    def connect(cls, path=AGENT_SOCKET, timeout=AGENT_CLIENT_TIMEOUT):
+        '''
+        Return connected client or None when there is no agent listening on the path.
+        '''
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(timeout)
+        try:
+            conn.connect(path)
+        except (IOError, OSError) as e:
+            conn.close()
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK):
+                return None
+            raise
+        return cls(conn)
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        try:
+            send(self.conn, kwargs)
+            reply = receive(self.stream)
+        except (IOError, OSError, ValueError) as e:
+            raise AgentError('agent request %s failed - %s' % (op, e))
+        if 'error' in reply:
+            raise AgentError(reply['error'])
+        return reply
+
+    def hello(self, prefs):
+        return self.request('hello', prefs=prefs)
+
+    def run(self, command):
+        reply = self.request('run', cmd=command)
+        return reply['rc'], reply['out'], reply['err']
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+    def close(self):
+        try:
+            self.stream.close()
+            self.conn.close()
+        except (IOError, OSError):
+            pass
+
+
+def agent_info(path=AGENT_SOCKET):
+    '''
+    Return hello reply of running agent (pid, engine, idle_timeout) or None.
+    '''
+    try:
+        client = AgentClient.connect(path, timeout=5)
+    except (IOError, OSError):
+        return None
+    if client is None:
+        return None
+    try:
+        return client.hello({})
+    except AgentError:
+        return None
+    finally:
+        client.close()
+
+
+class AgentServer(object):
+    '''
+    Keeps one session (rtslib object tree or targetcli process) alive and
+    executes commands of clients connecting over the Unix socket.
+
+    Protocol is one JSON object per line in both directions: 'hello' (with
+    targetcli preferences of the client), 'run' (one command, reply has rc,
+    out and err like session.run()) and 'shutdown'. Connections are served
+    one at a time, whole module run is one connection, so writes of
+    different clients never interleave. Saving is left to the clients.
+    The agent exits when nobody connected for idle_timeout seconds.
+    '''
+
+    def __init__(self, session, engine, path=AGENT_SOCKET, idle_timeout=AGENT_IDLE_TIMEOUT):
+        self.session = session
+        self.engine = engine
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.stopping = False
+        self.inode = None
+
+    def listen(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.inode = os.stat(self.path).st_ino
+        sock.listen(64)
+        sock.settimeout(self.idle_timeout)
+        return sock
+
+    def serve(self, sock=None):
+        sock = sock or self.listen()
+        try:
+            while not self.stopping:
+                try:
+                    conn, address = sock.accept()
+                except socket.timeout:
+                    break
+                try:
+                    self.handle(conn)
+                except (IOError, OSError, ValueError):
+                    # client went away or sent garbage, next one
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            try:
+                # unless another agent took the path over already
+                if os.stat(self.path).st_ino == self.inode:
+                    os.unlink(self.path)
+            except OSError:
+                pass
+            self.session.close()
+
+    def handle(self, conn):
+        conn.settimeout(self.idle_timeout)
+        stream = conn.makefile('rb')
+        # every client starts with hello that sets its preferences
+        self.session.history = []
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            request = json.loads(to_text(line))
+            op = request.get('op')
+            if op == 'hello':
+                self.session.set_prefs(request.get('prefs') or {})
+                send(conn, {'pid': os.getpid(), 'engine': self.engine, 'idle_timeout': self.idle_timeout})
+            elif op == 'run':
+                rc, out, err = self.session.run(request['cmd'])
+                send(conn, {'rc': rc, 'out': out, 'err': err})
+                if self.engine == 'targetcli' and not self.session.alive():
+                    # targetcli process died, let the next client start a fresh agent
+                    self.stopping = True
+            elif op == 'shutdown':
+                self.stopping = True
+                send(conn, {'stopping': True})
+                return
+            else:
+                send(conn, {'error': 'unknown request %s' % op})
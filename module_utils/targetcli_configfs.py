@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import json
+import os
+import re
+import resource
+
+from ansible.module_utils.targetcli_state import from_saveconfig, new_state, new_tpg, portal_name
+
+CONFIGFS_ROOT = '/sys/kernel/config/target'
+SAVECONFIG = '/etc/target/saveconfig.json'
+
+# configfs HBA plugin -> targetcli backstore type
+BACKSTORE_PLUGINS = {
+    'iblock': 'block',
+    'fileio': 'fileio',
+    'pscsi': 'pscsi',
+    'rd_mcp': 'ramdisk',
+    'user': 'user',
+}
+
+# configfs auth file -> saveconfig chap_ suffix
+AUTH_FILES = {
+    'userid': 'userid',
+    'password': 'password',
+    'userid_mutual': 'mutual_userid',
+    'password_mutual': 'mutual_password',
+}
+
+HBA_DIR = re.compile(r'^(\w+)_(\d+)$')
+
+
+def read_file(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except (IOError, OSError):
+        return []
+
+
+class ConfigFS(object):
+    '''
+    Read-only view of the live target configuration in configfs, no targetcli involved.
+
+    Paths used by the lookups are targetcli paths ('/backstores/block/test1',
+    '/iscsi/<wwn>/tpg1/luns/lun0', ...), results have the shape of targetcli_state.
+    '''
+
+    def __init__(self, root=CONFIGFS_ROOT):
+        self.root = root
+
+    def available(self):
+        return os.path.isdir(os.path.join(self.root, 'core'))
+
+    def hbas(self):
+        '''
+        Yield (backstore type, hba directory) for every HBA in configfs.
+        '''
+        core = os.path.join(self.root, 'core')
+        for name in listdir(core):
+            match = HBA_DIR.match(name)
+            if match and match.group(1) in BACKSTORE_PLUGINS:
+                yield BACKSTORE_PLUGINS[match.group(1)], os.path.join(core, name)
+
+    def backstore_dir(self, backstore_type, backstore_name):
+        for bs_type, hba in self.hbas():
+            if bs_type == backstore_type and os.path.isdir(os.path.join(hba, backstore_name)):
+                return os.path.join(hba, backstore_name)
+        return None
+
+    def tpg_dir(self, wwn, tag):
+        return os.path.join(self.root, 'iscsi', wwn, 'tpgt_%d' % tag)
+
+    def exists(self, path):
+        '''
+        Check whether targetcli path exists (replacement for targetcli '<path> status').
+        '''
+        parts = [p for p in path.split('/') if p]
+        if not parts:
+            return True
+        if parts[0] == 'backstores':
+            if len(parts) == 3:
+                return self.backstore_dir(parts[1], parts[2]) is not None
+            return len(parts) < 3
+        if parts[0] != 'iscsi':
+            return False
+        if len(parts) == 1:
+            return True
+        fs_path = os.path.join(self.root, 'iscsi', parts[1])
+        if len(parts) > 2:
+            match = re.match(r'^tpg(\d+)$', parts[2])
+            if not match:
+                return False
+            fs_path = self.tpg_dir(parts[1], int(match.group(1)))
+        if len(parts) > 3:
+            sub = {'luns': 'lun', 'acls': 'acls', 'portals': 'np'}.get(parts[3])
+            if sub is None:
+                return False
+            fs_path = os.path.join(fs_path, sub)
+        if len(parts) > 4:
+            name = parts[4]
+            if parts[3] == 'luns':
+                name = re.sub(r'^lun(\d+)$', r'lun_\1', name)
+            fs_path = os.path.join(fs_path, name)
+        if len(parts) > 5:
+            return False
+        return os.path.isdir(fs_path)
+
+    def read_attributes(self, path, names=None):
+        attributes = {}
+        attrib = os.path.join(path, 'attrib')
+        for name in listdir(attrib) if names is None else names:
+            value = read_file(os.path.join(attrib, name))
+            if value is not None:
+                attributes[name] = value
+        return attributes
+
+    def object_attributes(self, path, names=None):
+        '''
+        Attributes of backstore or TPG given by targetcli path, only the named ones when given.
+        '''
+        parts = [p for p in path.split('/') if p]
+        if len(parts) == 3 and parts[0] == 'backstores':
+            directory = self.backstore_dir(parts[1], parts[2])
+        elif len(parts) == 3 and parts[0] == 'iscsi' and re.match(r'^tpg\d+$', parts[2]):
+            directory = self.tpg_dir(parts[1], int(parts[2][3:]))
+        else:
+            directory = None
+        if directory is None or not os.path.isdir(directory):
+            return None
+        return self.read_attributes(directory, names)
+
+    def read_size(self, so_dir):
+        '''
+        Size in bytes of fileio or ramdisk backstore from its 'info', None for other backstores.
+        '''
+        info = read_file(os.path.join(so_dir, 'info'), '')
+        size = re.search(r'\bSize: (\d+)', info)
+        if size:
+            return int(size.group(1))
+        pages = re.search(r'PAGES/PAGE_SIZE Per SG: (\d+)\s+SG_table_count: (\d+)', info)
+        if pages:
+            return int(pages.group(1)) * int(pages.group(2)) * resource.getpagesize()
+        return None
+
+    def read_backstores(self, attributes=True):
+        backstores = {}
+        for bs_type, hba in self.hbas():
+            for name in listdir(hba):
+                so_dir = os.path.join(hba, name)
+                if not os.path.isdir(so_dir):
+                    continue
+                wwn = read_file(os.path.join(so_dir, 'wwn', 'vpd_unit_serial'))
+                if wwn and ':' in wwn:
+                    wwn = wwn.split(':', 1)[1].strip()
+                backstores['%s/%s' % (bs_type, name)] = {
+                    'type': bs_type,
+                    'name': name,
+                    'dev': read_file(os.path.join(so_dir, 'udev_path')) or None,
+                    'size': self.read_size(so_dir),
+                    'wwn': wwn,
+                    'attributes': self.read_attributes(so_dir) if attributes else {},
+                }
+        return backstores
+
+    def read_luns(self, tpg_dir):
+        '''
+        Return {'lun0': {'index': 0, 'backstore': 'block/test1'}} for TPG directory.
+        '''
+        luns = {}
+        lun_root = os.path.join(tpg_dir, 'lun')
+        for name in listdir(lun_root):
+            if not name.startswith('lun_'):
+                continue
+            backstore = None
+            for entry in listdir(os.path.join(lun_root, name)):
+                link = os.path.join(lun_root, name, entry)
+                if os.path.islink(link):
+                    hba, so_name = os.readlink(link).rstrip('/').split('/')[-2:]
+                    match = HBA_DIR.match(hba)
+                    if match and match.group(1) in BACKSTORE_PLUGINS:
+                        backstore = '%s/%s' % (BACKSTORE_PLUGINS[match.group(1)], so_name)
+            index = int(name[len('lun_'):])
+            luns['lun%d' % index] = {'index': index, 'backstore': backstore}
+        return luns
+
+    def read_portals(self, tpg_dir):
+        portals = {}
+        for name in listdir(os.path.join(tpg_dir, 'np')):
+            ip_address, port = name.rsplit(':', 1)
+            portals[portal_name(ip_address, port)] = {'ip_address': ip_address, 'port': int(port)}
+        return portals
+
+    def read_acls(self, tpg_dir):
+        acls = {}
+        acl_root = os.path.join(tpg_dir, 'acls')
+        for wwn in listdir(acl_root):
+            acl_dir = os.path.join(acl_root, wwn)
+            mapped_luns = {}
+            for name in listdir(acl_dir):
+                if not name.startswith('lun_'):
+                    continue
+                index = int(name[len('lun_'):])
+                tpg_lun = None
+                for entry in listdir(os.path.join(acl_dir, name)):
+                    link = os.path.join(acl_dir, name, entry)
+                    if os.path.islink(link):
+                        tpg_lun = int(os.readlink(link).rstrip('/').split('/')[-1][len('lun_'):])
+                mapped_luns['mapped_lun%d' % index] = {
+                    'index': index,
+                    'tpg_lun': tpg_lun,
+                    'write_protect': read_file(os.path.join(acl_dir, name, 'write_protect'), '0') == '1',
+                }
+            auth = {}
+            for fs_name, name in AUTH_FILES.items():
+                value = read_file(os.path.join(acl_dir, 'auth', fs_name))
+                if value:
+                    auth[name] = value
+            acls[wwn] = {'wwn': wwn, 'mapped_luns': mapped_luns, 'auth': auth}
+        return acls
+
+    def read_tpg(self, wwn, tag, attributes=True):
+        '''
+        Return one TPG of iSCSI target or None when it doesn't exist.
+        '''
+        tpg_dir = self.tpg_dir(wwn, tag)
+        if not os.path.isdir(tpg_dir):
+            return None
+        tpg = new_tpg(tag)
+        tpg['enable'] = read_file(os.path.join(tpg_dir, 'enable')) == '1'
+        tpg['attributes'] = self.read_attributes(tpg_dir) if attributes else {}
+        tpg['luns'] = self.read_luns(tpg_dir)
+        tpg['acls'] = self.read_acls(tpg_dir)
+        tpg['portals'] = self.read_portals(tpg_dir)
+        return tpg
+
+    def read_target(self, wwn, attributes=True):
+        '''
+        Return iSCSI target with all its TPGs or None when it doesn't exist.
+        '''
+        target_dir = os.path.join(self.root, 'iscsi', wwn)
+        if wwn == 'discovery_auth' or not os.path.isdir(target_dir):
+            return None
+        tpgs = {}
+        for name in listdir(target_dir):
+            if name.startswith('tpgt_'):
+                tag = int(name[len('tpgt_'):])
+                tpgs['tpg%d' % tag] = self.read_tpg(wwn, tag, attributes)
+        return {'wwn': wwn, 'tpgs': tpgs}
+
+    def read_targets(self, attributes=True):
+        targets = {}
+        for wwn in listdir(os.path.join(self.root, 'iscsi')):
+            target = self.read_target(wwn, attributes)
+            if target is not None:
+                targets[wwn] = target
+        return targets
+
+    def read_fabric_luns(self):
+        '''
+        Return {'/loopback/<wwn>/tpg1/luns/lun0': 'block/test1'} for LUNs of the fabrics other than iSCSI.
+        '''
+        fabric_luns = {}
+        for fabric in listdir(self.root):
+            if fabric in ('core', 'iscsi') or not os.path.isdir(os.path.join(self.root, fabric)):
+                continue
+            for wwn in listdir(os.path.join(self.root, fabric)):
+                for name in listdir(os.path.join(self.root, fabric, wwn)):
+                    if not name.startswith('tpgt_'):
+                        continue
+                    luns = self.read_luns(os.path.join(self.root, fabric, wwn, name))
+                    for lun_name, lun in luns.items():
+                        path = '/%s/%s/tpg%s/luns/%s' % (fabric, wwn, name[len('tpgt_'):], lun_name)
+                        fabric_luns[path] = lun['backstore']
+        return fabric_luns
+
+    def read(self, attributes=True):
+        state = new_state()
+        state['backstores'] = self.read_backstores(attributes)
+        state['targets'] = self.read_targets(attributes)
+        fabric_luns = self.read_fabric_luns()
+        if fabric_luns:
+            state['fabric_luns'] = fabric_luns
+        return state
+
+
+def read_state(root=CONFIGFS_ROOT, savefile=SAVECONFIG, attributes=True):
+    '''
+    Return (state, source) from configfs or from saved configuration when configfs is not available.
+    '''
+    configfs = ConfigFS(root)
+    if configfs.available():
+        return configfs.read(attributes), 'configfs'
+    if savefile and os.path.isfile(savefile):
+        with open(savefile) as f:
+            content = f.read()
+        state = from_saveconfig(json.loads(content) if content.strip() else {})
+        if not attributes:
+            for bs in state['backstores'].values():
+                bs['attributes'] = {}
+            for target in state['targets'].values():
+                for tpg in target['tpgs'].values():
+                    tpg['attributes'] = {}
+        return state, 'saveconfig'
+    return new_state(), 'none'
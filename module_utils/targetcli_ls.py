@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import re
+
+from ansible.module_utils.targetcli_state import new_state, new_tpg, portal_name
+
+# 'o- name ........ [description]', tree is drawn with '| ' and '  ' in front of it
+LS_LINE = re.compile(r'^(?P<indent>[ |]*)o- (?P<rest>.*)$')
+LS_DESCRIPTION = re.compile(r'^(?P<name>.*?)(?: \.+)? \[(?P<description>.*)\]$')
+LS_NAME = re.compile(r'^(?P<name>.*?)(?: \.+)?$')
+
+TPG_NAME = re.compile(r'^tpg(\d+)$')
+INDEX_NAME = re.compile(r'^(?:lun|mapped_lun)(\d+)$')
+
+
+def parse_backstore_description(description):
+    '''
+    Split '/dev/c7vg/LV1 (1.0GiB) write-thru activated' into its parts, the known fields are taken from
+    the end so that file paths with spaces ('/var/lib/my disk.img (1.0GiB) ...') stay whole.
+    '''
+    info = {'dev': None, 'size': None, 'write_mode': None, 'status': None}
+    tokens = description.split(' ')
+    while tokens:
+        token = tokens[-1]
+        if token in ('activated', 'deactivated') and info['status'] is None:
+            info['status'] = token
+        elif token in ('write-thru', 'write-back') and info['write_mode'] is None:
+            info['write_mode'] = token
+        elif token.startswith('(') and token.endswith(')') and info['size'] is None:
+            info['size'] = token[1:-1]
+        else:
+            break
+        tokens.pop()
+    info['dev'] = ' '.join(tokens) or None
+    return info
+
+
+class TargetCLITree(object):
+    '''
+    Output of 'targetcli <path> ls' parsed into nodes keyed by targetcli path.
+
+    Every node is {'path', 'name', 'description', 'children'} (children are
+    names in the listed order). Lookups that modules need (LUN of backstore,
+    portals, ACLs, backstores) are indexed while parsing so each of them is
+    one dict access regardless of the size of the tree.
+    '''
+
+    def __init__(self, output, path='/'):
+        self.nodes = {}
+        self.backstores = {}
+        self.tpgs = {}
+        self._parse(output, path.rstrip('/') or '/')
+
+    @staticmethod
+    def join(parent, name):
+        return '/' + name if parent == '/' else parent + '/' + name
+
+    def _parse(self, output, path):
+        # stack of paths, stack[depth] is the last node seen at that depth
+        stack = []
+        base = None
+        for line in output.splitlines():
+            match = LS_LINE.match(line)
+            if not match:
+                continue
+            depth = len(match.group('indent')) // 2
+            rest = match.group('rest').rstrip()
+            described = LS_DESCRIPTION.match(rest)
+            if described:
+                name, description = described.group('name'), described.group('description')
+            else:
+                name, description = LS_NAME.match(rest).group('name'), ''
+            if base is None:
+                base = depth
+                node_path = path
+            else:
+                del stack[depth - base:]
+                if not stack:
+                    # another top level node, output doesn't belong to one ls
+                    continue
+                node_path = self.join(stack[-1], name)
+                self.nodes[stack[-1]]['children'].append(name)
+            stack.append(node_path)
+            self.nodes[node_path] = {'path': node_path, 'name': name, 'description': description, 'children': []}
+            self._index(node_path, name, description)
+
+    def tpg(self, tpg_path):
+        if tpg_path not in self.tpgs:
+            parts = tpg_path.split('/')
+            self.tpgs[tpg_path] = new_tpg(int(TPG_NAME.match(parts[3]).group(1)))
+            self.tpgs[tpg_path]['wwn'] = parts[2]
+        return self.tpgs[tpg_path]
+
+    def _index(self, path, name, description):
+        parts = path.split('/')
+        # ['', 'backstores', type, name] and ['', 'iscsi', wwn, 'tpgN', 'luns', 'lunN'], ...
+        if len(parts) == 4 and parts[1] == 'backstores':
+            info = parse_backstore_description(description)
+            info.update({'type': parts[2], 'name': name})
+            self.backstores['%s/%s' % (parts[2], name)] = info
+            return
+        if len(parts) < 4 or parts[1] != 'iscsi' or not TPG_NAME.match(parts[3]):
+            return
+        tpg = self.tpg('/'.join(parts[:4]))
+        index = INDEX_NAME.match(name)
+        if len(parts) == 6 and parts[4] == 'luns' and index:
+            backstore = description.split(' ', 1)[0]
+            tpg['luns'][name] = {'index': int(index.group(1)), 'backstore': backstore}
+            tpg.setdefault('lun_by_backstore', {})[backstore] = int(index.group(1))
+        elif len(parts) == 6 and parts[4] == 'portals' and ':' in name:
+            ip_address, port = name.rsplit(':', 1)
+            tpg['portals'][portal_name(ip_address, port)] = {'ip_address': ip_address, 'port': int(port)}
+        elif len(parts) == 6 and parts[4] == 'acls':
+            tpg['acls'][name] = {'wwn': name, 'mapped_luns': {}, 'auth': {}}
+        elif len(parts) == 7 and parts[4] == 'acls' and index and parts[5] in tpg['acls']:
+            # 'lun0 block/test1 (rw)'
+            fields = description.split()
+            tpg_lun = INDEX_NAME.match(fields[0]) if fields else None
+            tpg['acls'][parts[5]]['mapped_luns'][name] = {
+                'index': int(index.group(1)),
+                'tpg_lun': int(tpg_lun.group(1)) if tpg_lun else None,
+                'write_protect': fields[-1] == '(ro)' if fields else False,
+            }
+
+    def get(self, path):
+        return self.nodes.get(path.rstrip('/') or '/')
+
+    def exists(self, path):
+        return (path.rstrip('/') or '/') in self.nodes
+
+    def backstore(self, backstore_type, backstore_name):
+        return self.backstores.get('%s/%s' % (backstore_type, backstore_name))
+
+    def lun_id(self, tpg_path, backstore):
+        '''
+        Index of LUN exporting backstore ('block/test1') in TPG or None.
+        '''
+        return self.tpgs.get(tpg_path, {}).get('lun_by_backstore', {}).get(backstore)
+
+    def luns(self, tpg_path):
+        '''
+        Return {backstore: LUN index} of TPG.
+        '''
+        return dict(self.tpgs.get(tpg_path, {}).get('lun_by_backstore', {}))
+
+    def portals(self, tpg_path):
+        return self.tpgs.get(tpg_path, {}).get('portals', {})
+
+    def acls(self, tpg_path):
+        return self.tpgs.get(tpg_path, {}).get('acls', {})
+
+    def to_state(self):
+        '''
+        Convert the tree into the state shape of targetcli_state (without attributes and auth, ls doesn't show them).
+        '''
+        state = new_state()
+        for key, info in self.backstores.items():
+            state['backstores'][key] = {'type': info['type'], 'name': info['name'], 'dev': info['dev'],
+                                        'size': None, 'wwn': None, 'attributes': {}}
+        for path, node in self.nodes.items():
+            parts = path.split('/')
+            if len(parts) == 3 and parts[1] == 'iscsi':
+                state['targets'][parts[2]] = {'wwn': parts[2], 'tpgs': {}}
+        for tpg_path, tpg in self.tpgs.items():
+            item = dict((k, v) for k, v in tpg.items() if k not in ('wwn', 'lun_by_backstore'))
+            state['targets'].setdefault(tpg['wwn'], {'wwn': tpg['wwn'], 'tpgs': {}})
+            state['targets'][tpg['wwn']]['tpgs'][tpg_path.split('/')[3]] = item
+        return state
+
+
+def parse_ls(output, path='/'):
+    '''
+    Parse output of 'targetcli <path> ls', path is the node the listing starts at.
+    '''
+    return TargetCLITree(output, path)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import json
+import platform
+import time
+
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.basic import remove_values
+
+
+class Profiler(object):
+    '''
+    Timing of everything a session did during one module run.
+
+    Every command (targetcli or rtslib) and every existence check answered
+    from configfs or the host cache is recorded with its duration, rc and
+    size of its output, targetcli process starts are counted separately.
+    The report is added as 'perf' key to the module result and optionally
+    appended as one JSON line to a file.
+    '''
+
+    def __init__(self, module, path=None):
+        self.module = module
+        self.path = path
+        self.engine = None
+        self.commands = []
+        self.spawns = 0
+        self.spawn_time = 0.0
+        self.started = time.time()
+
+    def record(self, command, rc, out, duration, source):
+        self.commands.append({
+            'cmd': command,
+            'source': source,
+            'rc': rc,
+            'duration': round(duration, 6),
+            'stdout_bytes': len(to_bytes(out or '')),
+        })
+
+    def spawn(self, duration):
+        self.spawns += 1
+        self.spawn_time += duration
+
+    def report(self):
+        return {
+            'engine': self.engine,
+            'commands': self.commands,
+            'spawns': self.spawns,
+            'spawn_time': round(self.spawn_time, 6),
+            'totals': {
+                'commands': len(self.commands),
+                'nonzero_rc': len([c for c in self.commands if c['rc'] != 0]),
+                'duration': round(sum(c['duration'] for c in self.commands), 6),
+                'stdout_bytes': sum(c['stdout_bytes'] for c in self.commands),
+                'wall': round(time.time() - self.started, 6),
+            },
+        }
+
+    def write(self, perf, result):
+        '''
+        Append the report as one JSON line to the profile file (commands with no_log values masked).
+        '''
+        entry = {
+            'time': time.time(),
+            'host': platform.node(),
+            'module': getattr(self.module, '_name', None),
+            'changed': result.get('changed', False),
+            'failed': result.get('failed', False),
+            'perf': perf,
+        }
+        line = json.dumps(remove_values(entry, self.module.no_log_values), sort_keys=True) + '\n'
+        try:
+            with open(self.path, 'ab') as f:
+                f.write(to_bytes(line))
+        except (IOError, OSError) as e:
+            self.module.warn('Failed to write profile to %s - %s' % (self.path, e))
+
+
+def get_profiler(module):
+    '''
+    Return Profiler of the module run when 'profile' parameter is true, None otherwise.
+
+    First call hooks module's exit_json() and fail_json() so that every
+    result (including failures) carries the 'perf' key.
+    '''
+    if not module.params.get('profile'):
+        return None
+    profiler = getattr(module, '_targetcli_profiler', None)
+    if profiler is not None:
+        return profiler
+    profiler = Profiler(module, module.params.get('profile_file'))
+    module._targetcli_profiler = profiler
+
+    def hook(method):
+        def wrapper(*args, **kwargs):
+            kwargs['perf'] = profiler.report()
+            if profiler.path:
+                profiler.write(kwargs['perf'], dict(kwargs, failed=method == fail_json))
+            method(*args, **kwargs)
+        return wrapper
+
+    exit_json, fail_json = module.exit_json, module.fail_json
+    module.exit_json = hook(exit_json)
+    module.fail_json = hook(fail_json)
+    return profiler
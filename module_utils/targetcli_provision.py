@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from ansible.module_utils.targetcli_rtslib import COMMAND_ARGS, CommandError, bind, create_backing_file, human_to_bytes, to_bool
+
+# default number of image files created in parallel
+PROVISION_WORKERS = 4
+
+
+def fileio_file(options):
+    '''
+    Return (path, size in bytes, sparse) of image file that fileio backstore create with these options
+    would create, None when it wouldn't create any (existing file or device, no size, relative path).
+    '''
+    pparams = []
+    kparams = {}
+    for part in (options or '').split():
+        if '=' in part:
+            key, value = part.split('=', 1)
+            kparams[key] = value
+        else:
+            pparams.append(part)
+    args = bind(COMMAND_ARGS[('backstore_type', 'create', 'fileio')][1:], pparams, kparams)
+    path = os.path.expanduser(args.get('file_or_dev') or '')
+    if not os.path.isabs(path) or os.path.exists(path) or not args.get('size'):
+        return None
+    return path, human_to_bytes(args['size']), to_bool(args.get('sparse'), True)
+
+
+def create_file(spec):
+    '''
+    Create one image file, returns spec with duration and error (None on success).
+    '''
+    started = time.time()
+    error = None
+    try:
+        create_backing_file(spec['path'], spec['size'], spec['sparse'])
+    except (IOError, OSError) as e:
+        error = str(e)
+    return dict(spec, duration=round(time.time() - started, 6), error=error)
+
+
+def provision(specs, workers=PROVISION_WORKERS, progress=None):
+    '''
+    Create image files (dicts with backstore, path, size, sparse) with a pool of worker threads,
+    sparse files are only sized, the others get all blocks allocated (fallocate).
+    progress is called with every finished file (spec with duration and error) as it finishes.
+
+    Returns the specs with duration of every file in the order they were given and error of the failed
+    ones. When any file failed, the files created by this call are removed again, so that a retry
+    starts from the same state.
+    '''
+    if not specs:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(specs))))
+    done = []
+    try:
+        for item in pool.imap_unordered(create_file, specs):
+            if progress is not None:
+                progress(item)
+            done.append(item)
+    finally:
+        pool.close()
+        pool.join()
+    order = dict((s['path'], i) for i, s in enumerate(specs))
+    done.sort(key=lambda item: order[item['path']])
+    if [d for d in done if d['error']]:
+        for item in done:
+            if not item['error']:
+                try:
+                    os.unlink(item['path'])
+                except OSError:
+                    pass
+    return done
+
+
+def fileio_specs(backstores):
+    '''
+    Image files to create for (type, name, options) dicts of fileio backstores that are going to be created.
+    '''
+    specs = []
+    paths = set()
+    for backstore in backstores:
+        try:
+            found = fileio_file(backstore['options'])
+        except CommandError:
+            # left to targetcli to report
+            continue
+        if found is not None and found[0] not in paths:
+            paths.add(found[0])
+            specs.append({'backstore': '%(backstore_type)s/%(backstore_name)s' % backstore,
+                          'path': found[0], 'size': found[1], 'sparse': found[2]})
+    return specs
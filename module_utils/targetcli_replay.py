@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import collections
+import fcntl
+import gzip
+import json
+import os
+import re
+
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.basic import remove_values
+
+# fixture file the sessions append their targetcli commands and replies to
+RECORD_ENV = 'ANSIBLE_TARGETCLI_RECORD'
+# fixture file the sessions answer commands from instead of running targetcli
+REPLAY_ENV = 'ANSIBLE_TARGETCLI_REPLAY'
+
+# configfs root that never exists, recording and replay send every read through targetcli commands
+NO_CONFIGFS = '/nonexistent/ansible-targetcli-replay'
+
+# temporary file of 'saveconfig savefile=...' differs between runs, its content is part of the reply
+SAVEFILE = re.compile(r'\bsavefile=(\S+)')
+SAVEFILE_PLACEHOLDER = 'savefile=<savefile>'
+
+# CHAP secrets never get into fixtures, in commands and replies ('set auth password=...', 'get auth')
+# and in saved configuration (chap_password, chap_mutual_password, discovery_password, ...)
+SECRET = re.compile(r'\b((?:mutual_)?password)=(\S+)')
+SECRET_MASK = '********'
+
+
+class ReplayError(Exception):
+    pass
+
+
+def mask_secrets(text):
+    return SECRET.sub(r'\1=' + SECRET_MASK, text)
+
+
+def mask_saveconfig(content):
+    '''
+    Saved configuration with the values of all password keys masked, content that isn't JSON is kept.
+    '''
+    def scrub(item):
+        if isinstance(item, dict):
+            return dict((k, SECRET_MASK if k.endswith('password') and item[k] else scrub(item[k])) for k in item)
+        if isinstance(item, list):
+            return [scrub(i) for i in item]
+        return item
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    return json.dumps(scrub(data), indent=2, sort_keys=True)
+
+
+def normalize(command):
+    '''
+    Command as it is stored in fixture (with secrets masked), returns (command, path of savefile or None).
+    '''
+    match = SAVEFILE.search(command)
+    if match is None:
+        return mask_secrets(command), None
+    return mask_secrets(SAVEFILE.sub(SAVEFILE_PLACEHOLDER, command)), match.group(1)
+
+
+class Recorder(object):
+    '''
+    Collects targetcli commands of one module run with their replies (rc, out, err and content of
+    written savefile) and appends them as one JSON line to fixture file when the session closes.
+    CHAP secrets and no_log values of the module are masked.
+
+    {"module": "targetcli_iscsi_lun", "prefs": {...},
+     "commands": [{"cmd": "/iscsi/iqn.../tpg1 status", "rc": 0, "out": "...", "err": ""}, ...]}
+    '''
+
+    def __init__(self, path, module_name=None, prefs=None, no_log_values=None):
+        self.path = path
+        self.run = {'module': module_name, 'prefs': prefs or {}, 'commands': []}
+        self.no_log_values = no_log_values or set()
+        self.written = False
+
+    def record(self, command, rc, out, err):
+        cmd, savefile = normalize(command)
+        entry = {'cmd': cmd, 'rc': rc, 'out': mask_secrets(out), 'err': mask_secrets(err)}
+        if savefile is not None and rc == 0:
+            try:
+                with open(savefile) as f:
+                    entry['savefile'] = mask_saveconfig(f.read())
+            except (IOError, OSError):
+                pass
+        self.run['commands'].append(remove_values(entry, self.no_log_values))
+
+    def write(self):
+        if self.written or not self.run['commands']:
+            return
+        self.written = True
+        with open(self.path, 'ab') as f:
+            # module runs of parallel tasks append whole lines
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(to_bytes(json.dumps(self.run, sort_keys=True) + '\n'))
+
+
+def load_runs(path):
+    '''
+    Recorded module runs of fixture file (gzip compressed when its name ends with '.gz').
+    '''
+    runs = []
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                runs.append(json.loads(to_text(line)))
+            except ValueError as e:
+                raise ReplayError('Invalid fixture %s line %d: %s' % (path, number, e))
+    return runs
+
+
+def next_run(path):
+    '''
+    Recorded module run to replay, fixture with one run is replayed by every module run, otherwise
+    the runs are replayed in the recorded order (position is kept in '<fixture>.pos').
+    '''
+    runs = load_runs(path)
+    if len(runs) == 1:
+        return runs[0]
+    with open(path + '.pos', 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        content = f.read().strip()
+        position = int(content) if content else 0
+        if position >= len(runs):
+            raise ReplayError('All %d module runs recorded in %s were replayed already' % (len(runs), path))
+        f.seek(0)
+        f.truncate()
+        f.write('%d\n' % (position + 1))
+    return runs[position]
+
+
+class Replay(object):
+    '''
+    Replies of one recorded module run, every command gets the reply recorded for it in recorded
+    order, commands that were not recorded (or asked more times than recorded) fail.
+    '''
+
+    def __init__(self, run):
+        self.run = run
+        self.replies = collections.defaultdict(collections.deque)
+        for entry in run['commands']:
+            self.replies[entry['cmd']].append(entry)
+        self.unmatched = []
+
+    def reply(self, command):
+        cmd, savefile = normalize(command)
+        if not self.replies[cmd]:
+            self.unmatched.append(command)
+            return 1, '', 'No recorded reply for command: %s' % command
+        entry = self.replies[cmd].popleft()
+        if savefile is not None and 'savefile' in entry:
+            with open(savefile, 'w') as f:
+                f.write(entry['savefile'])
+        return entry['rc'], entry['out'], entry['err']
+
+    def remaining(self):
+        return sum(len(entries) for entries in self.replies.values())
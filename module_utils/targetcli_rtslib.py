@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import atexit
+import os
+import pickle
+import re
+import time
+import traceback
+
+from ansible.module_utils.targetcli_configfs import ConfigFS, SAVECONFIG
+from ansible.module_utils.targetcli_runtime import UNSAVED_MARKER, HostLockTimeout, clear_unsaved, has_unsaved, mark_unsaved
+
+RTSLIB_IMP_ERR = None
+try:
+    from rtslib_fb import (BlockStorageObject, FabricModule, FileIOStorageObject, LUN, MappedLUN, NetworkPortal,
+                           NodeACL, PSCSIStorageObject, RDMCPStorageObject, RTSLibError, RTSRoot, Target, TPG)
+    HAS_RTSLIB = True
+except ImportError:
+    try:
+        from rtslib import (BlockStorageObject, FabricModule, FileIOStorageObject, LUN, MappedLUN, NetworkPortal,
+                            NodeACL, PSCSIStorageObject, RDMCPStorageObject, RTSLibError, RTSRoot, Target, TPG)
+        HAS_RTSLIB = True
+    except ImportError:
+        RTSLIB_IMP_ERR = traceback.format_exc()
+        HAS_RTSLIB = False
+
+        class RTSLibError(Exception):
+            pass
+
+# targetcli defaults for the preferences that influence what create does
+DEFAULT_PREFS = {
+    'auto_enable_tpgt': True,
+    'auto_add_default_portal': True,
+    'auto_add_mapped_luns': True,
+    'export_backstore_name_as_model': True,
+}
+
+# parameters of 'set auth' in ACL, NodeACL attributes have chap_ prefix
+AUTH_PARAMS = ('userid', 'password', 'mutual_userid', 'mutual_password')
+
+# argument names of the targetcli commands, used for binding positional parameters
+COMMAND_ARGS = {
+    ('backstore_type', 'create', 'block'): ('name', 'dev', 'readonly', 'wwn'),
+    ('backstore_type', 'create', 'fileio'): ('name', 'file_or_dev', 'size', 'write_back', 'sparse', 'wwn'),
+    ('backstore_type', 'create', 'pscsi'): ('name', 'dev'),
+    ('backstore_type', 'create', 'ramdisk'): ('name', 'size', 'nullio', 'wwn'),
+    ('backstore_type', 'delete'): ('name',),
+    ('iscsi', 'create'): ('wwn',),
+    ('iscsi', 'delete'): ('wwn',),
+    ('target', 'create'): ('tag',),
+    ('target', 'delete'): ('tag',),
+    ('luns', 'create'): ('storage_object', 'lun', 'add_mapped_luns'),
+    ('luns', 'delete'): ('lun',),
+    ('acls', 'create'): ('wwn', 'add_mapped_luns'),
+    ('acls', 'delete'): ('wwn',),
+    ('acl', 'create'): ('mapped_lun', 'tpg_lun_or_backstore', 'write_protect'),
+    ('acl', 'delete'): ('mapped_lun',),
+    ('portals', 'create'): ('ip_address', 'ip_port'),
+    ('portals', 'delete'): ('ip_address', 'ip_port'),
+    ('root', 'saveconfig'): ('savefile',),
+}
+
+
+class CommandError(Exception):
+    pass
+
+
+def human_to_bytes(hsize, kilo=1024):
+    '''
+    Convert size with optional k/m/g/t unit into bytes, same rules as targetcli.
+    '''
+    size = str(hsize).replace('i', '').lower()
+    if not re.match('^[0-9]+[kmgt]?b?$', size):
+        raise CommandError("Cannot interpret size, wrong format: %s" % hsize)
+    size = size.rstrip('b')
+    units = ['k', 'm', 'g', 't']
+    if size[-1] in units:
+        return int(size[:-1]) * (kilo ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
+def create_backing_file(path, size, sparse=True):
+    '''
+    Create backing file of fileio backstore, sparse or with all blocks allocated.
+    '''
+    with open(path, 'wb') as f:
+        if sparse:
+            f.truncate(size)
+            return
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except AttributeError:
+            # no fallocate in python 2, write zeros
+            chunk = b'\0' * (1024 * 1024)
+            remaining = size
+            while remaining > 0:
+                f.write(chunk[:min(remaining, len(chunk))])
+                remaining -= len(chunk)
+
+
+def to_bool(value, default=False):
+    if value is None:
+        return default
+    if str(value).lower() in ('1', 'true', 'yes', 'on', 'enable'):
+        return True
+    if str(value).lower() in ('0', 'false', 'no', 'off', 'disable'):
+        return False
+    raise CommandError("Invalid boolean value %s" % value)
+
+
+def parse_command(command):
+    '''
+    Split '[PATH] COMMAND [POSITIONAL_PARAMETER]+ [PARAMETER=VALUE]+' into its parts.
+    '''
+    parts = command.split()
+    path = '/'
+    if parts and parts[0].startswith('/'):
+        path = parts.pop(0)
+    verb = parts.pop(0) if parts else 'cd'
+    pparams = []
+    kparams = {}
+    for part in parts:
+        if '=' in part:
+            key, value = part.split('=', 1)
+            kparams[key] = value
+        else:
+            pparams.append(part)
+    return path, verb, pparams, kparams
+
+
+def bind(names, pparams, kparams):
+    if len(pparams) > len(names):
+        raise CommandError("Too many parameters")
+    args = dict(zip(names, pparams))
+    for key, value in kparams.items():
+        if key not in names:
+            raise CommandError("Unknown parameter %s" % key)
+        if key in args:
+            raise CommandError("Parameter %s given twice" % key)
+        args[key] = value
+    return args
+
+
+def classify(path):
+    '''
+    Return (node kind, path components) for targetcli path.
+    '''
+    parts = [p for p in path.split('/') if p]
+    if not parts:
+        return 'root', parts
+    if parts[0] == 'backstores' and len(parts) in (2, 3):
+        return ('backstore_type', 'backstore')[len(parts) - 2], parts
+    if parts[0] == 'iscsi':
+        if len(parts) <= 3:
+            return ('iscsi', 'target', 'tpg')[len(parts) - 1], parts
+        if parts[3] in ('luns', 'acls', 'portals') and len(parts) == 4:
+            return parts[3], parts
+        if parts[3] == 'acls' and len(parts) == 5:
+            return 'acl', parts
+    raise CommandError("No such path %s" % path)
+
+
+def load_user_prefs():
+    '''
+    Return targetcli preferences of the user, the ones in DEFAULT_PREFS only.
+    '''
+    prefs = dict(DEFAULT_PREFS)
+    path = os.path.expanduser(os.path.join(os.environ.get('TARGETCLI_HOME', '~/.targetcli'), 'prefs.bin'))
+    try:
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        prefs.update((k, v) for k, v in saved.items() if k in DEFAULT_PREFS)
+    except Exception:
+        pass
+    return prefs
+
+
+class RTSLibSession(object):
+    '''
+    Drop-in replacement of TargetCLISession that executes the targetcli commands
+    used by the modules with rtslib in the module process, no targetcli involved.
+    Saving follows save_mode the same way as in TargetCLISession, so does host lock and timing with profiler.
+    '''
+
+    def __init__(self, module, prefs=None, configfs=None, save_mode='immediate', marker=UNSAVED_MARKER, profiler=None,
+                 lock=None):
+        self.module = module
+        self.prefs = load_user_prefs()
+        for key, value in (prefs or {}).items():
+            self.prefs[key] = to_bool(value)
+        self.configfs = configfs or ConfigFS()
+        self.save_mode = save_mode
+        self.marker = marker
+        self.profiler = profiler
+        self.lock = lock
+        self.handed_over = False
+        self.dirty = False
+        self.history = []
+        self._root = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set_prefs(self, prefs):
+        '''
+        Switch preferences of the session, keys not given are the user's values.
+        '''
+        self.prefs = load_user_prefs()
+        for key, value in prefs.items():
+            self.prefs[key] = to_bool(value)
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = RTSRoot()
+        return self._root
+
+    def storage_object(self, backstore_type, name):
+        classes = {
+            'block': BlockStorageObject,
+            'fileio': FileIOStorageObject,
+            'pscsi': PSCSIStorageObject,
+            'ramdisk': RDMCPStorageObject,
+        }
+        if backstore_type not in classes:
+            raise CommandError("No such path /backstores/%s" % backstore_type)
+        return classes[backstore_type](name)
+
+    def tpg(self, parts):
+        tag = re.match(r'^tpg(\d+)$', parts[2])
+        if tag is None:
+            raise CommandError("No such path /%s" % '/'.join(parts))
+        return TPG(Target(FabricModule('iscsi'), parts[1], mode='lookup'), int(tag.group(1)), mode='lookup')
+
+    def acquire(self):
+        if self.lock is None or self.lock.held:
+            return
+        try:
+            waited = self.lock.acquire()
+        except HostLockTimeout as e:
+            self.module.fail_json(msg=str(e))
+        atexit.register(self.close)
+        if self.profiler is not None:
+            self.profiler.record('lock', 0, '', waited, 'lock')
+
+    def run(self, command):
+        '''
+        Run one targetcli command, returns (rc, out, err) like TargetCLISession.run().
+        '''
+        self.acquire()
+        started = time.time()
+        try:
+            out = self._execute(*parse_command(command))
+            rc, err = 0, ''
+        except (CommandError, RTSLibError, ValueError, IOError, OSError) as e:
+            rc, out, err = 1, '', str(e)
+        self.history.append({'cmd': command, 'rc': rc})
+        if self.profiler is not None:
+            self.profiler.record(command, rc, out, time.time() - started, 'rtslib')
+        return rc, out or '', err
+
+    def _execute(self, path, verb, pparams, kparams):
+        kind, parts = classify(path)
+        if verb == 'status':
+            if not self.configfs.exists(path):
+                raise CommandError("No such path %s" % path)
+            return 'Status for %s: ok' % path
+        if verb == 'saveconfig' and kind == 'root':
+            args = bind(COMMAND_ARGS[('root', 'saveconfig')], pparams, kparams)
+            savefile = os.path.expanduser(args.get('savefile') or SAVECONFIG)
+            self.root.save_to_file(savefile)
+            return 'Configuration saved to %s' % savefile
+        if verb == 'set' and pparams[:1] == ['attribute'] and kind in ('backstore', 'tpg'):
+            obj = self.storage_object(parts[1], parts[2]) if kind == 'backstore' else self.tpg(parts)
+            if self.save_mode == 'deferred' and not self.dirty:
+                mark_unsaved(self.marker)
+            out = []
+            for key, value in sorted(kparams.items()):
+                obj.set_attribute(key, value)
+                out.append("Parameter %s is now '%s'." % (key, value))
+            self.dirty = True
+            return '\n'.join(out)
+        if verb == 'get' and pparams[:1] == ['attribute'] and kind in ('backstore', 'tpg'):
+            obj = self.storage_object(parts[1], parts[2]) if kind == 'backstore' else self.tpg(parts)
+            return '\n'.join('%s=%s' % (key, obj.get_attribute(key)) for key in pparams[1:])
+        if verb == 'set' and pparams[:1] == ['auth'] and kind == 'acl':
+            acl = NodeACL(self.tpg(parts), parts[4], mode='lookup')
+            if self.save_mode == 'deferred' and not self.dirty:
+                mark_unsaved(self.marker)
+            out = []
+            for key, value in sorted(kparams.items()):
+                if key not in AUTH_PARAMS:
+                    raise CommandError("Unknown auth parameter %s" % key)
+                setattr(acl, 'chap_' + key, value)
+                out.append("Parameter %s is now '%s'." % (key, value))
+            self.dirty = True
+            return '\n'.join(out)
+
+        if self.save_mode == 'deferred' and not self.dirty:
+            mark_unsaved(self.marker)
+        key = (kind, verb, parts[1]) if kind == 'backstore_type' and verb == 'create' else (kind, verb)
+        if key not in COMMAND_ARGS:
+            raise CommandError("Command %s is not supported on %s" % (verb, path))
+        args = bind(COMMAND_ARGS[key], pparams, kparams)
+        out = getattr(self, '_%s_%s' % (kind, verb))(parts, args)
+        self.dirty = True
+        return out
+
+    def _backstore_type_create(self, parts, args):
+        backstore_type = parts[1]
+        name = args['name']
+        wwn = args.get('wwn')
+        if backstore_type == 'block':
+            so = BlockStorageObject(name, args['dev'], readonly=to_bool(args.get('readonly')), wwn=wwn)
+        elif backstore_type == 'fileio':
+            path = os.path.expanduser(args['file_or_dev'])
+            size = args.get('size')
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+            elif not os.path.exists(path):
+                if not size:
+                    raise CommandError("Attempting to create file for new fileio backstore, need a size")
+                size = human_to_bytes(size)
+                create_backing_file(path, size, to_bool(args.get('sparse'), True))
+            else:
+                size = None
+            so = FileIOStorageObject(name, path, size, write_back=to_bool(args.get('write_back'), True), wwn=wwn)
+        elif backstore_type == 'pscsi':
+            so = PSCSIStorageObject(name, args['dev'])
+        else:
+            so = RDMCPStorageObject(name, human_to_bytes(args['size']), nullio=to_bool(args.get('nullio')), wwn=wwn)
+        if backstore_type != 'pscsi' and self.prefs['export_backstore_name_as_model']:
+            so.set_attribute('emulate_model_alias', 1)
+        return 'Created %s storage object %s.' % (backstore_type, name)
+
+    def _backstore_type_delete(self, parts, args):
+        self.storage_object(parts[1], args['name']).delete()
+        return 'Deleted storage object %s.' % args['name']
+
+    def _new_tpg(self, target, tag=None):
+        tpg = TPG(target, tag, mode='create')
+        if self.prefs['auto_enable_tpgt']:
+            tpg.enable = True
+        tpg.set_attribute('authentication', 0)
+        out = ['Created TPG %s.' % tpg.tag]
+        if self.prefs['auto_add_default_portal']:
+            try:
+                NetworkPortal(tpg, '0.0.0.0')
+                out.append('Created default portal listening on all IPs (0.0.0.0), port 3260.')
+            except RTSLibError:
+                out.append('Default portal not created, TPGs within a target cannot share ip:port.')
+        return out
+
+    def _iscsi_create(self, parts, args):
+        target = Target(FabricModule('iscsi'), args.get('wwn'), mode='create')
+        return '\n'.join(['Created target %s.' % target.wwn] + self._new_tpg(target))
+
+    def _iscsi_delete(self, parts, args):
+        Target(FabricModule('iscsi'), args['wwn'], mode='lookup').delete()
+        return 'Deleted Target %s.' % args['wwn']
+
+    def _target_create(self, parts, args):
+        tag = args.get('tag')
+        tag = int(tag[3:] if tag and tag.startswith('tpg') else tag) if tag else None
+        return '\n'.join(self._new_tpg(Target(FabricModule('iscsi'), parts[1], mode='lookup'), tag))
+
+    def _target_delete(self, parts, args):
+        tag = args['tag'][3:] if args['tag'].startswith('tpg') else args['tag']
+        TPG(Target(FabricModule('iscsi'), parts[1], mode='lookup'), int(tag), mode='lookup').delete()
+        return 'Deleted TPGT %s.' % tag
+
+    def _luns_create(self, parts, args):
+        tpg = self.tpg(parts)
+        so_parts = [p for p in args['storage_object'].split('/') if p]
+        if len(so_parts) != 3 or so_parts[0] != 'backstores':
+            raise CommandError("storage object or path not valid")
+        so = self.storage_object(so_parts[1], so_parts[2])
+        if so in (lun.storage_object for lun in tpg.luns):
+            raise CommandError("lun for storage object %s/%s already exists" % (so.plugin, so.name))
+        index = args.get('lun')
+        if index is not None:
+            index = int(index[3:] if index.startswith('lun') else index)
+        lun = LUN(tpg, index, so)
+        out = ['Created LUN %s.' % lun.lun]
+        if to_bool(args.get('add_mapped_luns'), self.prefs['auto_add_mapped_luns']):
+            for acl in tpg.node_acls:
+                existing = set(mlun.mapped_lun for mlun in acl.mapped_luns)
+                # under the TPG LUN number when it is free in the ACL
+                mapped_lun = index if index is not None else lun.lun
+                while mapped_lun in existing:
+                    mapped_lun += 1
+                mlun = MappedLUN(acl, mapped_lun, lun, write_protect=False)
+                out.append('Created LUN %d->%d mapping in node ACL %s' % (lun.lun, mlun.mapped_lun, acl.node_wwn))
+        return '\n'.join(out)
+
+    def _luns_delete(self, parts, args):
+        index = args['lun'][3:] if args['lun'].startswith('lun') else args['lun']
+        LUN(self.tpg(parts), int(index)).delete()
+        return 'Deleted LUN %s.' % index
+
+    def _acls_create(self, parts, args):
+        tpg = self.tpg(parts)
+        acl = NodeACL(tpg, args['wwn'], mode='create')
+        out = ['Created Node ACL for %s' % acl.node_wwn]
+        if to_bool(args.get('add_mapped_luns'), self.prefs['auto_add_mapped_luns']):
+            for lun in tpg.luns:
+                MappedLUN(acl, lun.lun, lun.lun, write_protect=False)
+                out.append('Created mapped LUN %d.' % lun.lun)
+        return '\n'.join(out)
+
+    def _acls_delete(self, parts, args):
+        NodeACL(self.tpg(parts), args['wwn'], mode='lookup').delete()
+        return 'Deleted Node ACL %s.' % args['wwn']
+
+    def _acl_create(self, parts, args):
+        acl = NodeACL(self.tpg(parts), parts[4], mode='lookup')
+        tpg_lun = args['tpg_lun_or_backstore']
+        tpg_lun = int(tpg_lun[3:] if tpg_lun.startswith('lun') else tpg_lun)
+        mlun = MappedLUN(acl, int(args['mapped_lun']), tpg_lun, write_protect=to_bool(args.get('write_protect')))
+        return 'Created Mapped LUN %s.' % mlun.mapped_lun
+
+    def _acl_delete(self, parts, args):
+        acl = NodeACL(self.tpg(parts), parts[4], mode='lookup')
+        MappedLUN(acl, int(args['mapped_lun'])).delete()
+        return 'Deleted Mapped LUN %s.' % args['mapped_lun']
+
+    def _portals_create(self, parts, args):
+        ip_address = args.get('ip_address', '0.0.0.0')
+        port = int(args.get('ip_port', 3260))
+        NetworkPortal(self.tpg(parts), ip_address, port, mode='create')
+        return 'Created network portal %s:%d.' % (ip_address, port)
+
+    def _portals_delete(self, parts, args):
+        port = int(args.get('ip_port', 3260))
+        NetworkPortal(self.tpg(parts), args['ip_address'], port, mode='lookup').delete()
+        return 'Deleted network portal %s:%d' % (args['ip_address'], port)
+
+    def exists(self, path):
+        self.acquire()
+        started = time.time()
+        found = self.configfs.exists(path)
+        if self.profiler is not None:
+            self.profiler.record('%s status' % path, 0 if found else 1, '', time.time() - started, 'configfs')
+        return found
+
+    def cached_state(self):
+        # rtslib needs configfs, which is always read directly
+        return None
+
+    def save(self):
+        rc, out, err = self.run('/ saveconfig')
+        if rc == 0:
+            self.dirty = False
+            clear_unsaved(self.marker)
+        return rc, out, err
+
+    def needs_save(self):
+        if self.save_mode != 'immediate' or self.module.check_mode or self.handed_over:
+            return False
+        return self.dirty or has_unsaved(self.marker)
+
+    def hand_over_save(self):
+        if self.lock is None or not self.lock.held or not self.lock.saving_waiters():
+            return False
+        mark_unsaved(self.marker)
+        if not self.lock.hand_over():
+            return False
+        self.dirty = False
+        self.handed_over = True
+        return True
+
+    def close(self):
+        rc, out, err = 0, '', ''
+        if self.needs_save() and not self.hand_over_save():
+            rc, out, err = self.save()
+        self._root = None
+        if self.lock is not None:
+            self.lock.release()
+        return rc, out, err
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import random
+import time
+
+from ansible.module_utils.targetcli_configfs import SAVECONFIG
+from ansible.module_utils.targetcli_state import from_saveconfig
+
+# host side state shared by the module runs, on tmpfs so it lives exactly as
+# long as the live (configfs) configuration it describes
+RUNTIME_DIR = '/run/ansible-targetcli'
+
+# present while the live configuration has changes that were not saved yet
+UNSAVED_MARKER = os.path.join(RUNTIME_DIR, 'unsaved')
+
+SAVE_MODES = ('immediate', 'deferred', 'never')
+
+# parsed configuration shared by the module runs when configfs is not available
+STATE_CACHE = os.path.join(RUNTIME_DIR, 'state.json')
+
+# serializes module runs touching the configuration, waiting runs register in the queue directory
+HOST_LOCK = os.path.join(RUNTIME_DIR, 'lock')
+LOCK_QUEUE = os.path.join(RUNTIME_DIR, 'queue')
+
+# default seconds to wait for the host lock and the backoff between attempts
+LOCK_TIMEOUT = 300
+LOCK_BACKOFF = (0.01, 0.5)
+
+
+def has_unsaved(marker=UNSAVED_MARKER):
+    return os.path.exists(marker)
+
+
+def mark_unsaved(marker=UNSAVED_MARKER):
+    '''
+    Record that the live configuration is going to differ from the saved one.
+    '''
+    directory = os.path.dirname(marker)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    with open(marker, 'w') as f:
+        f.write('%d %d\n' % (os.getpid(), int(time.time())))
+
+
+def clear_unsaved(marker=UNSAVED_MARKER):
+    try:
+        os.unlink(marker)
+    except OSError:
+        pass
+
+
+class StateCache(object):
+    '''
+    Parsed configuration (targetcli_state shape) cached on the host between module runs.
+
+    Cached state is valid only while saveconfig.json has the same mtime and
+    content hash as when the state was stored, sessions store fresh state
+    after they changed the configuration. Readers and writers are serialized
+    with flock on a lock file next to the cache.
+    '''
+
+    def __init__(self, path=STATE_CACHE, savefile=SAVECONFIG):
+        self.path = path
+        self.savefile = savefile
+        self.lockfile = path + '.lock'
+
+    def savefile_key(self, content=None):
+        try:
+            if content is None:
+                with open(self.savefile, 'rb') as f:
+                    content = f.read()
+            return [os.stat(self.savefile).st_mtime, hashlib.sha1(content).hexdigest()]
+        except (IOError, OSError):
+            return [None, None]
+
+    def _lock(self, operation):
+        directory = os.path.dirname(self.lockfile)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        lock = open(self.lockfile, 'a')
+        fcntl.flock(lock.fileno(), operation)
+        return lock
+
+    def load(self):
+        '''
+        Return cached state or None when there is none or it is stale.
+        '''
+        try:
+            lock = self._lock(fcntl.LOCK_SH)
+            try:
+                with open(self.path) as f:
+                    cached = json.load(f)
+            finally:
+                lock.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if cached.get('key') != self.savefile_key():
+            return None
+        return cached['state']
+
+    def store(self, state, key=None):
+        try:
+            lock = self._lock(fcntl.LOCK_EX)
+            try:
+                tmp = '%s.%d' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump({'key': key or self.savefile_key(), 'state': state}, f)
+                os.rename(tmp, self.path)
+            finally:
+                lock.close()
+        except (IOError, OSError):
+            self.invalidate()
+
+    def store_saved(self):
+        '''
+        Store the configuration that was just saved, parsed from saveconfig.json itself so that no
+        second 'saveconfig' is needed, the key is computed from the same content that was parsed.
+        '''
+        try:
+            with open(self.savefile, 'rb') as f:
+                content = f.read()
+            state = from_saveconfig(json.loads(content.decode('utf-8')) if content.strip() else {})
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.invalidate()
+            return
+        self.store(state, self.savefile_key(content))
+
+    def invalidate(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class HostLockTimeout(Exception):
+    pass
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class HostLock(object):
+    '''
+    Host-wide lock serializing module runs that read and change the configuration.
+
+    Lock is flock on HOST_LOCK taken without blocking, attempts are repeated
+    with exponential backoff (with jitter so that the waiters don't wake up
+    together) until timeout. The holder writes its pid into the lock file
+    for the timeout message.
+
+    While waiting a run registers in the queue directory whether it will
+    save the configuration at its end (saves). Holder that should save can
+    leave the save to such queued run, the waiting runs then share one save
+    instead of saving one after another (see hand_over()). Hand-over and
+    waiters giving up are serialized with flock on a lock file next to the
+    queue directory, so that the save is never left to a run that timed out.
+    '''
+
+    def __init__(self, path=HOST_LOCK, queue=LOCK_QUEUE, timeout=LOCK_TIMEOUT, saves=False):
+        self.path = path
+        self.queue = queue
+        self.timeout = timeout
+        self.saves = saves
+        self.queue_lockfile = queue + '.lock'
+        self.lock = None
+
+    @property
+    def held(self):
+        return self.lock is not None
+
+    def _try(self, lock):
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def _queue_lock(self):
+        lock = open(self.queue_lockfile, 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def holder(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or 'unknown'
+        except (IOError, OSError):
+            return 'unknown'
+
+    def acquire(self):
+        '''
+        Take the lock, returns seconds spent waiting or raises HostLockTimeout.
+        '''
+        if self.lock is not None:
+            return 0
+        for directory in (os.path.dirname(self.path), self.queue):
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+        lock = open(self.path, 'a+')
+        started = time.time()
+        if not self._try(lock):
+            ticket = os.path.join(self.queue, str(os.getpid()))
+            with open(ticket, 'w') as f:
+                f.write('1' if self.saves else '0')
+            try:
+                delay = LOCK_BACKOFF[0]
+                while True:
+                    remaining = started + self.timeout - time.time()
+                    if remaining <= 0:
+                        queue_lock = self._queue_lock()
+                        try:
+                            # the holder may have handed its save over to us right before releasing
+                            if self._try(lock):
+                                break
+                            os.unlink(ticket)
+                        finally:
+                            queue_lock.close()
+                        holder = self.holder()
+                        lock.close()
+                        raise HostLockTimeout('Timed out after %d seconds waiting for lock %s held by pid %s'
+                                              % (self.timeout, self.path, holder))
+                    time.sleep(min(remaining, delay * random.uniform(0.5, 1)))
+                    delay = min(delay * 2, LOCK_BACKOFF[1])
+                    if self._try(lock):
+                        break
+            finally:
+                try:
+                    os.unlink(ticket)
+                except OSError:
+                    pass
+        lock.seek(0)
+        lock.truncate()
+        lock.write('%d\n' % os.getpid())
+        lock.flush()
+        self.lock = lock
+        return time.time() - started
+
+    def release(self):
+        if self.lock is not None:
+            # closing the file drops the flock
+            self.lock.close()
+            self.lock = None
+
+    def hand_over(self):
+        '''
+        Release the lock when a queued run is going to save after us, returns False (lock still held) when there is none.
+
+        A waiter that times out meanwhile either tries the lock once more after
+        the release or has removed its ticket before the check.
+        '''
+        if self.lock is None:
+            return False
+        queue_lock = self._queue_lock()
+        try:
+            if not self.saving_waiters():
+                return False
+            self.release()
+        finally:
+            queue_lock.close()
+        return True
+
+    def saving_waiters(self):
+        '''
+        Return True when a live queued run is going to save the configuration after us.
+        '''
+        try:
+            tickets = os.listdir(self.queue)
+        except OSError:
+            return False
+        for ticket in tickets:
+            if not ticket.isdigit() or int(ticket) == os.getpid():
+                continue
+            if not pid_alive(int(ticket)):
+                # left behind by killed waiter
+                try:
+                    os.unlink(os.path.join(self.queue, ticket))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(self.queue, ticket)) as f:
+                    if f.read().strip() == '1':
+                        return True
+            except (IOError, OSError):
+                pass
+        return False
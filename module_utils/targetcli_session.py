@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import atexit
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.basic import missing_required_lib
+from ansible.module_utils.targetcli_agent import AGENT_SOCKET, AgentClient, AgentError
+from ansible.module_utils.targetcli_configfs import ConfigFS
+from ansible.module_utils.targetcli_profile import get_profiler
+from ansible.module_utils.targetcli_replay import NO_CONFIGFS, RECORD_ENV, REPLAY_ENV, Recorder, Replay, ReplayError, next_run
+from ansible.module_utils.targetcli_rtslib import HAS_RTSLIB, RTSLIB_IMP_ERR, RTSLibSession, load_user_prefs
+from ansible.module_utils.targetcli_runtime import (LOCK_TIMEOUT, UNSAVED_MARKER, HostLock, HostLockTimeout, StateCache,
+                                                    clear_unsaved, has_unsaved, mark_unsaved)
+from ansible.module_utils.targetcli_state import TargetCLIStateError, path_exists, snapshot
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+# commands that never change the configuration, anything else marks session dirty
+READ_ONLY_COMMANDS = ('status', 'ls', 'get', 'pwd', 'info', 'help', 'version', 'bookmarks', 'saveconfig')
+
+# targetcli (configshell) prints errors as 'Error: <msg>' when color_mode is off
+ERROR_PREFIX = 'Error: '
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+
+def command_verb(command):
+    '''
+    Return the command name from '[PATH] COMMAND [PARAMETERS]' command line.
+    '''
+    parts = command.split()
+    if parts and parts[0].startswith('/'):
+        parts = parts[1:]
+    return parts[0] if parts else ''
+
+
+class TargetCLISession(object):
+    '''
+    One long running targetcli process fed with commands over stdin.
+
+    Every command is followed by a marker command that fails on a unique
+    nonexistent path, the error message of the marker delimits the reply of
+    the command in the (merged) output stream. Command is considered failed
+    when its reply contains an error message.
+
+    targetcli runs with private TARGETCLI_HOME (copy of the user's preferences)
+    so that colors and auto-save on exit can be turned off without touching
+    the user's settings. With save_mode 'immediate' configuration is saved once
+    on close() when any command changed it (or an earlier deferred save is
+    pending), 'deferred' only records the pending save in the unsaved marker
+    before the first change and 'never' leaves saving to the caller.
+
+    When configfs is not available existence checks are answered from the
+    host state cache (if given), session that changed and saved the
+    configuration stores the saved file parsed into it on close(), one that
+    changed it without saving invalidates it.
+
+    With host lock the session holds it from the first command or check
+    till close(), when another run that saves is queued for the lock the
+    'immediate' save is left to it (recorded in the unsaved marker).
+
+    With profiler every command, existence check and process start is timed.
+    '''
+
+    def __init__(self, module, executable=None, prefs=None, configfs=None, save_mode='immediate', marker=UNSAVED_MARKER,
+                 cache=None, profiler=None, lock=None, recorder=None):
+        self.module = module
+        self.executable = executable or module.get_bin_path('targetcli', required=True)
+        self.prefs = prefs or {}
+        self.configfs = configfs or ConfigFS()
+        self.save_mode = save_mode
+        self.marker = marker
+        self.cache = cache
+        self.profiler = profiler
+        self.lock = lock
+        self.recorder = recorder
+        self.handed_over = False
+        self.source = 'targetcli'
+        self.proc = None
+        self.home = None
+        self.dirty = False
+        self.changed = False
+        self.history = []
+        self._seq = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        if self.proc is not None:
+            return
+        started = time.time()
+        self.home = tempfile.mkdtemp(prefix='ansible-targetcli-')
+        prefs = os.path.expanduser(os.path.join(os.environ.get('TARGETCLI_HOME', '~/.targetcli'), 'prefs.bin'))
+        if os.path.isfile(prefs):
+            shutil.copy(prefs, self.home)
+        env = dict(os.environ)
+        env['TARGETCLI_HOME'] = self.home
+        env['PYTHONUNBUFFERED'] = '1'
+        self.proc = subprocess.Popen([self.executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, env=env, close_fds=True)
+        atexit.register(self.close)
+        # swallow the banner and switch off what would break the reply parsing
+        self._exchange('set global color_mode=false auto_save_on_exit=false')
+        if self.prefs:
+            self._exchange('set global ' + ' '.join('%s=%s' % (k, v) for k, v in sorted(self.prefs.items())))
+        self._exchange('cd /')
+        if self.profiler is not None:
+            self.profiler.spawn(time.time() - started)
+
+    def _exchange(self, command):
+        self._seq += 1
+        marker = '__ansible_targetcli_%d_%d__' % (os.getpid(), self._seq)
+        try:
+            self.proc.stdin.write(to_bytes(command + '\n/' + marker + ' pwd\n'))
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            return None
+        lines = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                # targetcli exited (or crashed), there is no reply to wait for
+                return None
+            line = ANSI_ESCAPE.sub('', to_text(line, errors='surrogate_or_strict')).rstrip('\r\n')
+            if marker in line:
+                return lines
+            lines.append(line)
+
+    def acquire(self):
+        '''
+        Take the host lock (if any) before touching the configuration, fails the module on timeout.
+        '''
+        if self.lock is None or self.lock.held:
+            return
+        try:
+            waited = self.lock.acquire()
+        except HostLockTimeout as e:
+            self.module.fail_json(msg=str(e))
+        # a failing module still saves and releases what it holds
+        atexit.register(self.close)
+        if self.profiler is not None:
+            self.profiler.record('lock', 0, '', waited, 'lock')
+
+    def run(self, command):
+        '''
+        Run one targetcli command, returns (rc, out, err) like module.run_command().
+        '''
+        self.acquire()
+        self.start()
+        started = time.time()
+        read_only = command_verb(command) in READ_ONLY_COMMANDS
+        if not read_only and self.save_mode == 'deferred' and not self.dirty:
+            # before the change, so that a crash in between still leaves the marker behind
+            mark_unsaved(self.marker)
+        rc, out, err = self._execute(command)
+        if self.recorder is not None:
+            self.recorder.record(command, rc, out, err)
+        if rc == 0 and not read_only:
+            self.dirty = True
+            self.changed = True
+        self.history.append({'cmd': command, 'rc': rc})
+        if self.profiler is not None:
+            self.profiler.record(command, rc, out, time.time() - started, self.source)
+        return rc, out, err
+
+    def _execute(self, command):
+        lines = self._exchange(command)
+        if lines is None:
+            return 1, '', 'targetcli process exited unexpectedly'
+        out_lines = []
+        err_lines = []
+        for line in lines:
+            # strip prompts that targetcli printed before reading our commands
+            while line.startswith('/> '):
+                line = line[3:]
+            if line.startswith(ERROR_PREFIX):
+                err_lines.append(line[len(ERROR_PREFIX):])
+            elif line:
+                out_lines.append(line)
+        return 1 if err_lines else 0, '\n'.join(out_lines), '\n'.join(err_lines)
+
+    def set_prefs(self, prefs):
+        '''
+        Switch preferences of the session, keys set before and not given now go back to the user's values.
+        '''
+        user = load_user_prefs()
+        wanted = dict((k, str(v).lower()) for k, v in prefs.items())
+        for key in self.prefs:
+            if key not in wanted and key in user:
+                wanted[key] = str(user[key]).lower()
+        changes = dict((k, v) for k, v in wanted.items() if str(self.prefs.get(k, user.get(k))).lower() != v)
+        if changes and self.proc is not None:
+            self._exchange('set global ' + ' '.join('%s=%s' % (k, v) for k, v in sorted(changes.items())))
+        self.prefs = dict(prefs)
+
+    def _lookup(self, path, source, lookup):
+        started = time.time()
+        found = lookup()
+        if self.profiler is not None:
+            self.profiler.record('%s status' % path, 0 if found else 1, '', time.time() - started, source)
+        return found
+
+    def exists(self, path):
+        '''
+        Check if the targetcli path exists, from configfs when possible without starting targetcli.
+        '''
+        self.acquire()
+        if self.configfs.available():
+            return self._lookup(path, 'configfs', lambda: self.configfs.exists(path))
+        if self.cache is not None:
+            try:
+                return self._lookup(path, 'cache', lambda: path_exists(snapshot(self), path))
+            except TargetCLIStateError:
+                pass
+        rc, out, err = self.run('%s status' % path)
+        return rc == 0
+
+    def cached_state(self):
+        '''
+        Whole configuration from the host cache when configfs is not available, None when not cached.
+        '''
+        if self.cache is None or self.configfs.available():
+            return None
+        self.acquire()
+        return self.cache.load()
+
+    def save(self):
+        rc, out, err = self.run('/ saveconfig')
+        if rc == 0:
+            self.dirty = False
+            clear_unsaved(self.marker)
+        return rc, out, err
+
+    def needs_save(self):
+        if self.save_mode != 'immediate' or self.module.check_mode or self.handed_over:
+            return False
+        return self.dirty or has_unsaved(self.marker)
+
+    def hand_over_save(self):
+        '''
+        Leave the save to a queued run that saves anyway, returns False when there is none.
+
+        The host lock is released right away, the queued run may take it before close() ends.
+        '''
+        if self.lock is None or not self.lock.held or not self.lock.saving_waiters():
+            return False
+        mark_unsaved(self.marker)
+        if self.cache is not None and self.changed:
+            # before the queued run can store the state it saves
+            self.cache.invalidate()
+            self.changed = False
+        if not self.lock.hand_over():
+            # the waiter gave up meanwhile, the marker is cleared by our own save
+            return False
+        self.dirty = False
+        self.handed_over = True
+        return True
+
+    def close(self):
+        '''
+        Save configuration if needed, terminate targetcli and release the host lock, returns (rc, out, err).
+        '''
+        rc, out, err = 0, '', ''
+        saved = False
+        if self.needs_save() and not self.hand_over_save():
+            rc, out, err = self.save()
+            saved = rc == 0
+        if self.cache is not None:
+            # saveconfig.json was just written from the live configuration, unsaved changes make the cache stale
+            if saved:
+                self.cache.store_saved()
+            elif self.changed:
+                self.cache.invalidate()
+        self.changed = False
+        if self.started():
+            self.stop()
+        if self.lock is not None:
+            self.lock.release()
+        if self.recorder is not None:
+            self.recorder.write()
+        return rc, out, err
+
+    def started(self):
+        return self.proc is not None
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        try:
+            self.proc.stdin.write(b'exit\n')
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.proc.stdout.read()
+        self.proc.wait()
+        self.proc = None
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+class AgentSession(TargetCLISession):
+    '''
+    TargetCLISession that sends the commands to the targetcli agent (see
+    targetcli_agent module) instead of starting targetcli. Agent is
+    connected on the first command and serves only this session until it
+    is closed. When the agent is not running (anymore) the session starts
+    its own targetcli process.
+    '''
+
+    def __init__(self, module, path=AGENT_SOCKET, **kwargs):
+        kwargs.setdefault('executable', module.get_bin_path('targetcli') or 'targetcli')
+        super(AgentSession, self).__init__(module, **kwargs)
+        self.path = path
+        self.client = None
+
+    def start(self):
+        if self.client is not None or self.proc is not None:
+            return
+        self.client = AgentClient.connect(self.path)
+        if self.client is None:
+            super(AgentSession, self).start()
+            return
+        try:
+            self.client.hello(self.prefs)
+        except AgentError:
+            self.client.close()
+            self.client = None
+            super(AgentSession, self).start()
+            return
+        self.source = 'agent'
+
+    def _execute(self, command):
+        if self.client is None:
+            return super(AgentSession, self)._execute(command)
+        try:
+            return self.client.run(command)
+        except AgentError as e:
+            return 1, '', str(e)
+
+    def started(self):
+        return self.client is not None or self.proc is not None
+
+    def stop(self):
+        if self.client is None:
+            return super(AgentSession, self).stop()
+        self.client.close()
+        self.client = None
+
+
+class ReplaySession(TargetCLISession):
+    '''
+    TargetCLISession answering the commands with the replies recorded in a
+    fixture file (see targetcli_replay) instead of starting targetcli, so
+    the modules run where the kernel target stack is not available.
+    configfs, the host cache and the host lock are not used and the
+    unsaved marker is kept next to the fixture.
+    '''
+
+    def __init__(self, module, replay, **kwargs):
+        kwargs.setdefault('executable', 'targetcli')
+        super(ReplaySession, self).__init__(module, **kwargs)
+        self.replay = replay
+        self.source = 'replay'
+
+    def start(self):
+        pass
+
+    def started(self):
+        return False
+
+    def _execute(self, command):
+        return self.replay.reply(command)
+
+
+def new_session(module, prefs=None, configfs=None):
+    '''
+    Return session for the engine selected by module's 'engine' parameter.
+
+    'auto' uses rtslib in the module process when it is importable and configfs
+    is mounted, otherwise targetcli subprocess. Modules without 'save'
+    parameter save immediately, with 'profile' parameter true the session
+    records timing into the 'perf' key of the module result. When the
+    targetcli agent is running 'auto' sends the commands to it. Sessions
+    of all engines hold the host lock, waiting up to 'lock_timeout' seconds.
+
+    With ANSIBLE_TARGETCLI_REPLAY environment variable set to a fixture file
+    the commands are answered from it, with ANSIBLE_TARGETCLI_RECORD the
+    commands of targetcli process and their replies are appended to it.
+    Both send every read through targetcli commands (no configfs or cache).
+    '''
+    engine = module.params.get('engine') or 'auto'
+    save_mode = module.params.get('save') or 'immediate'
+    configfs = configfs or ConfigFS()
+    profiler = get_profiler(module)
+    timeout = module.params.get('lock_timeout')
+    lock = HostLock(timeout=LOCK_TIMEOUT if timeout is None else timeout,
+                    saves=save_mode == 'immediate' and not module.check_mode)
+    replay = os.environ.get(REPLAY_ENV)
+    if replay:
+        try:
+            run = next_run(replay)
+        except (IOError, OSError, ReplayError) as e:
+            module.fail_json(msg="Failed to load targetcli replay fixture %s - %s" % (replay, e))
+        if profiler is not None:
+            profiler.engine = 'replay'
+        return ReplaySession(module, Replay(run), prefs=prefs, configfs=ConfigFS(NO_CONFIGFS), save_mode=save_mode,
+                             marker=replay + '.unsaved', profiler=profiler)
+    if os.environ.get(RECORD_ENV):
+        # only targetcli process gives replies worth recording
+        engine = 'targetcli'
+    if engine == 'rtslib' and not HAS_RTSLIB:
+        module.fail_json(msg=missing_required_lib('rtslib-fb'), exception=RTSLIB_IMP_ERR)
+    if engine == 'auto' and os.path.exists(AGENT_SOCKET):
+        if profiler is not None:
+            profiler.engine = 'agent'
+        return AgentSession(module, prefs=prefs, configfs=configfs, save_mode=save_mode, cache=StateCache(),
+                            profiler=profiler, lock=lock)
+    if engine == 'rtslib' or (engine == 'auto' and HAS_RTSLIB and configfs.available()):
+        if profiler is not None:
+            profiler.engine = 'rtslib'
+        return RTSLibSession(module, prefs=prefs, configfs=configfs, save_mode=save_mode, profiler=profiler, lock=lock)
+    if which('targetcli') is None:
+        module.fail_json(msg="'targetcli' executable not found. Install 'targetcli'.")
+    record = os.environ.get(RECORD_ENV)
+    if record:
+        if profiler is not None:
+            profiler.engine = 'targetcli'
+        recorder = Recorder(record, getattr(module, '_name', None), prefs, module.no_log_values)
+        return TargetCLISession(module, prefs=prefs, configfs=ConfigFS(NO_CONFIGFS), save_mode=save_mode,
+                                profiler=profiler, lock=lock, recorder=recorder)
+    if profiler is not None:
+        profiler.engine = 'targetcli'
+    return TargetCLISession(module, prefs=prefs, configfs=configfs, save_mode=save_mode, cache=StateCache(),
+                            profiler=profiler, lock=lock)
@@ -0,0 +1,912 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import copy
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_PORTAL = '0.0.0.0:3260'
+
+# order in which changes are applied, deletes go in the reverse order
+OBJECT_ORDER = ('backstore', 'target', 'tpg', 'lun', 'acl', 'mapped_lun', 'portal')
+
+# keys of ACL auth that are secret, never shown in the planned changes
+SECRET_AUTH = ('password', 'mutual_password')
+
+# read-only attributes reported by the kernel, left out of the fingerprint
+READONLY_ATTRIBUTES = ('alua_support', 'pgr_support')
+
+# highest LUN index of TPG the kernel accepts
+MAX_LUN_INDEX = 65535
+
+
+class TargetCLIStateError(Exception):
+    pass
+
+
+def new_state():
+    return {'backstores': {}, 'targets': {}}
+
+
+def new_tpg(tag):
+    return {'tag': tag, 'attributes': {}, 'luns': {}, 'acls': {}, 'portals': {}}
+
+
+def normalize_attributes(attributes):
+    return dict((k, str(v).lower() if isinstance(v, bool) else str(v)) for k, v in (attributes or {}).items())
+
+
+def portal_name(ip_address, port):
+    return '%s:%s' % (ip_address, port)
+
+
+def from_saveconfig(data):
+    '''
+    Convert saveconfig.json structure into the state tree used by the modules.
+
+    {'backstores': {'block/test1': {...}},
+     'targets': {'iqn...': {'wwn': 'iqn...', 'tpgs': {'tpg1': {'luns': {'lun0': {...}}, 'acls': {...}, 'portals': {...}}}}}}
+
+    Targets of other fabrics (loopback, vhost, qla2xxx, ...) are not managed, only the backstores used by
+    their LUNs are kept in 'fabric_luns' ({'/loopback/<wwn>/tpg1/luns/lun0': 'block/test1'}) when there are any.
+    '''
+    state = new_state()
+    for so in data.get('storage_objects', []):
+        key = '%s/%s' % (so['plugin'], so['name'])
+        state['backstores'][key] = {
+            'type': so['plugin'],
+            'name': so['name'],
+            'dev': so.get('dev'),
+            'size': so.get('size'),
+            'wwn': so.get('wwn'),
+            'attributes': normalize_attributes(so.get('attributes')),
+        }
+    for target in data.get('targets', []):
+        if target.get('fabric', 'iscsi') != 'iscsi':
+            for tpg in target.get('tpgs', []):
+                for lun in tpg.get('luns', []):
+                    path = '/%s/%s/tpg%d/luns/lun%d' % (target['fabric'], target['wwn'], tpg.get('tag', 1), lun['index'])
+                    state.setdefault('fabric_luns', {})[path] = lun['storage_object'][len('/backstores/'):]
+            continue
+        tpgs = {}
+        for tpg in target.get('tpgs', []):
+            item = new_tpg(tpg['tag'])
+            item['enable'] = tpg.get('enable', True)
+            item['attributes'] = normalize_attributes(tpg.get('attributes'))
+            for lun in tpg.get('luns', []):
+                item['luns']['lun%d' % lun['index']] = {
+                    'index': lun['index'],
+                    'backstore': lun['storage_object'][len('/backstores/'):],
+                }
+            for acl in tpg.get('node_acls', []):
+                item['acls'][acl['node_wwn']] = {
+                    'wwn': acl['node_wwn'],
+                    'mapped_luns': dict(('mapped_lun%d' % mlun['index'], {
+                        'index': mlun['index'],
+                        'tpg_lun': mlun['tpg_lun'],
+                        'write_protect': bool(mlun.get('write_protect', False)),
+                    }) for mlun in acl.get('mapped_luns', [])),
+                    'auth': dict((k[len('chap_'):], v) for k, v in acl.items() if k.startswith('chap_')),
+                }
+            for portal in tpg.get('portals', []):
+                item['portals'][portal_name(portal['ip_address'], portal['port'])] = {
+                    'ip_address': portal['ip_address'],
+                    'port': int(portal['port']),
+                }
+            tpgs['tpg%d' % tpg['tag']] = item
+        state['targets'][target['wwn']] = {'wwn': target['wwn'], 'tpgs': tpgs}
+    return state
+
+
+def read_saveconfig(session):
+    '''
+    Read the whole live configuration with one 'saveconfig' into a temporary file.
+    '''
+    fd, path = tempfile.mkstemp(prefix='ansible-targetcli-', suffix='.json')
+    os.close(fd)
+    try:
+        rc, out, err = session.run('/ saveconfig savefile=%s' % path)
+        if rc != 0:
+            raise TargetCLIStateError('Failed to read targetcli configuration: %s' % (err or out))
+        with open(path) as f:
+            content = f.read()
+        return from_saveconfig(json.loads(content) if content.strip() else {})
+    finally:
+        os.unlink(path)
+
+
+def snapshot(session, attributes=False):
+    '''
+    Read the whole live configuration, from configfs when available otherwise
+    from the session's host cache or with read_saveconfig() (which refreshes the cache).
+    Attributes are read from configfs only when asked for, the other sources always have them.
+    '''
+    # under the session's host lock, the caller is going to act on what it read
+    session.acquire()
+    if session.configfs.available():
+        return session.configfs.read(attributes=attributes)
+    cache = getattr(session, 'cache', None)
+    state = cache.load() if cache is not None else None
+    if state is None:
+        state = read_saveconfig(session)
+        if cache is not None:
+            cache.store(state)
+    return state
+
+
+def path_exists(state, path):
+    '''
+    Check whether targetcli path ('/backstores/block/test1', '/iscsi/<wwn>/tpg1/luns/lun0', ...) exists in state.
+    '''
+    parts = [p for p in path.split('/') if p]
+    if not parts:
+        return True
+    if parts[0] == 'backstores':
+        return len(parts) < 3 or (len(parts) == 3 and '%s/%s' % (parts[1], parts[2]) in state['backstores'])
+    if parts[0] != 'iscsi' or len(parts) > 5:
+        return False
+    if len(parts) == 1:
+        return True
+    target = state['targets'].get(parts[1])
+    if target is None or len(parts) == 2:
+        return target is not None
+    tpg = target['tpgs'].get(parts[2])
+    if tpg is None or len(parts) == 3:
+        return tpg is not None
+    if parts[3] not in ('luns', 'acls', 'portals'):
+        return False
+    return len(parts) == 4 or parts[4] in tpg[parts[3]]
+
+
+def read_tpg(session, wwn, tag=1):
+    '''
+    Read one TPG of iSCSI target (None when it doesn't exist), from configfs when available.
+    '''
+    session.acquire()
+    if session.configfs.available():
+        return session.configfs.read_tpg(wwn, tag, attributes=False)
+    target = snapshot(session)['targets'].get(wwn)
+    return target['tpgs'].get('tpg%d' % tag) if target else None
+
+
+def read_target(session, wwn, attributes=False):
+    '''
+    Read iSCSI target with all its TPGs and their children in one pass (None when it doesn't exist),
+    from configfs when available. Attributes are read from configfs only when asked for.
+    '''
+    session.acquire()
+    if session.configfs.available():
+        return session.configfs.read_target(wwn, attributes)
+    return snapshot(session)['targets'].get(wwn)
+
+
+def lun_by_backstore(tpg):
+    '''
+    Index of LUNs in TPG keyed by backstore ('block/test1' -> 'lun0').
+    '''
+    return dict((lun['backstore'], name) for name, lun in tpg['luns'].items())
+
+
+def in_scope(key, patterns):
+    '''
+    Whether backstore 'type/name' matches list of backstore types and 'type/name' keys.
+    '''
+    return key in patterns or key.split('/')[0] in patterns
+
+
+def backstore_references(state):
+    '''
+    Dependency index of the whole tree, targetcli paths of the LUNs using each backstore
+    ({'block/test1': ['/iscsi/<wwn>/tpg1/luns/lun0']}), every backstore has an entry.
+    LUNs of the other fabrics ('fabric_luns') count as well.
+    '''
+    references = dict((key, []) for key in state['backstores'])
+    for wwn, target in sorted(state['targets'].items()):
+        for tpg_name, tpg in sorted(target['tpgs'].items()):
+            for name, lun in sorted(tpg['luns'].items()):
+                if lun['backstore'] is not None:
+                    references.setdefault(lun['backstore'], []).append('/iscsi/%s/%s/luns/%s' % (wwn, tpg_name, name))
+    for path, backstore in sorted(state.get('fabric_luns', {}).items()):
+        if backstore is not None:
+            references.setdefault(backstore, []).append(path)
+    return references
+
+
+def parse_attributes(attributes):
+    '''
+    Split 'key=value key2=value2' attributes option of the modules into dict.
+    '''
+    parsed = {}
+    for item in (attributes or '').split():
+        key, sep, value = item.partition('=')
+        if not key or not sep:
+            raise TargetCLIStateError("Invalid attribute %s, expected key=value" % item)
+        parsed[key] = value
+    return parsed
+
+
+def read_attributes(session, path, names):
+    '''
+    Current values of the named attributes of backstore or TPG at targetcli path,
+    from configfs attrib/ when available, otherwise with one 'get attribute'.
+    Attributes the object doesn't have are left out.
+    '''
+    if session.configfs.available():
+        return session.configfs.object_attributes(path, names) or {}
+    rc, out, err = session.run('%s get attribute %s' % (path, ' '.join(sorted(names))))
+    if rc != 0:
+        raise TargetCLIStateError('Failed to read attributes of %s: %s' % (path, err or out))
+    current = {}
+    for line in out.splitlines():
+        key, sep, value = line.strip().partition('=')
+        if sep and key in names:
+            current[key] = value.strip()
+    return current
+
+
+def attribute_changes(current, wanted):
+    '''
+    Attributes from wanted that differ from current ones, these need 'set attribute'.
+    '''
+    return dict((k, v) for k, v in wanted.items() if current.get(k) != str(v))
+
+
+def attributes_diff(path, current, changes):
+    '''
+    Module diff ('before'/'after') of the changed attributes of one object.
+    '''
+    return {
+        'before_header': path + ' attributes',
+        'after_header': path + ' attributes',
+        'before': ''.join('%s=%s\n' % (k, current.get(k, '')) for k in sorted(changes)),
+        'after': ''.join('%s=%s\n' % (k, changes[k]) for k in sorted(changes)),
+    }
+
+
+def format_attributes(attributes):
+    '''
+    Attributes (option string or dict) as 'key=value' parameters of 'set attribute'.
+    '''
+    if isinstance(attributes, dict):
+        return ' '.join('%s=%s' % (k, v) for k, v in sorted(attributes.items()))
+    return attributes
+
+
+def reconcile_attributes(session, path, attributes, check_mode=False, current=None):
+    '''
+    Set the attributes (option string) of existing backstore or TPG that differ from the live ones
+    (current when already read), all in one 'set attribute' command.
+    Returns (diff or None when nothing differs, (rc, out, err)).
+    '''
+    wanted = parse_attributes(attributes)
+    if not wanted:
+        return None, (0, '', '')
+    if current is None:
+        current = read_attributes(session, path, list(wanted))
+    changes = attribute_changes(current, wanted)
+    if not changes:
+        return None, (0, '', '')
+    result = (0, '', '')
+    if not check_mode:
+        result = session.run('%s set attribute %s' % (path, ' '.join('%s=%s' % (k, v) for k, v in sorted(changes.items()))))
+    return attributes_diff(path, current, changes), result
+
+
+class Change(dict):
+    '''
+    One planned change, dict so it can be returned in the module result as is.
+    '''
+
+    def __init__(self, action, obj, path, name, command, **kwargs):
+        super(Change, self).__init__(action=action, object=obj, path=path, name=name, command=command, **kwargs)
+
+
+def lun_deleted(backstore, des_luns, purge):
+    '''
+    Whether existing LUN of backstore goes away with the planned changes.
+    '''
+    if backstore in des_luns:
+        return des_luns[backstore].get('state', 'present') == 'absent'
+    return purge
+
+
+class LunAllocator(object):
+    '''
+    Indexes for new LUNs of one TPG, assigned from one read of the TPG before any LUN is created, so
+    that a batch of LUNs gets the same indexes on every host with the same configuration.
+
+    Indexes of existing LUNs and the mapped LUN indexes of all ACLs are taken. targetcli maps new LUN
+    into every ACL under the LUN's own index when it is free there, so LUN created with an allocated
+    index gets the same mapped LUN number in all ACLs. Free indexes are handed out lowest first, the
+    cursor only moves forward, so a batch of N LUNs costs O(N + taken) set lookups.
+    '''
+
+    def __init__(self, tpg, path):
+        self.path = path
+        # index -> backstore of existing LUNs and of the new LUNs given an index by this allocator
+        self.owners = dict((lun['index'], lun['backstore']) for lun in tpg['luns'].values())
+        self.assigned = set()
+        self.taken = set(self.owners)
+        for acl in tpg['acls'].values():
+            self.taken.update(mlun['index'] for mlun in acl['mapped_luns'].values())
+        self.lowest = 0
+
+    def owner(self, index):
+        return self.owners.get(index)
+
+    def take(self, index, backstore):
+        '''
+        Record explicitly requested index of new LUN of backstore, fails when another new LUN has it already,
+        callers check owner() for conflicts with the existing LUNs.
+        '''
+        if index < 0 or index > MAX_LUN_INDEX:
+            raise TargetCLIStateError("LUN index %d of backstore %s in %s is out of range 0-%d"
+                                      % (index, backstore, self.path, MAX_LUN_INDEX))
+        if index in self.assigned and self.owners[index] != backstore:
+            raise TargetCLIStateError("LUN %d in %s is requested for backstores %s and %s"
+                                      % (index, self.path, self.owners[index], backstore))
+        self.owners[index] = backstore
+        self.assigned.add(index)
+        self.taken.add(index)
+        return index
+
+    def allocate(self, backstore):
+        '''
+        Lowest free index for new LUN of backstore.
+        '''
+        while self.lowest in self.taken:
+            self.lowest += 1
+        if self.lowest > MAX_LUN_INDEX:
+            raise TargetCLIStateError("No free LUN index left in %s for backstore %s" % (self.path, backstore))
+        return self.take(self.lowest, backstore)
+
+
+def update_attributes(obj, path, name, current, wanted):
+    '''
+    Change setting attributes (dict) of existing backstore or TPG that differ from current ones, None when none differ.
+    '''
+    changes = attribute_changes(current, wanted)
+    if not changes:
+        return None
+    return Change('update', obj, path, name, '%s set attribute %s' % (path, format_attributes(changes)),
+                  before=' '.join('%s=%s' % (k, current.get(k, '')) for k in sorted(changes)),
+                  after=format_attributes(changes))
+
+
+def show_auth(auth, key):
+    return '********' if key in SECRET_AUTH and auth.get(key) else auth.get(key, '')
+
+
+def masked_state(state):
+    '''
+    Copy of state with the secret ACL auth values masked like show_auth(), for returning the state to the controller.
+    '''
+    masked = copy.deepcopy(state)
+    for target in masked['targets'].values():
+        for tpg in target['tpgs'].values():
+            for acl in tpg['acls'].values():
+                auth = acl.get('auth', {})
+                for key in SECRET_AUTH:
+                    if key in auth:
+                        auth[key] = show_auth(auth, key)
+    return masked
+
+
+def update_auth(path, name, current, wanted):
+    '''
+    Change setting ACL auth (userid, password, ...) to wanted values, keys missing in wanted are cleared.
+    '''
+    keys = sorted(k for k in set(current) | set(wanted) if current.get(k, '') != wanted.get(k, ''))
+    if not keys:
+        return None
+    return Change('update', 'acl', path, name, '%s set auth %s' % (path, ' '.join('%s=%s' % (k, wanted.get(k, '')) for k in keys)),
+                  before=' '.join('%s=%s' % (k, show_auth(current, k)) for k in keys),
+                  after=' '.join('%s=%s' % (k, show_auth(wanted, k)) for k in keys))
+
+
+def desired_from_options(backstores, targets):
+    '''
+    Desired state for plan() from backstores and targets options of targetcli_config module.
+    Attribute option strings are parsed into dicts, so plan() keeps them in sync also on existing objects.
+    '''
+    desired = {'backstores': None, 'targets': None}
+    if backstores is not None:
+        desired['backstores'] = {}
+        for bs in backstores:
+            desired['backstores']['%(backstore_type)s/%(backstore_name)s' % bs] = {
+                'type': bs['backstore_type'],
+                'name': bs['backstore_name'],
+                'options': bs['options'],
+                'attributes': wanted_attributes(bs['attributes']) if bs['attributes'] is not None else None,
+                'state': bs['state'],
+            }
+    if targets is not None:
+        desired['targets'] = {}
+        for target in targets:
+            tpg = new_tpg(1)
+            tpg['attributes'] = wanted_attributes(target['attributes']) if target['attributes'] is not None else None
+            tpg['luns'] = None
+            tpg['acls'] = None
+            tpg['portals'] = None
+            if target['luns'] is not None:
+                tpg['luns'] = dict(('%(backstore_type)s/%(backstore_name)s' % lun, {'state': lun['state'], 'index': lun.get('lun_index')})
+                                   for lun in target['luns'])
+            if target['acls'] is not None:
+                tpg['acls'] = dict((acl['initiator_wwn'], {'state': acl['state']}) for acl in target['acls'])
+            if target['portals'] is not None:
+                tpg['portals'] = dict((portal_name(p['portal_ip'], p['portal_port']), {
+                    'ip_address': p['portal_ip'],
+                    'port': p['portal_port'],
+                    'state': p['state'],
+                }) for p in target['portals'])
+            desired['targets'][target['wwn']] = {'wwn': target['wwn'], 'state': target['state'], 'tpgs': {'tpg1': tpg}}
+    return desired
+
+
+def plan(current, desired, purge=False):
+    '''
+    Compute ordered list of changes turning current state into desired one.
+
+    desired has the same shape as the result of from_saveconfig() with these differences:
+      - every object can have 'state': 'absent'
+      - backstores have 'options' for the create command
+      - backstores, targets or target children ('luns', 'acls', 'portals') set to None are not managed
+      - every TPG listed in target's 'tpgs' is managed, missing TPGs are created, unlisted ones are left alone
+      - LUNs are keyed by backstore ('block/test1'), new LUNs without 'index' get the lowest free index
+        (see LunAllocator), every LUN create command has explicit index
+      - attributes are option string set on created objects only, or dict that is also compared with
+        the attributes of existing objects (current state has to be read with attributes then)
+      - ACLs can have 'mapped_luns' (by mapped LUN index, tpg_lun is TPG LUN index) and 'auth' dict,
+        these are managed only when present
+    With purge=True objects not present in desired state are removed (only in managed lists).
+    Objects that exist and don't differ are left alone, so are sessions using them.
+    '''
+    creates = []
+    deletes = []
+    des_backstores = desired.get('backstores') or {}
+    des_targets = desired.get('targets') or {}
+
+    for key, bs in sorted(des_backstores.items()):
+        exists = key in current['backstores']
+        if bs.get('state', 'present') == 'absent':
+            if exists:
+                deletes.append(Change('delete', 'backstore', '/backstores/%s' % key, key,
+                                      '/backstores/%s delete %s' % (bs['type'], bs['name'])))
+        elif not exists:
+            if not bs.get('options'):
+                raise TargetCLIStateError("Missing options needed for creating backstore object %s" % key)
+            creates.append(Change('create', 'backstore', '/backstores/%s' % key, key,
+                                  '/backstores/%s create %s %s' % (bs['type'], bs['name'], bs['options'])))
+            if bs.get('attributes'):
+                creates.append(Change('create', 'backstore', '/backstores/%s' % key, key,
+                                      '/backstores/%s set attribute %s' % (key, format_attributes(bs['attributes']))))
+        elif isinstance(bs.get('attributes'), dict):
+            update = update_attributes('backstore', '/backstores/%s' % key, key,
+                                       current['backstores'][key]['attributes'], bs['attributes'])
+            if update is not None:
+                creates.append(update)
+    if purge and desired.get('backstores') is not None:
+        for key, bs in sorted(current['backstores'].items()):
+            if key not in des_backstores:
+                deletes.append(Change('delete', 'backstore', '/backstores/%s' % key, key,
+                                      '/backstores/%s delete %s' % (bs['type'], bs['name'])))
+
+    # backstores that will exist after the changes, LUNs can refer only to these
+    after_backstores = set(current['backstores'])
+    after_backstores.difference_update(c['name'] for c in deletes)
+    after_backstores.update(c['name'] for c in creates)
+
+    deleted_targets = set()
+    for wwn, target in sorted(des_targets.items()):
+        path = '/iscsi/%s' % wwn
+        exists = wwn in current['targets']
+        if target.get('state', 'present') == 'absent':
+            if exists:
+                deletes.append(Change('delete', 'target', path, wwn, '/iscsi delete %s' % wwn))
+                deleted_targets.add(wwn)
+            continue
+        if not exists:
+            creates.append(Change('create', 'target', path, wwn, '/iscsi create %s' % wwn))
+        for tpg_name, des_tpg in sorted(target['tpgs'].items()):
+            tpg_path = '%s/%s' % (path, tpg_name)
+            cur_tpg = current['targets'][wwn]['tpgs'].get(tpg_name) if exists else None
+            # targetcli creates TPG 1 together with the target
+            new = cur_tpg is None and (exists or des_tpg['tag'] != 1)
+            if new:
+                creates.append(Change('create', 'tpg', tpg_path, tpg_name, '%s create tag=%d' % (path, des_tpg['tag'])))
+            created = cur_tpg is None
+            if created:
+                cur_tpg = new_tpg(des_tpg['tag'])
+            if created and des_tpg.get('attributes'):
+                creates.append(Change('create', 'tpg', tpg_path, tpg_name,
+                                      '%s set attribute %s' % (tpg_path, format_attributes(des_tpg['attributes']))))
+            elif isinstance(des_tpg.get('attributes'), dict):
+                update = update_attributes('target', tpg_path, wwn, cur_tpg['attributes'], des_tpg['attributes'])
+                if update is not None:
+                    creates.append(update)
+
+            # LUNs
+            if des_tpg.get('luns') is not None:
+                cur_luns = lun_by_backstore(cur_tpg)
+                # LUNs without index get the lowest indexes left free by the existing LUNs, mapped LUNs and
+                # the explicitly requested indexes
+                allocator = LunAllocator(cur_tpg, tpg_path)
+                for backstore, lun in sorted(des_tpg['luns'].items()):
+                    if lun.get('index') is not None and lun.get('state', 'present') != 'absent' and backstore not in cur_luns:
+                        allocator.take(lun['index'], backstore)
+                for backstore, lun in sorted(des_tpg['luns'].items()):
+                    if lun.get('state', 'present') == 'absent':
+                        if backstore in cur_luns:
+                            deletes.append(Change('delete', 'lun', '%s/luns/%s' % (tpg_path, cur_luns[backstore]), backstore,
+                                                  '%s/luns delete %s' % (tpg_path, cur_luns[backstore])))
+                    elif backstore not in cur_luns:
+                        if backstore not in after_backstores:
+                            raise TargetCLIStateError("LUN in %s refers to backstore %s that is not defined" % (tpg_path, backstore))
+                        if lun.get('index') is not None:
+                            used = cur_tpg['luns'].get('lun%d' % lun['index'])
+                            if used is not None and not lun_deleted(used['backstore'], des_tpg['luns'], purge):
+                                raise TargetCLIStateError("LUN %d in %s is used by backstore %s"
+                                                          % (lun['index'], tpg_path, used['backstore']))
+                            index = lun['index']
+                        else:
+                            index = allocator.allocate(backstore)
+                        creates.append(Change('create', 'lun', '%s/luns' % tpg_path, backstore,
+                                              '%s/luns create /backstores/%s lun=%d' % (tpg_path, backstore, index)))
+                if purge:
+                    for backstore, name in sorted(cur_luns.items()):
+                        if backstore not in des_tpg['luns']:
+                            deletes.append(Change('delete', 'lun', '%s/luns/%s' % (tpg_path, name), backstore,
+                                                  '%s/luns delete %s' % (tpg_path, name)))
+
+            # ACLs
+            if des_tpg.get('acls') is not None:
+                for initiator, acl in sorted(des_tpg['acls'].items()):
+                    acl_path = '%s/acls/%s' % (tpg_path, initiator)
+                    if acl.get('state', 'present') == 'absent':
+                        if initiator in cur_tpg['acls']:
+                            deletes.append(Change('delete', 'acl', acl_path, initiator,
+                                                  '%s/acls delete %s' % (tpg_path, initiator)))
+                        continue
+                    cur_acl = cur_tpg['acls'].get(initiator)
+                    if cur_acl is None:
+                        creates.append(Change('create', 'acl', acl_path, initiator,
+                                              '%s/acls create %s' % (tpg_path, initiator)))
+                        cur_acl = {'mapped_luns': {}, 'auth': {}}
+                    if acl.get('auth') is not None:
+                        update = update_auth(acl_path, initiator, cur_acl['auth'], acl['auth'])
+                        if update is not None:
+                            creates.append(update)
+                    if acl.get('mapped_luns') is not None:
+                        for name, mlun in sorted(acl['mapped_luns'].items()):
+                            cur_mlun = cur_acl['mapped_luns'].get(name)
+                            if cur_mlun is not None and (cur_mlun['tpg_lun'], bool(cur_mlun['write_protect'])) == \
+                                    (mlun['tpg_lun'], bool(mlun['write_protect'])):
+                                continue
+                            if cur_mlun is not None:
+                                deletes.append(Change('delete', 'mapped_lun', '%s/%s' % (acl_path, name), name,
+                                                      '%s delete %d' % (acl_path, cur_mlun['index'])))
+                            creates.append(Change('create', 'mapped_lun', '%s/%s' % (acl_path, name), name,
+                                                  '%s create mapped_lun=%d tpg_lun_or_backstore=%d write_protect=%s'
+                                                  % (acl_path, mlun['index'], mlun['tpg_lun'], str(bool(mlun['write_protect'])).lower())))
+                        if purge:
+                            for name, cur_mlun in sorted(cur_acl['mapped_luns'].items()):
+                                if name not in acl['mapped_luns']:
+                                    deletes.append(Change('delete', 'mapped_lun', '%s/%s' % (acl_path, name), name,
+                                                          '%s delete %d' % (acl_path, cur_mlun['index'])))
+                if purge:
+                    for initiator in sorted(cur_tpg['acls']):
+                        if initiator not in des_tpg['acls']:
+                            deletes.append(Change('delete', 'acl', '%s/acls/%s' % (tpg_path, initiator), initiator,
+                                                  '%s/acls delete %s' % (tpg_path, initiator)))
+
+            # portals, new targets get only the listed ones (or targetcli's default one on TPG 1 when not managed),
+            # session applying the changes must have auto_add_default_portal turned off
+            des_portals = des_tpg.get('portals')
+            if des_portals is None and not exists and des_tpg['tag'] == 1:
+                ip, port = DEFAULT_PORTAL.split(':')
+                des_portals = {DEFAULT_PORTAL: {'ip_address': ip, 'port': int(port)}}
+            if des_portals is not None:
+                for name, portal in sorted(des_portals.items()):
+                    portal_cmd = 'ip_address=%(ip_address)s ip_port=%(port)s' % portal
+                    if portal.get('state', 'present') == 'absent':
+                        if name in cur_tpg['portals']:
+                            deletes.append(Change('delete', 'portal', '%s/portals/%s' % (tpg_path, name), name,
+                                                  '%s/portals delete %s' % (tpg_path, portal_cmd)))
+                    elif name not in cur_tpg['portals']:
+                        creates.append(Change('create', 'portal', '%s/portals/%s' % (tpg_path, name), name,
+                                              '%s/portals create %s' % (tpg_path, portal_cmd)))
+                if purge:
+                    for name, portal in sorted(cur_tpg['portals'].items()):
+                        if name not in des_portals:
+                            deletes.append(Change('delete', 'portal', '%s/portals/%s' % (tpg_path, name), name,
+                                                  '%s/portals delete ip_address=%s ip_port=%s' % (tpg_path, portal['ip_address'], portal['port'])))
+
+    if purge and desired.get('targets') is not None:
+        for wwn in sorted(current['targets']):
+            if wwn not in des_targets:
+                deletes.append(Change('delete', 'target', '/iscsi/%s' % wwn, wwn, '/iscsi delete %s' % wwn))
+                deleted_targets.add(wwn)
+
+    # children of deleted targets are gone together with the target
+    deletes = [c for c in deletes if c['object'] in ('target', 'backstore') or c['path'].split('/')[2] not in deleted_targets]
+    deletes.sort(key=lambda c: -OBJECT_ORDER.index(c['object']))
+    creates.sort(key=lambda c: OBJECT_ORDER.index(c['object']))
+    return deletes + creates
+
+
+def diff(changes):
+    '''
+    Ansible diff of the planned changes: deleted objects before, created objects after,
+    changed attributes and auth in both.
+    '''
+    before = sorted(set(c['path'] for c in changes if c['action'] == 'delete') |
+                    set('%s %s' % (c['path'], c['before']) for c in changes if c['action'] == 'update'))
+    after = sorted(set(c['path'] if c['object'] != 'lun' else '%s/%s' % (c['path'], c['name'])
+                       for c in changes if c['action'] == 'create') |
+                   set('%s %s' % (c['path'], c['after']) for c in changes if c['action'] == 'update'))
+    return {
+        'before': ''.join(p + '\n' for p in before),
+        'after': ''.join(p + '\n' for p in after),
+    }
+
+
+def apply(session, changes):
+    '''
+    Run the planned changes in the session, returns (failed change, out, err) or None on success.
+    '''
+    for change in changes:
+        rc, out, err = session.run(change['command'])
+        if rc != 0:
+            return change, out, err
+        change['done'] = True
+    return None
+
+
+def recreate_options(bs):
+    '''
+    Options of backstore create command recreating backstore of the state, None when the state lacks
+    the device or size it needs.
+    '''
+    options = []
+    if bs['type'] in ('block', 'pscsi', 'fileio'):
+        if not bs.get('dev'):
+            return None
+        options.append('%s=%s' % ('file_or_dev' if bs['type'] == 'fileio' else 'dev', bs['dev']))
+        if bs['type'] == 'fileio' and bs.get('size'):
+            options.append('size=%s' % bs['size'])
+    elif bs['type'] == 'ramdisk' and bs.get('size'):
+        options.append('size=%s' % bs['size'])
+    else:
+        return None
+    if bs['type'] != 'pscsi' and bs.get('wwn'):
+        options.append('wwn=%s' % bs['wwn'])
+    return ' '.join(options)
+
+
+def revert_state(before, after, backstores, targets):
+    '''
+    Desired state for plan() with purge that puts backstores and targets (sets of keys and WWNs) of after
+    state back to how they are in before state, all other objects of after state are left alone.
+    Attributes are reverted only on objects that still exist. Returns (desired, keys of backstores that
+    can't be recreated), LUNs of these are left out too.
+    '''
+    desired = {'backstores': {}, 'targets': {}}
+    lost = set()
+    for key, bs in after['backstores'].items():
+        if key not in backstores:
+            desired['backstores'][key] = {'type': bs['type'], 'name': bs['name']}
+    for key in backstores:
+        bs = before['backstores'].get(key)
+        if bs is None:
+            continue
+        item = {'type': bs['type'], 'name': bs['name']}
+        if key in after['backstores']:
+            if bs.get('attributes'):
+                item['attributes'] = stable_attributes(bs['attributes'])
+        else:
+            item['options'] = recreate_options(bs)
+            if item['options'] is None:
+                lost.add(key)
+                continue
+        desired['backstores'][key] = item
+
+    for wwn in after['targets']:
+        if wwn not in targets:
+            desired['targets'][wwn] = {'wwn': wwn, 'tpgs': {}}
+    for wwn in targets:
+        if wwn not in before['targets']:
+            continue
+        tpgs = {}
+        for name, tpg in before['targets'][wwn]['tpgs'].items():
+            kept = [lun for lun in tpg['luns'].values() if lun['backstore'] is not None and lun['backstore'] not in lost]
+            indexes = set(lun['index'] for lun in kept)
+            existed = wwn in after['targets'] and name in after['targets'][wwn]['tpgs']
+            tpgs[name] = {
+                'tag': tpg['tag'],
+                'attributes': stable_attributes(tpg['attributes']) if existed and tpg.get('attributes') else None,
+                'luns': dict((lun['backstore'], {'index': lun['index']}) for lun in kept),
+                'acls': dict((initiator, {
+                    'mapped_luns': dict((n, m) for n, m in acl['mapped_luns'].items() if m['tpg_lun'] in indexes),
+                    'auth': dict(acl.get('auth', {})),
+                }) for initiator, acl in tpg['acls'].items()),
+                'portals': dict(tpg['portals']),
+            }
+        desired['targets'][wwn] = {'wwn': wwn, 'tpgs': tpgs}
+    return desired, lost
+
+
+def rollback_plan(before, after, paths):
+    '''
+    Changes putting the objects at targetcli paths changed by a failed batch back to before state, together
+    with the objects their deletion took along (LUNs of deleted backstore, children of deleted target).
+    Returns (changes, keys of backstores that can't be recreated).
+    '''
+    backstores = set()
+    targets = set()
+    for path in paths:
+        parts = path.split('/')
+        if parts[1] == 'backstores':
+            backstores.add('/'.join(parts[2:4]))
+        elif len(parts) > 2:
+            targets.add(parts[2])
+    references = backstore_references(before)
+    for key in backstores:
+        # LUNs of the other fabrics are not managed
+        targets.update(path.split('/')[2] for path in references.get(key, []) if path.startswith('/iscsi/'))
+
+    desired, lost = revert_state(before, after, backstores, targets)
+    # TPGs are not purged by plan()
+    changes = []
+    for wwn in sorted(targets):
+        if wwn in before['targets'] and wwn in after['targets']:
+            for name, tpg in sorted(after['targets'][wwn]['tpgs'].items()):
+                if name not in before['targets'][wwn]['tpgs']:
+                    changes.append(Change('delete', 'tpg', '/iscsi/%s/%s' % (wwn, name), name,
+                                          '/iscsi/%s delete tag=%d' % (wwn, tpg['tag'])))
+    for change in plan(after, desired, purge=True):
+        if change['action'] == 'create' and change['object'] in ('lun', 'acl'):
+            # mapped LUNs are recreated only as they were
+            change['command'] += ' add_mapped_luns=false'
+        changes.append(change)
+    return changes, sorted(lost)
+
+
+def rollback(session, before, paths):
+    '''
+    Revert the objects at paths changed by a failed batch to before state (snapshot() taken before the
+    batch) in the same session, live configuration is read again to see what the batch did.
+    All steps are run even when some fail, returns the steps (changes with rc and error of the failed ones).
+    '''
+    try:
+        if session.configfs.available():
+            after = session.configfs.read(attributes=True)
+        else:
+            after = read_saveconfig(session)
+        changes, lost = rollback_plan(before, after, paths)
+    except TargetCLIStateError as e:
+        return [{'command': None, 'rc': None, 'error': 'Failed to plan the rollback: %s' % e}]
+    steps = []
+    for change in changes:
+        rc, out, err = session.run(change['command'])
+        step = dict(change, rc=rc)
+        if change['object'] == 'acl' and change['action'] == 'update':
+            # CHAP passwords of the before state are not shown
+            step['command'] = '%s set auth %s' % (change['path'], change['after'])
+        if rc != 0:
+            step['error'] = err or out
+        steps.append(step)
+    for key in lost:
+        steps.append(Change('create', 'backstore', '/backstores/%s' % key, key, None, rc=None,
+                            error='device or size of the deleted backstore is not known, it was not recreated'))
+    return steps
+
+
+def rolled_back(steps):
+    return all(step['rc'] == 0 for step in steps)
+
+
+def stable_attributes(attributes):
+    return dict((k, v) for k, v in normalize_attributes(attributes).items()
+                if not k.startswith('hw_') and k not in READONLY_ATTRIBUTES)
+
+
+def wanted_attributes(attributes):
+    '''
+    Attributes of desired object (option string or dict) as dict of strings.
+    '''
+    if isinstance(attributes, dict):
+        return normalize_attributes(attributes)
+    return parse_attributes(attributes)
+
+
+def present(objects):
+    return sorted(k for k, v in objects.items() if v.get('state', 'present') != 'absent')
+
+
+def live_view(state):
+    '''
+    Normalized live configuration for fingerprint(), device paths, sizes, serial numbers and read-only
+    attributes are left out, they are not managed by the modules or differ between configfs and saveconfig.
+    '''
+    view = {'backstores': {}, 'targets': {}}
+    for key, bs in state['backstores'].items():
+        view['backstores'][key] = {'attributes': stable_attributes(bs.get('attributes'))}
+    for wwn, target in state['targets'].items():
+        tpgs = {}
+        for name, tpg in target['tpgs'].items():
+            tpgs[name] = {
+                'enable': bool(tpg.get('enable', True)),
+                'attributes': stable_attributes(tpg.get('attributes')),
+                'luns': dict((lun['backstore'], lun['index']) for lun in tpg['luns'].values()),
+                'acls': dict((initiator, {
+                    'mapped_luns': dict((str(m['index']), [m['tpg_lun'], bool(m['write_protect'])])
+                                        for m in acl['mapped_luns'].values()),
+                    'auth': dict((k, v) for k, v in acl.get('auth', {}).items() if v),
+                }) for initiator, acl in tpg['acls'].items()),
+                'portals': sorted(tpg['portals']),
+            }
+        view['targets'][wwn] = {'tpgs': tpgs}
+    return view
+
+
+def managed_view(state, desired, purge=False):
+    '''
+    Part of the live configuration that desired state (of desired_from_options()) manages, normalized
+    like desired_view() so that the fingerprints of both match when plan() has nothing to change.
+    '''
+    view = {}
+    if desired.get('backstores') is not None:
+        view['backstores'] = {}
+        for key, bs in state['backstores'].items():
+            if key in desired['backstores'] or purge:
+                names = wanted_attributes(desired['backstores'].get(key, {}).get('attributes'))
+                view['backstores'][key] = {'attributes': dict((n, bs['attributes'].get(n)) for n in names)}
+    if desired.get('targets') is not None:
+        view['targets'] = {}
+        for wwn, target in state['targets'].items():
+            if wwn not in desired['targets'] and not purge:
+                continue
+            view['targets'][wwn] = {}
+            if wwn not in desired['targets']:
+                continue
+            des_tpg = desired['targets'][wwn]['tpgs']['tpg1']
+            tpg = target['tpgs'].get('tpg1', new_tpg(1))
+            names = wanted_attributes(des_tpg.get('attributes'))
+            view['targets'][wwn]['attributes'] = dict((n, tpg['attributes'].get(n)) for n in names)
+            for part, current in (('luns', lun_by_backstore(tpg)), ('acls', tpg['acls']), ('portals', tpg['portals'])):
+                if des_tpg.get(part) is not None:
+                    view['targets'][wwn][part] = sorted(k for k in current if purge or k in des_tpg[part])
+    return view
+
+
+def desired_view(desired):
+    '''
+    Normalized desired state (of desired_from_options()) for fingerprint(), see managed_view().
+    '''
+    view = {}
+    if desired.get('backstores') is not None:
+        view['backstores'] = dict((key, {'attributes': wanted_attributes(desired['backstores'][key].get('attributes'))})
+                                  for key in present(desired['backstores']))
+    if desired.get('targets') is not None:
+        view['targets'] = {}
+        for wwn in present(desired['targets']):
+            des_tpg = desired['targets'][wwn]['tpgs']['tpg1']
+            view['targets'][wwn] = {'attributes': wanted_attributes(des_tpg.get('attributes'))}
+            for part in ('luns', 'acls', 'portals'):
+                if des_tpg.get(part) is not None:
+                    view['targets'][wwn][part] = present(des_tpg[part])
+    return view
+
+
+def fingerprint(view):
+    '''
+    Stable hash of normalized configuration view, independent of ordering of the objects.
+    '''
+    return hashlib.sha256(json.dumps(view, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
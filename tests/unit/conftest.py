@@ -0,0 +1,18 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+'''
+Unit tests of module_utils and modules, run with 'python -m pytest tests/unit' from the role directory.
+
+module_utils of the role are made importable as ansible.module_utils.targetcli_* the same way
+bench/ scripts do it.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import ansible.module_utils
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ansible.module_utils.__path__.append(os.path.join(ROOT_DIR, 'module_utils'))
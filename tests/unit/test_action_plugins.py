@@ -0,0 +1,124 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+'''
+Loop batching of the action plugins, with the task, the templar and the module execution replaced by stubs.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import pytest
+from jinja2.nativetypes import NativeEnvironment
+
+from conftest import ROOT_DIR
+
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+
+    def load_source(name, path):
+        spec = spec_from_loader(name, SourceFileLoader(name, path))
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+except ImportError:
+    from imp import load_source
+
+lun_plugin = load_source('targetcli_iscsi_lun_action', os.path.join(ROOT_DIR, 'action_plugins', 'targetcli_iscsi_lun.py'))
+
+WWN = 'iqn.2020-01.com.example:t1'
+
+
+class Templar(object):
+
+    def __init__(self):
+        self.available_variables = {}
+        self.environment = NativeEnvironment()
+
+    def template(self, data):
+        if isinstance(data, dict):
+            return dict((k, self.template(v)) for k, v in data.items())
+        if isinstance(data, list):
+            return [self.template(v) for v in data]
+        if isinstance(data, str) and '{{' in data:
+            return self.environment.from_string(data).render(self.available_variables)
+        return data
+
+
+class Task(object):
+
+    def __init__(self, raw_args, loop):
+        self._uuid = 'task-uuid'
+        self._ds = {'targetcli_iscsi_lun': raw_args, 'loop': loop}
+        self.collections = []
+        self.loop = loop
+        self.loop_with = None
+        self.loop_control = None
+        self.when = []
+        self.until = []
+        self.async_val = 0
+        self.delegate_to = None
+        self.args = raw_args
+
+
+class ModuleArgsParser(object):
+
+    def __init__(self, task_ds, collection_list=None):
+        self.task_ds = task_ds
+
+    def parse(self):
+        return 'targetcli_iscsi_lun', dict(self.task_ds['targetcli_iscsi_lun']), None
+
+
+def action(monkeypatch, raw_args, loop, module_result):
+    monkeypatch.setattr(lun_plugin._loop, 'ModuleArgsParser', ModuleArgsParser)
+    plugin = lun_plugin.ActionModule.__new__(lun_plugin.ActionModule)
+    plugin._task = Task(raw_args, loop)
+    plugin._templar = Templar()
+    plugin.calls = []
+
+    def execute_module(module_args=None, task_vars=None):
+        plugin.calls.append(module_args)
+        return module_result
+    plugin._execute_module = execute_module
+    return plugin
+
+
+def item_results(plugin, loop):
+    results = []
+    for item in loop:
+        # the task arguments of every item are templated before the plugin runs
+        variables = {'inventory_hostname': 'host1', 'item': item}
+        plugin._templar.available_variables = variables
+        plugin._task.args = plugin._templar.template(plugin._task._ds['targetcli_iscsi_lun'])
+        results.append(plugin._batch(variables))
+    return results
+
+
+@pytest.mark.parametrize('indexes', [[3, 7], [3, None]])
+def test_loop_with_lun_index_per_item_is_batched(monkeypatch, indexes):
+    loop = [{'name': 'disk1', 'index': indexes[0]}, {'name': 'disk2', 'index': indexes[1]}]
+    raw_args = {'wwn': WWN, 'backstore_type': 'block', 'backstore_name': '{{ item.name }}', 'lun_index': '{{ item.index }}'}
+    batch_result = {'changed': True, 'changed_objects': ['block/disk1', 'block/disk2'],
+                    'lun_id': {'block/disk1': str(indexes[0]), 'block/disk2': '0'}}
+    plugin = action(monkeypatch, raw_args, loop, batch_result)
+    results = item_results(plugin, loop)
+
+    # one module run with all objects and their indexes
+    assert len(plugin.calls) == 1
+    expected = [{'backstore_type': 'block', 'backstore_name': 'disk1', 'lun_index': indexes[0]},
+                {'backstore_type': 'block', 'backstore_name': 'disk2'}]
+    if indexes[1] is not None:
+        expected[1]['lun_index'] = indexes[1]
+    assert plugin.calls[0] == {'wwn': WWN, 'backstores': expected}
+    assert results == [{'changed': True, 'lun_id': str(indexes[0])}, {'changed': True, 'lun_id': '0'}]
+
+
+def test_loop_with_other_differing_options_runs_per_item(monkeypatch):
+    loop = [{'name': 'disk1', 'tpg': 1}, {'name': 'disk2', 'tpg': 2}]
+    raw_args = {'wwn': WWN, 'backstore_type': 'block', 'backstore_name': '{{ item.name }}', 'tpg': '{{ item.tpg }}'}
+    plugin = action(monkeypatch, raw_args, loop, {})
+    assert item_results(plugin, loop) == [None, None]
+    assert plugin.calls == []
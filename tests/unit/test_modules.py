@@ -0,0 +1,356 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+'''
+Modules run against the fake targetcli (bench/targetcli) with configfs, every run in forked process like
+a task on the managed host. The tests check the targetcli commands of the run (from the 'perf' key),
+the result and the configuration the fake targetcli ends with.
+'''
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import io
+import json
+import os
+import sys
+
+import pytest
+
+from ansible.module_utils import basic
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.targetcli_state import from_saveconfig
+
+from conftest import ROOT_DIR
+
+try:
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import module_from_spec, spec_from_loader
+
+    def load_source(name, path):
+        spec = spec_from_loader(name, SourceFileLoader(name, path))
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+except ImportError:
+    from imp import load_source
+
+bench_modules = load_source('bench_modules', os.path.join(ROOT_DIR, 'bench', 'modules.py'))
+
+WWN = bench_modules.WWN
+TPG = '/iscsi/%s/tpg1' % WWN
+CLIENT = 'iqn.2020-01.com.example:client1'
+
+
+@pytest.fixture(scope='module')
+def bench():
+    environ = dict(os.environ)
+    bench = bench_modules.Bench(argparse.Namespace(latency=0.0, save_cost=0.0, configfs=True, agent=False))
+    yield bench
+    bench.cleanup()
+    os.environ.clear()
+    os.environ.update(environ)
+
+
+def run(bench, name, params):
+    '''
+    Run module in forked process, return (result without 'perf', targetcli commands of the run).
+    '''
+    if name != 'targetcli_facts':
+        params = dict(params, profile=True)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        params.setdefault('_ansible_check_mode', False)
+        basic._ANSIBLE_ARGS = to_bytes(json.dumps({'ANSIBLE_MODULE_ARGS': params}))
+        basic._ANSIBLE_PROFILE = 'legacy'
+        sys.stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        try:
+            bench.module(name).main()
+        except SystemExit:
+            pass
+        os.write(write_fd, to_bytes(sys.stdout.getvalue()))
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        result = json.loads(to_text(f.read()))
+    os.waitpid(pid, 0)
+    result.pop('invocation', None)
+    perf = result.pop('perf', {'commands': []})
+    return result, [c['cmd'] for c in perf['commands'] if c['source'] == 'targetcli']
+
+
+def live(bench):
+    with open(bench.state) as f:
+        return from_saveconfig(json.load(f))
+
+
+def configuration(backstores=2, luns=(), acls=(), portals=()):
+    '''
+    Fake targetcli configuration with block backstores disk0..N and target WWN exporting the listed ones.
+    '''
+    config = bench_modules.saveconfig(backstores, target=True)
+    tpg = config['targets'][0]['tpgs'][0]
+    tpg['luns'] = [{'index': index, 'storage_object': '/backstores/block/disk%d' % disk} for index, disk in enumerate(luns)]
+    tpg['node_acls'] = [{'node_wwn': initiator, 'mapped_luns': []} for initiator in acls]
+    tpg['portals'] = [{'ip_address': ip_address, 'port': 3260} for ip_address in portals]
+    return config
+
+
+def test_backstore(bench):
+    bench.setup(configuration(0))
+    params = {'backstore_type': 'block', 'backstore_name': 'disk9', 'options': '/dev/vg/disk9'}
+    result, commands = run(bench, 'targetcli_backstore', params)
+    assert result['changed'] is True
+    assert commands == ['/backstores/block create disk9 /dev/vg/disk9', '/ saveconfig']
+    assert live(bench)['backstores']['block/disk9']['dev'] == '/dev/vg/disk9'
+
+    result, commands = run(bench, 'targetcli_backstore', params)
+    assert (result['changed'], commands) == (False, [])
+
+    result, commands = run(bench, 'targetcli_backstore', dict(params, state='absent'))
+    assert result['changed'] is True
+    assert commands == ['/backstores/block delete disk9', '/ saveconfig']
+    assert live(bench)['backstores'] == {}
+
+
+def test_iscsi(bench):
+    bench.setup(configuration(0))
+    wwn = 'iqn.2020-01.com.example:t2'
+    result, commands = run(bench, 'targetcli_iscsi', {'wwn': wwn})
+    assert result['changed'] is True
+    assert commands == ['/iscsi create %s' % wwn, '/ saveconfig']
+    assert sorted(live(bench)['targets']) == [WWN, wwn]
+    assert list(live(bench)['targets'][wwn]['tpgs']) == ['tpg1']
+
+    result, commands = run(bench, 'targetcli_iscsi', {'wwn': wwn})
+    assert (result['changed'], commands) == (False, [])
+
+
+def test_iscsi_lun(bench):
+    bench.setup(configuration(2, luns=[0]))
+    params = {'wwn': WWN, 'backstore_type': 'block', 'backstore_name': 'disk1'}
+    result, commands = run(bench, 'targetcli_iscsi_lun', params)
+    assert (result['changed'], result['lun_id']) == (True, '1')
+    assert commands == ['%s/luns create /backstores/block/disk1 lun=1' % TPG, '/ saveconfig']
+    assert live(bench)['targets'][WWN]['tpgs']['tpg1']['luns']['lun1'] == {'index': 1, 'backstore': 'block/disk1'}
+
+    result, commands = run(bench, 'targetcli_iscsi_lun', params)
+    assert (result['changed'], result['lun_id'], commands) == (False, '1', [])
+
+
+def test_iscsi_acl(bench):
+    bench.setup(configuration(1, luns=[0]))
+    result, commands = run(bench, 'targetcli_iscsi_acl', {'wwn': WWN, 'initiator_wwn': CLIENT})
+    assert result['changed'] is True
+    assert commands == ['%s/acls create %s' % (TPG, CLIENT), '/ saveconfig']
+    acl = live(bench)['targets'][WWN]['tpgs']['tpg1']['acls'][CLIENT]
+    # the LUNs of the TPG are mapped under their own numbers
+    assert acl['mapped_luns'] == {'mapped_lun0': {'index': 0, 'tpg_lun': 0, 'write_protect': False}}
+
+    result, commands = run(bench, 'targetcli_iscsi_acl', {'wwn': WWN, 'initiator_wwn': CLIENT})
+    assert (result['changed'], commands) == (False, [])
+
+
+def test_iscsi_acl_batch(bench):
+    old, client2, client3 = ['iqn.2020-01.com.example:%s' % name for name in ('old', 'client2', 'client3')]
+    bench.setup(configuration(1, luns=[0], acls=[old]))
+    params = {'wwn': WWN, 'exclusive': True, 'initiators': [
+        {'initiator_wwn': CLIENT},
+        {'initiator_wwn': client2, 'mapped_luns': [{'mapped_lun': 4, 'tpg_lun': 0}]},
+    ]}
+    result, commands = run(bench, 'targetcli_iscsi_acl', dict(params, _ansible_check_mode=True))
+    assert (result['changed'], result['changed_objects'], commands) == (True, [old, CLIENT, client2], [])
+
+    result, commands = run(bench, 'targetcli_iscsi_acl', params)
+    assert result['changed'] is True
+    assert result['changed_objects'] == [old, CLIENT, client2]
+    assert 'failed_object' not in result
+    assert commands == [
+        '%s/acls delete %s' % (TPG, old),
+        '%s/acls create %s' % (TPG, CLIENT),
+        '%s/acls create %s add_mapped_luns=false' % (TPG, client2),
+        '%s/acls/%s create 4 0 write_protect=false' % (TPG, client2),
+        '/ saveconfig',
+    ]
+    acls = live(bench)['targets'][WWN]['tpgs']['tpg1']['acls']
+    assert sorted(acls) == [CLIENT, client2]
+    assert acls[client2]['mapped_luns'] == {'mapped_lun4': {'index': 4, 'tpg_lun': 0, 'write_protect': False}}
+
+    result, commands = run(bench, 'targetcli_iscsi_acl', params)
+    assert (result['changed'], result['changed_objects'], commands) == (False, [], [])
+
+    # mapped LUN of missing TPG LUN fails, the initiators before it were handled
+    params = {'wwn': WWN, 'initiators': [{'initiator_wwn': client3},
+                                         {'initiator_wwn': CLIENT, 'mapped_luns': [{'mapped_lun': 1, 'tpg_lun': 9}]}]}
+    result, commands = run(bench, 'targetcli_iscsi_acl', params)
+    assert result['failed'] is True
+    assert (result['changed_objects'], result['failed_object']) == ([client3], CLIENT)
+    assert commands[-1] == '%s/acls/%s create 1 9 write_protect=false' % (TPG, CLIENT)
+    # the failed run is not saved
+    assert sorted(live(bench)['targets'][WWN]['tpgs']['tpg1']['acls']) == [CLIENT, client2]
+
+
+def test_iscsi_portal(bench):
+    bench.setup(configuration(0, portals=['0.0.0.0']))
+    params = {'wwns': [WWN], 'portals': [{'portal_ip': '10.0.0.1'}, {'portal_ip': '10.0.0.2', 'portal_port': 3261}],
+              'exclusive': True}
+    result, commands = run(bench, 'targetcli_iscsi_portal', params)
+    assert result['changed'] is True
+    assert result['portals'] == [{'wwn': WWN, 'tpg': 1, 'ip_address': '0.0.0.0', 'port': 3260}]
+    assert result['changed_objects'] == ['%s/portals/0.0.0.0:3260' % TPG, '%s/portals/10.0.0.1:3260' % TPG,
+                                         '%s/portals/10.0.0.2:3261' % TPG]
+    assert commands == [
+        '%s/portals delete ip_address=0.0.0.0 ip_port=3260' % TPG,
+        '%s/portals create ip_address=10.0.0.1 ip_port=3260' % TPG,
+        '%s/portals create ip_address=10.0.0.2 ip_port=3261' % TPG,
+        '/ saveconfig',
+    ]
+    assert sorted(live(bench)['targets'][WWN]['tpgs']['tpg1']['portals']) == ['10.0.0.1:3260', '10.0.0.2:3261']
+
+    result, commands = run(bench, 'targetcli_iscsi_portal', {'wwn': WWN, 'portal_ip': '10.0.0.1'})
+    assert (result['changed'], commands) == (False, [])
+    # the same shape with one target and portal
+    assert result['portals'] == [{'wwn': WWN, 'tpg': 1, 'ip_address': '10.0.0.1', 'port': 3260},
+                                 {'wwn': WWN, 'tpg': 1, 'ip_address': '10.0.0.2', 'port': 3261}]
+
+
+def test_config(bench):
+    bench.setup(configuration(1, luns=[0]))
+    params = {
+        'backstores': [{'backstore_type': 'block', 'backstore_name': 'disk0', 'options': '/dev/vg/disk0'},
+                       {'backstore_type': 'fileio', 'backstore_name': 'file1', 'options': '/tmp/file1.img 1M'}],
+        'targets': [{'wwn': WWN, 'luns': [{'backstore_type': 'block', 'backstore_name': 'disk0'},
+                                          {'backstore_type': 'fileio', 'backstore_name': 'file1'}],
+                     'portals': [{'portal_ip': '10.0.0.1'}]}],
+    }
+    result, commands = run(bench, 'targetcli_config', params)
+    assert result['changed'] is True
+    assert commands == [
+        '/backstores/fileio create file1 /tmp/file1.img 1M',
+        '%s/luns create /backstores/fileio/file1 lun=1' % TPG,
+        '%s/portals create ip_address=10.0.0.1 ip_port=3260' % TPG,
+        '/ saveconfig',
+    ]
+    assert [c['command'] for c in result['changes']] == commands[:-1]
+    tpg = live(bench)['targets'][WWN]['tpgs']['tpg1']
+    assert tpg['luns'] == {'lun0': {'index': 0, 'backstore': 'block/disk0'}, 'lun1': {'index': 1, 'backstore': 'fileio/file1'}}
+    assert list(tpg['portals']) == ['10.0.0.1:3260']
+
+    result, commands = run(bench, 'targetcli_config', params)
+    assert (result['changed'], result['changes'], commands) == (False, [], [])
+
+
+def test_restore(bench, tmp_path):
+    bench.setup(configuration(2, luns=[1], acls=[CLIENT], portals=['10.0.0.1']))
+    src = str(tmp_path / 'saveconfig.json')
+    with open(bench.state) as f, open(src, 'w') as dst:
+        dst.write(f.read())
+    bench.setup(configuration(0))
+    result, commands = run(bench, 'targetcli_restore', {'src': src})
+    assert result['changed'] is True
+    assert commands == [
+        '/backstores/block create disk0 dev=/dev/vg/disk0',
+        '/backstores/block create disk1 dev=/dev/vg/disk1',
+        '%s/luns create /backstores/block/disk1 lun=0' % TPG,
+        '%s/acls create %s' % (TPG, CLIENT),
+        '%s/portals create ip_address=10.0.0.1 ip_port=3260' % TPG,
+        '/ saveconfig',
+    ]
+    with open(src) as f:
+        restored = from_saveconfig(json.load(f))
+    assert live(bench)['targets'] == restored['targets']
+    assert sorted(live(bench)['backstores']) == sorted(restored['backstores'])
+
+    result, commands = run(bench, 'targetcli_restore', {'src': src})
+    assert (result['changed'], commands) == (False, [])
+
+
+def test_prune(bench):
+    bench.setup(configuration(3, luns=[0], acls=[CLIENT, 'iqn.2020-01.com.example:client2']))
+    # backstores are pruned only on request
+    result, commands = run(bench, 'targetcli_prune', {'initiators': [CLIENT]})
+    assert result['changed'] is True
+    assert commands == ['%s/acls delete iqn.2020-01.com.example:client2' % TPG, '/ saveconfig']
+    assert sorted(live(bench)['backstores']) == ['block/disk0', 'block/disk1', 'block/disk2']
+
+    result, commands = run(bench, 'targetcli_prune', {'backstores': True, 'keep_backstores': ['block/disk2']})
+    assert [c['name'] for c in result['changes']] == ['block/disk1']
+    assert commands == ['/backstores/block delete disk1', '/ saveconfig']
+    assert sorted(live(bench)['backstores']) == ['block/disk0', 'block/disk2']
+    assert list(live(bench)['targets'][WWN]['tpgs']['tpg1']['acls']) == [CLIENT]
+
+    result, commands = run(bench, 'targetcli_prune', {'backstores': True, 'keep_backstores': ['block/disk2']})
+    assert (result['changed'], commands) == (False, [])
+
+
+def test_prune_keeps_backstores_of_other_fabrics(bench):
+    config = configuration(2, luns=[0])
+    config['targets'].append({'wwn': 'naa.5001405a1b2c3d4e', 'fabric': 'loopback', 'tpgs': [
+        {'tag': 1, 'enable': True, 'attributes': {}, 'luns': [{'index': 0, 'storage_object': '/backstores/block/disk1'}],
+         'node_acls': [], 'portals': []}]})
+    bench.setup(config)
+    result, commands = run(bench, 'targetcli_prune', {'backstores': True})
+    assert (result['changed'], commands) == (False, [])
+
+
+def test_facts(bench):
+    bench.setup(configuration(1, luns=[0], portals=['10.0.0.1']))
+    if os.path.exists(bench.log):
+        os.unlink(bench.log)
+    desired = {'targets': [{'wwn': WWN, 'luns': [{'backstore_type': 'block', 'backstore_name': 'disk0'}]}]}
+    result, commands = run(bench, 'targetcli_facts', {'configfs_root': bench.configfs, 'desired': desired})
+    facts = result['ansible_facts']['targetcli']
+    assert result['changed'] is False
+    assert facts['source'] == 'configfs'
+    assert sorted(facts['backstores']) == ['block/disk0']
+    assert facts['managed_fingerprint'] == facts['desired_fingerprint']
+    # no targetcli started
+    assert not os.path.exists(bench.log)
+
+    desired['targets'][0]['portals'] = [{'portal_ip': '10.0.0.2'}]
+    facts = run(bench, 'targetcli_facts', {'configfs_root': bench.configfs, 'desired': desired})[0]['ansible_facts']['targetcli']
+    assert facts['managed_fingerprint'] != facts['desired_fingerprint']
+
+
+def test_facts_mask_chap_secrets(bench):
+    config = configuration(1, acls=[CLIENT])
+    acl = config['targets'][0]['tpgs'][0]['node_acls'][0]
+    acl.update(chap_userid='user', chap_password='secret1', chap_mutual_userid='target', chap_mutual_password='secret2')
+    bench.setup(config)
+    sources = {'configfs': {'configfs_root': bench.configfs},
+               'saveconfig': {'configfs_root': bench.configfs + '.missing', 'savefile': bench.savefile}}
+    fingerprints = {}
+    for source, params in sorted(sources.items()):
+        result = run(bench, 'targetcli_facts', params)[0]
+        output = json.dumps(result)
+        assert 'secret1' not in output and 'secret2' not in output
+        facts = result['ansible_facts']['targetcli']
+        assert facts['source'] == source
+        assert facts['targets'][WWN]['tpgs']['tpg1']['acls'][CLIENT]['auth'] == {
+            'userid': 'user', 'password': '********', 'mutual_userid': 'target', 'mutual_password': '********'}
+        fingerprints[source] = facts['fingerprint']
+
+    # the secrets are still part of the fingerprint
+    acl['chap_password'] = 'secret3'
+    bench.setup(config)
+    facts = run(bench, 'targetcli_facts', sources['configfs'])[0]['ansible_facts']['targetcli']
+    assert facts['fingerprint'] != fingerprints['configfs']
+
+
+def test_save(bench):
+    bench.setup(configuration(2))
+    result, commands = run(bench, 'targetcli_iscsi_lun', {'wwn': WWN, 'backstore_type': 'block', 'backstore_name': 'disk0',
+                                                          'save': 'deferred'})
+    assert (result['changed'], result['lun_id']) == (True, '0')
+    assert commands == ['%s/luns create /backstores/block/disk0 lun=0' % TPG]
+
+    result, commands = run(bench, 'targetcli_save', {})
+    assert (result['changed'], commands) == (True, ['/ saveconfig'])
+    with open(bench.savefile) as f:
+        assert from_saveconfig(json.load(f))['targets'][WWN]['tpgs']['tpg1']['luns'] == {
+            'lun0': {'index': 0, 'backstore': 'block/disk0'}}
+
+    result, commands = run(bench, 'targetcli_save', {})
+    assert (result['changed'], commands) == (False, [])
@@ -0,0 +1,189 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import resource
+
+import pytest
+
+from ansible.module_utils.targetcli_configfs import ConfigFS, read_state
+
+WWN = 'iqn.2020-01.com.example:t1'
+CLIENT = 'iqn.2020-01.com.example:client1'
+
+
+def put(path, content=''):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def root(tmp_path):
+    '''
+    configfs tree laid out like the kernel does it: block disk1 exported as LUN 0 and mapped read-only
+    to client1 with CHAP, fileio file1 and ramdisk ram1 with their 'info', two portals, ram1 exported by loopback.
+    '''
+    root = str(tmp_path / 'target')
+    core = os.path.join(root, 'core')
+    put(os.path.join(core, 'iblock_0', 'disk1', 'udev_path'), '/dev/vg/disk1\n')
+    put(os.path.join(core, 'iblock_0', 'disk1', 'wwn', 'vpd_unit_serial'), 'T10 VPD Unit Serial Number: 0123-abcd\n')
+    put(os.path.join(core, 'iblock_0', 'disk1', 'attrib', 'emulate_tpu'), '1\n')
+    put(os.path.join(core, 'iblock_0', 'hba_info'), 'HBA Index: 0 plugin: iblock version: v5.0\n')
+    put(os.path.join(core, 'fileio_1', 'file1', 'udev_path'), '/var/lib/file1.img\n')
+    put(os.path.join(core, 'fileio_1', 'file1', 'info'),
+        'Status: ACTIVATED  Max Queue Depth: 128  SectorSize: 512  HwMaxSectors: 16384\n'
+        '        TCM FILEIO ID: 0        File: /var/lib/file1.img  Size: 1048576  Mode: O_DSYNC\n')
+    put(os.path.join(core, 'rd_mcp_2', 'ram1', 'info'),
+        'Status: ACTIVATED  Max Queue Depth: 128  SectorSize: 512  HwMaxSectors: 1024\n'
+        '        TCM RamDisk ID: 0  RamDisk Pages: 512  PAGES/PAGE_SIZE Per SG: 256  SG_table_count: 2\n')
+    # alua directory is not an HBA
+    os.makedirs(os.path.join(core, 'alua', 'lu_gps', 'default_lu_gp'))
+
+    tpg = os.path.join(root, 'iscsi', WWN, 'tpgt_1')
+    put(os.path.join(tpg, 'enable'), '1\n')
+    put(os.path.join(tpg, 'attrib', 'authentication'), '0\n')
+    os.makedirs(os.path.join(tpg, 'lun', 'lun_0'))
+    os.symlink('../../../../../../target/core/iblock_0/disk1', os.path.join(tpg, 'lun', 'lun_0', '5a1bd01c0d'))
+    os.makedirs(os.path.join(tpg, 'np', '10.0.0.1:3260'))
+    os.makedirs(os.path.join(tpg, 'np', '[fe80::1]:3261'))
+    acl = os.path.join(tpg, 'acls', CLIENT)
+    put(os.path.join(acl, 'lun_3', 'write_protect'), '1\n')
+    os.symlink('../../../../../../target/iscsi/%s/tpgt_1/lun/lun_0' % WWN, os.path.join(acl, 'lun_3', 'b2f3a8c1e4'))
+    put(os.path.join(acl, 'auth', 'userid'), 'user\n')
+    put(os.path.join(acl, 'auth', 'password'), 'secret\n')
+    put(os.path.join(acl, 'auth', 'userid_mutual'), '\n')
+    os.makedirs(os.path.join(root, 'iscsi', 'discovery_auth'))
+
+    # loopback target exporting ramdisk ram1
+    loopback_lun = os.path.join(root, 'loopback', 'naa.5001405a1b2c3d4e', 'tpgt_1', 'lun', 'lun_0')
+    os.makedirs(loopback_lun)
+    os.symlink('../../../../../../target/core/rd_mcp_2/ram1', os.path.join(loopback_lun, 'c3d4e5f6a7'))
+    put(os.path.join(root, 'version'), 'Target Engine Core ConfigFS Infrastructure v5.0\n')
+    return root
+
+
+@pytest.mark.parametrize('path, exists', [
+    ('/', True),
+    ('/backstores', True),
+    ('/backstores/block', True),
+    ('/backstores/block/disk1', True),
+    ('/backstores/block/file1', False),
+    ('/backstores/fileio/file1', True),
+    ('/backstores/ramdisk/ram1', True),
+    ('/iscsi', True),
+    ('/iscsi/%s' % WWN, True),
+    ('/iscsi/iqn.2020-01.com.example:missing', False),
+    ('/iscsi/%s/tpg1' % WWN, True),
+    ('/iscsi/%s/tpg2' % WWN, False),
+    ('/iscsi/%s/tpg1/luns' % WWN, True),
+    ('/iscsi/%s/tpg1/luns/lun0' % WWN, True),
+    ('/iscsi/%s/tpg1/luns/lun1' % WWN, False),
+    ('/iscsi/%s/tpg1/acls/%s' % (WWN, CLIENT), True),
+    ('/iscsi/%s/tpg1/portals/10.0.0.1:3260' % WWN, True),
+    ('/iscsi/%s/tpg1/portals/10.0.0.2:3260' % WWN, False),
+    ('/iscsi/%s/tpg1/acls/%s/mapped_lun3/extra' % (WWN, CLIENT), False),
+    ('/loopback', False),
+])
+def test_exists(root, path, exists):
+    assert ConfigFS(root).exists(path) is exists
+
+
+def test_available(root, tmp_path):
+    assert ConfigFS(root).available()
+    assert not ConfigFS(str(tmp_path / 'missing')).available()
+
+
+def test_read_luns(root):
+    tpg_dir = ConfigFS(root).tpg_dir(WWN, 1)
+    assert ConfigFS(root).read_luns(tpg_dir) == {'lun0': {'index': 0, 'backstore': 'block/disk1'}}
+
+
+def test_read_acls(root):
+    tpg_dir = ConfigFS(root).tpg_dir(WWN, 1)
+    assert ConfigFS(root).read_acls(tpg_dir) == {CLIENT: {
+        'wwn': CLIENT,
+        'mapped_luns': {'mapped_lun3': {'index': 3, 'tpg_lun': 0, 'write_protect': True}},
+        # empty auth files are left out
+        'auth': {'userid': 'user', 'password': 'secret'},
+    }}
+
+
+def test_read_tpg(root):
+    configfs = ConfigFS(root)
+    tpg = configfs.read_tpg(WWN, 1)
+    assert tpg['tag'] == 1
+    assert tpg['enable'] is True
+    assert tpg['attributes'] == {'authentication': '0'}
+    assert sorted(tpg['portals']) == ['10.0.0.1:3260', '[fe80::1]:3261']
+    assert tpg['portals']['[fe80::1]:3261'] == {'ip_address': '[fe80::1]', 'port': 3261}
+    assert tpg['luns'] == configfs.read_luns(configfs.tpg_dir(WWN, 1))
+    assert configfs.read_tpg(WWN, 1, attributes=False)['attributes'] == {}
+    assert configfs.read_tpg(WWN, 2) is None
+
+
+def test_read_size(root):
+    configfs = ConfigFS(root)
+    assert configfs.read_size(os.path.join(root, 'core', 'fileio_1', 'file1')) == 1048576
+    assert configfs.read_size(os.path.join(root, 'core', 'rd_mcp_2', 'ram1')) == 256 * 2 * resource.getpagesize()
+    assert configfs.read_size(os.path.join(root, 'core', 'iblock_0', 'disk1')) is None
+
+
+def test_read_backstores(root):
+    backstores = ConfigFS(root).read_backstores()
+    assert sorted(backstores) == ['block/disk1', 'fileio/file1', 'ramdisk/ram1']
+    assert backstores['block/disk1'] == {'type': 'block', 'name': 'disk1', 'dev': '/dev/vg/disk1', 'size': None,
+                                         'wwn': '0123-abcd', 'attributes': {'emulate_tpu': '1'}}
+    assert backstores['ramdisk/ram1']['dev'] is None
+
+
+def test_read_targets_skips_discovery_auth(root):
+    assert sorted(ConfigFS(root).read_targets()) == [WWN]
+
+
+def test_read_fabric_luns(root):
+    assert ConfigFS(root).read_fabric_luns() == {'/loopback/naa.5001405a1b2c3d4e/tpg1/luns/lun0': 'ramdisk/ram1'}
+    assert ConfigFS(root).read()['fabric_luns'] == ConfigFS(root).read_fabric_luns()
+
+
+def test_read_state_configfs(root, tmp_path):
+    state, source = read_state(root, str(tmp_path / 'saveconfig.json'))
+    assert source == 'configfs'
+    assert state['targets'][WWN]['tpgs']['tpg1']['luns']['lun0']['backstore'] == 'block/disk1'
+
+
+def test_read_state_saveconfig_fallback(tmp_path):
+    savefile = str(tmp_path / 'saveconfig.json')
+    put(savefile, json.dumps({
+        'storage_objects': [{'plugin': 'block', 'name': 'disk1', 'dev': '/dev/vg/disk1', 'attributes': {'emulate_tpu': 1}}],
+        'targets': [
+            {'wwn': WWN, 'fabric': 'iscsi', 'tpgs': [{
+                'tag': 1, 'enable': True, 'attributes': {'authentication': 0},
+                'luns': [{'index': 0, 'storage_object': '/backstores/block/disk1'}],
+                'node_acls': [{'node_wwn': CLIENT, 'chap_userid': 'user',
+                               'mapped_luns': [{'index': 3, 'tpg_lun': 0, 'write_protect': True}]}],
+                'portals': [{'ip_address': '10.0.0.1', 'port': 3260}],
+            }]},
+        ],
+    }))
+    state, source = read_state(str(tmp_path / 'missing'), savefile)
+    assert source == 'saveconfig'
+    assert state['backstores']['block/disk1']['attributes'] == {'emulate_tpu': '1'}
+    tpg = state['targets'][WWN]['tpgs']['tpg1']
+    assert tpg['luns'] == {'lun0': {'index': 0, 'backstore': 'block/disk1'}}
+    assert tpg['acls'][CLIENT]['mapped_luns'] == {'mapped_lun3': {'index': 3, 'tpg_lun': 0, 'write_protect': True}}
+    assert tpg['acls'][CLIENT]['auth'] == {'userid': 'user'}
+    assert list(tpg['portals']) == ['10.0.0.1:3260']
+
+    state, source = read_state(str(tmp_path / 'missing'), savefile, attributes=False)
+    assert state['backstores']['block/disk1']['attributes'] == {}
+    assert state['targets'][WWN]['tpgs']['tpg1']['attributes'] == {}
+
+
+def test_read_state_nothing(tmp_path):
+    assert read_state(str(tmp_path / 'missing'), str(tmp_path / 'missing.json')) == ({'backstores': {}, 'targets': {}}, 'none')
@@ -0,0 +1,163 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from ansible.module_utils.targetcli_ls import parse_backstore_description, parse_ls
+
+WWN = 'iqn.1994-05.com.redhat:data'
+TPG1 = '/iscsi/%s/tpg1' % WWN
+
+# 'targetcli ls' of targetcli-fb 2.1 (CentOS 7), with ALUA groups under the backstores, a fileio image
+# whose path has spaces, read-only and read-write mapped LUNs, two TPGs and IPv4, IPv6 and iSER portals
+LS_ROOT = '''\
+o- / ......................................................................................................................... [...]
+  o- backstores .............................................................................................................. [...]
+  | o- block .................................................................................................. [Storage Objects: 2]
+  | | o- test1 ............................................................... [/dev/c7vg/LV1 (1.0GiB) write-thru activated]
+  | | | o- alua ................................................................................................... [ALUA Groups: 1]
+  | | |   o- default_tg_pt_gp ....................................................................... [ALUA state: Active/optimized]
+  | | o- test2 ............................................................. [/dev/c7vg/LV2 (2.0GiB) write-thru deactivated]
+  | |   o- alua ................................................................................................... [ALUA Groups: 2]
+  | |     o- default_tg_pt_gp ....................................................................... [ALUA state: Active/optimized]
+  | |     o- standby_gp ................................................................................... [ALUA state: Standby]
+  | o- fileio ................................................................................................. [Storage Objects: 1]
+  | | o- images ......................................... [/var/lib/target images/disk 1.img (100.0MiB) write-back activated]
+  | |   o- alua ................................................................................................... [ALUA Groups: 1]
+  | |     o- default_tg_pt_gp ....................................................................... [ALUA state: Active/optimized]
+  | o- pscsi .................................................................................................. [Storage Objects: 0]
+  | o- ramdisk ................................................................................................ [Storage Objects: 1]
+  | | o- rd1 ............................................................................................ [(1.0GiB) deactivated]
+  | |   o- alua ................................................................................................... [ALUA Groups: 1]
+  | |     o- default_tg_pt_gp ....................................................................... [ALUA state: Active/optimized]
+  | o- user:glfs .............................................................................................. [Storage Objects: 0]
+  o- iscsi ............................................................................................................ [Targets: 1]
+  | o- iqn.1994-05.com.redhat:data ....................................................................................... [TPGs: 2]
+  |   o- tpg1 ............................................................................................... [no-gen-acls, no-auth]
+  |   | o- acls .......................................................................................................... [ACLs: 2]
+  |   | | o- iqn.1994-05.com.redhat:client1 ....................................................................... [Mapped LUNs: 2]
+  |   | | | o- mapped_lun0 ............................................................................... [lun0 block/test1 (ro)]
+  |   | | | o- mapped_lun5 ............................................................................ [lun1 fileio/images (rw)]
+  |   | | o- iqn.1994-05.com.redhat:client2 ....................................................................... [Mapped LUNs: 0]
+  |   | o- luns .......................................................................................................... [LUNs: 2]
+  |   | | o- lun0 ...................................................................... [block/test1 (/dev/c7vg/LV1) (default_tg_pt_gp)]
+  |   | | o- lun1 ......................................... [fileio/images (/var/lib/target images/disk 1.img) (default_tg_pt_gp)]
+  |   | o- portals .................................................................................................... [Portals: 3]
+  |   |   o- 0.0.0.0:3260 ..................................................................................................... [OK]
+  |   |   o- 192.168.1.10:3261 ............................................................................................ [iser]
+  |   |   o- [::0]:3260 ....................................................................................................... [OK]
+  |   o- tpg2 ........................................................................... [disabled, gen-acls, tpg-auth, 1-way auth]
+  |     o- acls .......................................................................................................... [ACLs: 0]
+  |     o- luns .......................................................................................................... [LUNs: 1]
+  |     | o- lun3 ...................................................................... [block/test2 (/dev/c7vg/LV2) (default_tg_pt_gp)]
+  |     o- portals .................................................................................................... [Portals: 0]
+  o- loopback ......................................................................................................... [Targets: 0]
+  o- vhost ............................................................................................................ [Targets: 0]
+'''
+
+# 'targetcli /iscsi/<wwn>/tpg1 ls', the listing starts at the TPG
+LS_TPG = '''\
+o- tpg1 ................................................................................................. [no-gen-acls, no-auth]
+  o- acls ............................................................................................................ [ACLs: 1]
+  | o- iqn.1994-05.com.redhat:client1 ......................................................................... [Mapped LUNs: 1]
+  |   o- mapped_lun2 ................................................................................. [lun2 block/test1 (rw)]
+  o- luns ............................................................................................................ [LUNs: 1]
+  | o- lun2 ........................................................................ [block/test1 (/dev/c7vg/LV1) (default_tg_pt_gp)]
+  o- portals ...................................................................................................... [Portals: 0]
+'''
+
+
+@pytest.mark.parametrize('description, expected', [
+    ('/dev/c7vg/LV1 (1.0GiB) write-thru activated', ('/dev/c7vg/LV1', '1.0GiB', 'write-thru', 'activated')),
+    ('/var/lib/target images/disk 1.img (100.0MiB) write-back activated',
+     ('/var/lib/target images/disk 1.img', '100.0MiB', 'write-back', 'activated')),
+    ('(1.0GiB) deactivated', (None, '1.0GiB', None, 'deactivated')),
+    ('nullio (1.0GiB) deactivated', ('nullio', '1.0GiB', None, 'deactivated')),
+    ('/dev/sdb activated', ('/dev/sdb', None, None, 'activated')),
+    ('', (None, None, None, None)),
+])
+def test_parse_backstore_description(description, expected):
+    info = parse_backstore_description(description)
+    assert (info['dev'], info['size'], info['write_mode'], info['status']) == expected
+
+
+def test_nodes_and_status_fields():
+    tree = parse_ls(LS_ROOT)
+    assert tree.get('/')['description'] == '...'
+    assert tree.get('/backstores/block')['description'] == 'Storage Objects: 2'
+    assert tree.get('/backstores/block')['children'] == ['test1', 'test2']
+    assert tree.get(TPG1)['description'] == 'no-gen-acls, no-auth'
+    assert tree.get('/iscsi/%s/tpg2' % WWN)['description'] == 'disabled, gen-acls, tpg-auth, 1-way auth'
+    assert tree.get(TPG1 + '/portals/192.168.1.10:3261')['description'] == 'iser'
+    assert tree.exists('/backstores/user:glfs')
+    assert tree.exists('/vhost')
+    assert not tree.exists('/backstores/block/test3')
+
+
+def test_alua_subnodes():
+    tree = parse_ls(LS_ROOT)
+    assert tree.get('/backstores/block/test2/alua')['children'] == ['default_tg_pt_gp', 'standby_gp']
+    assert tree.get('/backstores/block/test2/alua/standby_gp')['description'] == 'ALUA state: Standby'
+    # ALUA groups are not backstores and the node after them is again a backstore
+    assert sorted(tree.backstores) == ['block/test1', 'block/test2', 'fileio/images', 'ramdisk/rd1']
+    assert tree.get('/backstores/fileio')['children'] == ['images']
+
+
+def test_backstores():
+    tree = parse_ls(LS_ROOT)
+    assert tree.backstore('block', 'test1') == {'type': 'block', 'name': 'test1', 'dev': '/dev/c7vg/LV1', 'size': '1.0GiB',
+                                                'write_mode': 'write-thru', 'status': 'activated'}
+    assert tree.backstore('fileio', 'images')['dev'] == '/var/lib/target images/disk 1.img'
+    assert tree.backstore('ramdisk', 'rd1')['dev'] is None
+    assert tree.backstore('block', 'missing') is None
+
+
+def test_luns():
+    tree = parse_ls(LS_ROOT)
+    assert tree.luns(TPG1) == {'block/test1': 0, 'fileio/images': 1}
+    assert tree.lun_id(TPG1, 'fileio/images') == 1
+    assert tree.lun_id('/iscsi/%s/tpg2' % WWN, 'block/test2') == 3
+    assert tree.lun_id(TPG1, 'block/test2') is None
+
+
+def test_acls_and_mapped_luns():
+    acls = parse_ls(LS_ROOT).acls(TPG1)
+    assert sorted(acls) == ['iqn.1994-05.com.redhat:client1', 'iqn.1994-05.com.redhat:client2']
+    assert acls['iqn.1994-05.com.redhat:client1']['mapped_luns'] == {
+        'mapped_lun0': {'index': 0, 'tpg_lun': 0, 'write_protect': True},
+        'mapped_lun5': {'index': 5, 'tpg_lun': 1, 'write_protect': False},
+    }
+    assert acls['iqn.1994-05.com.redhat:client2']['mapped_luns'] == {}
+
+
+def test_portals():
+    portals = parse_ls(LS_ROOT).portals(TPG1)
+    assert sorted(portals) == ['0.0.0.0:3260', '192.168.1.10:3261', '[::0]:3260']
+    assert portals['[::0]:3260'] == {'ip_address': '[::0]', 'port': 3260}
+
+
+def test_to_state():
+    state = parse_ls(LS_ROOT).to_state()
+    assert sorted(state['backstores']) == ['block/test1', 'block/test2', 'fileio/images', 'ramdisk/rd1']
+    assert state['backstores']['fileio/images']['dev'] == '/var/lib/target images/disk 1.img'
+    target = state['targets'][WWN]
+    assert sorted(target['tpgs']) == ['tpg1', 'tpg2']
+    assert target['tpgs']['tpg2']['luns'] == {'lun3': {'index': 3, 'backstore': 'block/test2'}}
+    assert 'lun_by_backstore' not in target['tpgs']['tpg1']
+
+
+def test_listing_of_subtree():
+    tree = parse_ls(LS_TPG, TPG1)
+    assert tree.exists(TPG1 + '/luns/lun2')
+    assert tree.luns(TPG1) == {'block/test1': 2}
+    assert tree.acls(TPG1)['iqn.1994-05.com.redhat:client1']['mapped_luns']['mapped_lun2']['write_protect'] is False
+    assert parse_ls(LS_TPG, TPG1).to_state()['targets'][WWN]['tpgs']['tpg1']['luns'] == {
+        'lun2': {'index': 2, 'backstore': 'block/test1'}}
+
+
+def test_ignores_unrelated_lines():
+    output = 'Warning: Could not load preferences file /root/.targetcli/prefs.bin.\n' + LS_TPG + '\nGlobal pref auto_save_on_exit=false\n'
+    assert parse_ls(output, TPG1).luns(TPG1) == {'block/test1': 2}
@@ -0,0 +1,53 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from ansible.module_utils.targetcli_replay import Recorder, Replay, load_runs
+
+ACL = '/iscsi/iqn.2020-01.com.example:t1/tpg1/acls/iqn.2020-01.com.example:client1'
+SAVECONFIG = {
+    'fabric_modules': [{'name': 'iscsi', 'discovery_userid': 'discovery', 'discovery_password': 'discosecret'}],
+    'targets': [{'wwn': 'iqn.2020-01.com.example:t1', 'fabric': 'iscsi', 'tpgs': [{'tag': 1, 'node_acls': [
+        {'node_wwn': 'iqn.2020-01.com.example:client1', 'chap_userid': 'user', 'chap_password': 'secret',
+         'chap_mutual_userid': '', 'chap_mutual_password': ''},
+    ]}]}],
+}
+
+
+def record(tmp_path, no_log_values=None):
+    fixture = str(tmp_path / 'fixture.jsonl')
+    savefile = tmp_path / 'saveconfig.json'
+    savefile.write_text(json.dumps(SAVECONFIG))
+    recorder = Recorder(fixture, 'targetcli_iscsi_acl', no_log_values=no_log_values)
+    recorder.record('%s set auth userid=user password=secret mutual_password=mutualsecret' % ACL, 0, '', '')
+    recorder.record('%s get auth' % ACL, 0, 'AUTH CONFIG GROUP\nmutual_password=mutualsecret\npassword=secret\nuserid=user\n', '')
+    recorder.record('/ saveconfig savefile=%s' % savefile, 0, 'Configuration saved to %s' % savefile, '')
+    recorder.record('%s info' % ACL, 0, 'token secret-token', '')
+    recorder.write()
+    with open(fixture) as f:
+        return f.read(), load_runs(fixture)[0]
+
+
+def test_recorder_masks_secrets(tmp_path):
+    content, run = record(tmp_path, no_log_values={'secret-token'})
+    for secret in ('discosecret', 'mutualsecret', 'secret-token', 'password=secret'):
+        assert secret not in content
+    assert run['commands'][0]['cmd'] == '%s set auth userid=user password=******** mutual_password=********' % ACL
+    assert 'userid=user' in run['commands'][1]['out']
+    acl = json.loads(run['commands'][2]['savefile'])['targets'][0]['tpgs'][0]['node_acls'][0]
+    assert (acl['chap_userid'], acl['chap_password'], acl['chap_mutual_password']) == ('user', '********', '')
+    assert json.loads(run['commands'][2]['savefile'])['fabric_modules'][0]['discovery_password'] == '********'
+
+
+def test_replay_matches_masked_commands(tmp_path):
+    dummy, run = record(tmp_path)
+    replay = Replay(run)
+    assert replay.reply('%s set auth userid=user password=other mutual_password=x' % ACL) == (0, '', '')
+    savefile = tmp_path / 'replayed.json'
+    assert replay.reply('/ saveconfig savefile=%s' % savefile)[0] == 0
+    assert 'chap_password' in savefile.read_text()
+    assert replay.unmatched == []
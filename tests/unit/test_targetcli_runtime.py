@@ -0,0 +1,104 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+
+import pytest
+
+from ansible.module_utils.targetcli_runtime import HostLock, HostLockTimeout, StateCache
+
+SAVED = {'storage_objects': [{'plugin': 'block', 'name': 'disk1', 'dev': '/dev/vg/disk1', 'attributes': {}}], 'targets': []}
+
+
+def write(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def test_store_saved_parses_saved_file(tmp_path):
+    savefile = str(tmp_path / 'saveconfig.json')
+    write(savefile, SAVED)
+    cache = StateCache(str(tmp_path / 'run' / 'state.json'), savefile)
+    cache.store_saved()
+    assert sorted(cache.load()['backstores']) == ['block/disk1']
+
+
+def test_stale_after_save_outside(tmp_path):
+    savefile = str(tmp_path / 'saveconfig.json')
+    write(savefile, SAVED)
+    cache = StateCache(str(tmp_path / 'run' / 'state.json'), savefile)
+    cache.store_saved()
+    write(savefile, dict(SAVED, storage_objects=[]))
+    os.utime(savefile, (0, 0))
+    assert cache.load() is None
+
+
+def test_store_saved_invalid_file_invalidates(tmp_path):
+    savefile = str(tmp_path / 'saveconfig.json')
+    write(savefile, SAVED)
+    cache = StateCache(str(tmp_path / 'run' / 'state.json'), savefile)
+    cache.store_saved()
+    with open(savefile, 'w') as f:
+        f.write('{broken')
+    cache.store_saved()
+    assert not os.path.exists(cache.path)
+
+
+def timing_out_waiter(tmp_path, holder):
+    '''
+    Fork a saving run waiting for the lock with zero timeout, it stops when giving up until the parent writes to go.
+
+    Returns (pid, ready, go), ready is readable once the waiter is queued and timed out.
+    '''
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 2
+        try:
+            # the lock file inherited from the holder would keep its flock
+            holder.lock.close()
+            lock = HostLock(str(tmp_path / 'lock'), str(tmp_path / 'queue'), timeout=0, saves=True)
+            queue_lock = lock._queue_lock
+
+            def stopped_queue_lock():
+                os.write(ready_w, b'1')
+                os.read(go_r, 1)
+                return queue_lock()
+            lock._queue_lock = stopped_queue_lock
+            try:
+                lock.acquire()
+                code = 0
+            except HostLockTimeout:
+                code = 1
+        finally:
+            os._exit(code)
+    os.close(ready_w)
+    os.close(go_r)
+    return pid, ready_r, go_w
+
+
+@pytest.mark.parametrize('handed_over', [True, False])
+def test_hand_over_to_timing_out_waiter(tmp_path, handed_over):
+    holder = HostLock(str(tmp_path / 'lock'), str(tmp_path / 'queue'), saves=True)
+    holder.acquire()
+    pid, ready, go = timing_out_waiter(tmp_path, holder)
+    os.read(ready, 1)
+    if handed_over:
+        # handed over before the waiter gave up, it takes the lock (and the save) after all
+        assert holder.hand_over() is True
+        assert not holder.held
+        os.write(go, b'1')
+        assert os.waitpid(pid, 0)[1] >> 8 == 0
+    else:
+        # the waiter gave up first, the holder keeps the lock and saves itself
+        os.write(go, b'1')
+        assert os.waitpid(pid, 0)[1] >> 8 == 1
+        assert os.listdir(str(tmp_path / 'queue')) == []
+        assert holder.hand_over() is False
+        assert holder.held
+    holder.release()
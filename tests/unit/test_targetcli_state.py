@@ -0,0 +1,91 @@
+# Copyright: (c) 2020, Ondrej Famera <ondrej-xa2iel8u@famera.cz>
+# GNU General Public License v3.0+ (see LICENSE-GPLv3.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# Apache License v2.0 (see LICENSE-APACHE2.txt or http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from ansible.module_utils.targetcli_state import (TargetCLIStateError, backstore_references, desired_from_options, desired_view,
+                                                  fingerprint, from_saveconfig, managed_view, new_state, new_tpg, plan)
+
+WWN = 'iqn.2020-01.com.example:t1'
+
+
+def live(emulate_tpu, authentication):
+    state = new_state()
+    state['backstores']['block/disk1'] = {'type': 'block', 'name': 'disk1', 'dev': '/dev/vg/disk1', 'size': None, 'wwn': None,
+                                          'attributes': {'emulate_tpu': emulate_tpu, 'block_size': '512'}}
+    tpg = new_tpg(1)
+    tpg['attributes'] = {'authentication': authentication, 'demo_mode_write_protect': '1'}
+    state['targets'][WWN] = {'wwn': WWN, 'tpgs': {'tpg1': tpg}}
+    return state
+
+
+def options(backstore_attributes, target_attributes):
+    backstores = [{'backstore_type': 'block', 'backstore_name': 'disk1', 'options': '/dev/vg/disk1',
+                   'attributes': backstore_attributes, 'state': 'present'}]
+    targets = [{'wwn': WWN, 'attributes': target_attributes, 'state': 'present', 'luns': None, 'acls': None, 'portals': None}]
+    return desired_from_options(backstores, targets)
+
+
+def fingerprints(state, desired):
+    return fingerprint(managed_view(state, desired)), fingerprint(desired_view(desired))
+
+
+def test_string_attributes_of_existing_objects_are_planned():
+    desired = options('emulate_tpu=1', 'authentication=1')
+    changes = plan(live('0', '0'), desired)
+    assert [c['command'] for c in changes] == [
+        '/backstores/block/disk1 set attribute emulate_tpu=1',
+        '/iscsi/%s/tpg1 set attribute authentication=1' % WWN,
+    ]
+    managed, wanted = fingerprints(live('0', '0'), desired)
+    assert managed != wanted
+
+
+def test_fingerprints_match_after_noop_apply_with_string_attributes():
+    desired = options('emulate_tpu=1', 'authentication=1')
+    state = live('1', '1')
+    assert plan(state, desired) == []
+    managed, wanted = fingerprints(state, desired)
+    assert managed == wanted
+
+
+def test_dict_and_string_attributes_fingerprint_alike():
+    state = live('1', '1')
+    assert fingerprints(state, options('emulate_tpu=1', None)) == fingerprints(state, options({'emulate_tpu': 1}, None))
+
+
+def test_unmanaged_attributes():
+    desired = options(None, None)
+    assert desired['backstores']['block/disk1']['attributes'] is None
+    assert plan(live('0', '0'), desired) == []
+    managed, wanted = fingerprints(live('0', '0'), desired)
+    assert managed == wanted
+
+
+def test_invalid_attribute_string():
+    with pytest.raises(TargetCLIStateError):
+        options('emulate_tpu', None)
+
+
+def test_luns_of_other_fabrics_are_backstore_references():
+    state = from_saveconfig({
+        'storage_objects': [{'plugin': 'block', 'name': 'disk1', 'dev': '/dev/vg/disk1'},
+                            {'plugin': 'block', 'name': 'disk2', 'dev': '/dev/vg/disk2'},
+                            {'plugin': 'block', 'name': 'disk3', 'dev': '/dev/vg/disk3'}],
+        'targets': [
+            {'wwn': WWN, 'fabric': 'iscsi', 'tpgs': [{'tag': 1, 'luns': [{'index': 0, 'storage_object': '/backstores/block/disk1'}]}]},
+            {'wwn': 'naa.5001405a1b2c3d4e', 'fabric': 'loopback',
+             'tpgs': [{'tag': 1, 'luns': [{'index': 0, 'storage_object': '/backstores/block/disk2'}]}]},
+        ],
+    })
+    # only iSCSI targets are managed
+    assert list(state['targets']) == [WWN]
+    assert state['fabric_luns'] == {'/loopback/naa.5001405a1b2c3d4e/tpg1/luns/lun0': 'block/disk2'}
+    assert backstore_references(state) == {
+        'block/disk1': ['/iscsi/%s/tpg1/luns/lun0' % WWN],
+        'block/disk2': ['/loopback/naa.5001405a1b2c3d4e/tpg1/luns/lun0'],
+        'block/disk3': [],
+    }